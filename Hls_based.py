@@ -1,31 +1,223 @@
-from flask import Flask, send_from_directory, render_template_string, session, jsonify, request, url_for
+from quart import Quart, render_template, session, jsonify, request, url_for, abort
+from werkzeug.utils import safe_join
 import os
 import random
 import threading
+import time
 import subprocess
+import json
+import shutil
+import posixpath
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
-import aiofiles
 from aiohttp import ClientSession
-from functools import wraps
-
-app = Flask(__name__)
+from functools import partial, wraps
+from transcode_queue import TranscodeQueue, PRIORITY_BACKGROUND
+from hls_playlist import parse_media_playlist, parse_master_playlist, write_media_playlist, write_master_playlist
+from media_probe import MetadataStore, keyframe_times, packaging_mode
+from segment_cache import SegmentCache
+from async_streaming import stream_file
+from media_catalog import MediaCatalog
+from fs_watcher import DirectoryWatcher, UploadWatcher
+from chunked_transcode import ChunkedTranscoder
+from jit_packager import JitPackager, PackagingError, copy_cut_points
+from shared_state import open_state
+from rate_limit import BandwidthShaper, PLAYBACK, DOWNLOAD
+from metrics import Registry, instrument, JOB_BUCKETS, REALTIME_BUCKETS
+from static_assets import FragmentCache, fingerprint_static
+from compression import compress_responses, negotiate, precompress, read_precompressed
+from encoding_profiles import (DEFAULT_PROFILE, ProfileScheduler, audio_args, calibrate, load_calibration,
+                               load_profiles, quality_args, save_calibration, transcode_args, video_args)
+
+app = Quart(__name__)
 app.secret_key = 'Letgoooooooooooooooooooooo'
 app.permanent_session_lifetime = timedelta(minutes=10)
+# Pages are templates/hls/*.html, their CSS and JS are served from static/ with hashed URLs
+fingerprint_static(app)
+# Pages, JSON and playlists go out gzip or brotli compressed, segments as they are
+compression_cache = compress_responses(app)
 
 # Define paths
-HLS_FOLDER = r"D:\Programs\video\hls"
-VIDEO_FOLDER = r"D:\Programs\video\uploads"
-MAX_CHANNELS = 13
-video_metadata = {}
+HLS_FOLDER = os.getenv('HLS_FOLDER', r"D:\Programs\video\hls")
+VIDEO_FOLDER = os.getenv('VIDEO_FOLDER', r"D:\Programs\video\uploads")
+# Conversions in progress, kept inside HLS_FOLDER so publishing is a rename
+STAGING_FOLDER = os.path.join(HLS_FOLDER, '.staging')
+SEGMENT_DURATION = 2
+# Rendition heights for adaptive bitrate output, e.g. ABR_LADDER=1080,720,480,360.
+# Leave unset to produce the single 1280-wide rendition.
+ABR_LADDER = [int(height) for height in os.getenv('ABR_LADDER', '').split(',') if height.strip()]
+# Video bitrate in kbps for each rendition height
+LADDER_BITRATES = {1080: 5000, 720: 2800, 480: 1400, 360: 800, 240: 400}
+MAX_CHANNELS = int(os.getenv('MAX_CHANNELS', 13))
+# Where channel admission and the catalog generation live: 'memory' for a single
+# process, 'sqlite:///path/state.sqlite3' to share them between worker processes
+SHARED_STATE = os.getenv('SHARED_STATE', 'memory')
+# A channel is a lease renewed by segment fetches and page heartbeats,
+# it is handed to the next waiting viewer once it lapses
+CHANNEL_LEASE_SECONDS = 45
+CHANNEL_HEARTBEAT_SECONDS = 15
+CHANNEL_REAP_INTERVAL = 10
+# Bandwidth limits in megabits per second, 0 for no limit. LINK_MBPS is the
+# server's uplink; once it is full, downloads only get what playback leaves.
+LINK_MBPS = float(os.getenv('LINK_MBPS', 0))
+PLAYBACK_MBPS = float(os.getenv('PLAYBACK_MBPS', 0))
+DOWNLOAD_MBPS = float(os.getenv('DOWNLOAD_MBPS', 50))
+FFMPEG_THREADS = 2
+# Each ffmpeg uses FFMPEG_THREADS threads, so size the pool to the core count
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', max(1, (os.cpu_count() or 2) // FFMPEG_THREADS)))
+# Sources longer than this are transcoded in CHUNK_SECONDS pieces by several ffmpegs at once,
+# drawing on the same TRANSCODE_WORKERS encoders as every other conversion
+CHUNKED_TRANSCODE_SECONDS = float(os.getenv('CHUNKED_TRANSCODE_SECONDS', 600))
+CHUNK_SECONDS = float(os.getenv('CHUNK_SECONDS', 120))
+# A new or replaced file in VIDEO_FOLDER is picked up once it hasn't changed for this long
+UPLOAD_SETTLE_SECONDS = float(os.getenv('UPLOAD_SETTLE_SECONDS', 5))
+TRANSCODE_STATE_FILE = os.path.join(HLS_FOLDER, 'transcode_jobs.json')
+CATALOG_DB = os.path.join(HLS_FOLDER, 'catalog.sqlite3')
+METADATA_DB = os.path.join(HLS_FOLDER, 'metadata.sqlite3')
+# Per worker process, see segment_cache
+SEGMENT_CACHE_BYTES = int(os.getenv('SEGMENT_CACHE_BYTES', 512 * 1024 * 1024))
+# Segments per rendition loaded ahead of time when a title is chosen
+PREFETCH_SEGMENTS = int(os.getenv('PREFETCH_SEGMENTS', 3))
+# JIT_PACKAGING=1 serves every source in VIDEO_FOLDER right away, cutting segments
+# on demand, instead of converting the whole library up front
+JIT_PACKAGING = os.getenv('JIT_PACKAGING', '0') == '1'
+JIT_FOLDER = os.path.join(HLS_FOLDER, '.jit')
+JIT_CACHE_BYTES = int(os.getenv('JIT_CACHE_BYTES', 10 * 1024 ** 3))
+# JSON file of {name: settings} adding to or overriding the built-in encoding profiles
+ENCODING_PROFILES_FILE = os.getenv('ENCODING_PROFILES_FILE')
+ENCODING_PROFILES = load_profiles(ENCODING_PROFILES_FILE)
+# Profile of full transcodes, 'auto' picks one per title from the calibration
+ENCODING_PROFILE = os.getenv('ENCODING_PROFILE', 'auto')
+# A misspelt name would otherwise only surface as a KeyError in every conversion
+if ENCODING_PROFILE != 'auto' and ENCODING_PROFILE not in ENCODING_PROFILES:
+    raise SystemExit(f"ENCODING_PROFILE {ENCODING_PROFILE!r} is not 'auto' or one of {', '.join(ENCODING_PROFILES)}")
+# Realtime factor and bitrate of every profile, measured on this machine at the first start
+ENCODER_CALIBRATION_FILE = os.path.join(HLS_FOLDER, 'encoder_calibration.json')
+# Segments whose codecs can't be copied are encoded while a viewer waits, so use the fastest
+JIT_PROFILE = os.getenv('JIT_PROFILE', DEFAULT_PROFILE)
+if JIT_PROFILE not in ENCODING_PROFILES:
+    raise SystemExit(f"JIT_PROFILE {JIT_PROFILE!r} is not one of {', '.join(ENCODING_PROFILES)}")
+JIT_TRANSCODE_ARGS = transcode_args(ENCODING_PROFILES[JIT_PROFILE], FFMPEG_THREADS)
 
 # Create necessary directories
 os.makedirs(HLS_FOLDER, exist_ok=True)
 os.makedirs(VIDEO_FOLDER, exist_ok=True)
+os.makedirs(STAGING_FOLDER, exist_ok=True)
+
+shared_state = open_state(SHARED_STATE)
+
+# Per-session rate limits and byte counters
+bandwidth = BandwidthShaper(LINK_MBPS * 125000, PLAYBACK_MBPS * 125000, DOWNLOAD_MBPS * 125000)
+
+# Published titles, kept up to date by a watcher on HLS_FOLDER
+catalog = MediaCatalog(HLS_FOLDER, CATALOG_DB, VIDEO_FOLDER, shared_state)
+catalog_watcher = DirectoryWatcher(HLS_FOLDER, catalog.refresh)
+# The rendered movie list, until the catalog changes
+catalog_fragment = FragmentCache()
+catalog_fragment_lock = asyncio.Lock()
+
+# ffprobe results for the source videos
+metadata_store = MetadataStore(METADATA_DB)
+
+# Picks the encoding profile of each full transcode
+profile_scheduler = ProfileScheduler(ENCODING_PROFILES, TRANSCODE_WORKERS,
+                                     load_calibration(ENCODER_CALIBRATION_FILE, FFMPEG_THREADS),
+                                     fixed=None if ENCODING_PROFILE == 'auto' else ENCODING_PROFILE)
 
-# Thread-safe set to track active channels
-active_channels = set()
-active_channels_lock = threading.Lock()
+def calibrate_encoder():
+    """Measure the encoding profiles, run in a thread when there is no calibration for this machine"""
+    try:
+        calibration = calibrate(ENCODING_PROFILES, FFMPEG_THREADS)
+    except Exception as e:
+        logging.error(f"Encoder calibration failed: {e}")
+        return
+    save_calibration(ENCODER_CALIBRATION_FILE, calibration)
+    profile_scheduler.calibration = calibration
+    logging.info(f"Encoder calibration: {calibration['profiles']}")
+
+def source_changed(filename, ingest=True):
+    """Track a file of VIDEO_FOLDER in the catalog and probe it for its duration.
+
+    With `ingest`, a new source counts towards the upload rate the
+    encoding profile is chosen by.
+    """
+    name = os.path.splitext(filename)[0]
+    catalog.refresh_source(filename)
+    source = catalog.source(name)
+    if source is not None and source['duration'] is None:
+        def probed(path, metadata):
+            catalog.refresh_source(os.path.basename(path), metadata['duration'])
+            if ingest and not playlist_filename(name):
+                profile_scheduler.ingested(metadata['duration'] or 0)
+        metadata_store.submit(source['path'], probed)
+
+def source_ready(filename):
+    """A file of VIDEO_FOLDER finished uploading: list it and queue its conversion.
+
+    A title that was published from an older version of the file is
+    converted again. With JIT_PACKAGING nothing is queued.
+    """
+    source_changed(filename)
+    name = os.path.splitext(filename)[0]
+    source = catalog.source(name)
+    if source is None or JIT_PACKAGING:
+        return
+    if conversion_outdated(name, source['path']):
+        logging.info(f"Queueing conversion of new upload {filename}")
+        transcode_queue.submit(name, source['path'], os.path.join(HLS_FOLDER, name), PRIORITY_BACKGROUND)
+
+def source_removed(filename):
+    """A file of VIDEO_FOLDER was deleted: forget it, published titles stay"""
+    name = os.path.splitext(filename)[0]
+    catalog.refresh_source(filename)
+    if catalog.source(name) is None:
+        transcode_queue.cancel(name)
+        jit_packager.discard(name)
+
+# New, replaced and deleted uploads, so the library updates without a rescan
+source_watcher = UploadWatcher(VIDEO_FOLDER, source_ready, source_removed, settle=UPLOAD_SETTLE_SECONDS,
+                               extensions=('.mp4', '.mkv'))
+
+# Every encoding ffmpeg holds one of these, so chunked and whole-file transcodes
+# together never run more than TRANSCODE_WORKERS encoders
+encoder_slots = asyncio.Semaphore(TRANSCODE_WORKERS)
+
+# Splits long transcodes across the idle encoder slots
+chunked_transcoder = ChunkedTranscoder(encoder_slots, CHUNK_SECONDS, SEGMENT_DURATION)
+
+# Serves titles that haven't been converted yet
+jit_packager = JitPackager(JIT_FOLDER, SEGMENT_DURATION, JIT_TRANSCODE_ARGS, JIT_CACHE_BYTES,
+                           workers=TRANSCODE_WORKERS)
+
+# Popular playlists and segments, served from memory
+segment_cache = SegmentCache(SEGMENT_CACHE_BYTES)
+# Fills the cache off the request path
+background_executor = ThreadPoolExecutor(max_workers=2)
+pending_cache_fills = set()
+pending_prefetches = set()
+pending_cache_fills_lock = threading.Lock()
+
+# Prometheus metrics, served on /metrics
+registry = Registry()
+instrument(app, registry)
+for name, help in (('hits', 'Segment cache hits'), ('misses', 'Segment cache misses'),
+                   ('evictions', 'Segment cache evictions'), ('bytes', 'Bytes held in the segment cache'),
+                   ('hit_ratio', 'Segment cache hits over lookups')):
+    registry.gauge_function(f'segment_cache_{name}', help, partial(lambda name: segment_cache.stats()[name], name))
+registry.gauge_function('active_channels', 'Viewers holding a channel', lambda: shared_state.channel_count())
+registry.gauge_function('waiting_viewers', 'Viewers queued for a channel', lambda: shared_state.waiting_count())
+registry.gauge_function('transcode_queue_depth', 'Transcode jobs waiting to run',
+                        lambda: len(transcode_queue.status()['queued']))
+registry.gauge_function('transcode_running', 'Transcode jobs running',
+                        lambda: len(transcode_queue.status()['running']))
+registry.gauge_function('transcode_ingest_rate', 'Media seconds uploaded per second',
+                        lambda: profile_scheduler.ingest_rate())
+transcode_jobs = registry.counter('transcode_jobs_total', 'Finished ffmpeg jobs', ('result',))
+transcode_seconds = registry.histogram('transcode_job_duration_seconds', 'Wall time of successful ffmpeg jobs',
+                                       JOB_BUCKETS, ('mode',))
+transcode_realtime = registry.histogram('transcode_realtime_factor', 'Media seconds converted per second',
+                                        REALTIME_BUCKETS, ('mode',))
 
 def async_wrapper(f):
     @wraps(f)
@@ -33,54 +225,471 @@ def async_wrapper(f):
         return await f(*args, **kwargs)
     return wrapper
 
-async def convert_to_hls(input_path, output_dir):
-    """Convert video to HLS format using ffmpeg asynchronously"""
-    playlist_path = os.path.join(output_dir, 'playlist.m3u8')
-    cmd = [
-    'ffmpeg',
-    '-i', input_path,
-    '-c:v', 'libx264',
-    '-preset', 'ultrafast',
-    '-crf', '28',
-    '-g', '30',  # Set keyframe interval to 1 second (assuming 30 fps)
-    '-r', '30',  # Set constant frame rate to 30 fps
-    '-c:a', 'aac',
-    '-b:a', '128k',
-    '-sn',
-    '-threads', '2',
-    '-vf', 'scale=1280:-1',
-    '-hls_time', '2',  # Set segment duration to 1 second
-    '-hls_playlist_type', 'vod',
-    '-hls_segment_filename', os.path.join(output_dir, 'segment%03d.ts'),
+def source_signature(input_path):
+    """Identify a source file by size and modification time"""
+    stat = os.stat(input_path)
+    return {'path': input_path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+def conversion_outdated(name, input_path):
+    """Whether a title is unpublished or was published from another version of its source.
+
+    Titles converted before conversion.json recorded the source count as current.
+    """
+    if not playlist_filename(name):
+        return True
+    try:
+        with open(os.path.join(HLS_FOLDER, name, 'conversion.json'), 'r') as f:
+            converted_from = json.load(f).get('source')
+    except (FileNotFoundError, json.JSONDecodeError):
+        return False
+    try:
+        return converted_from is not None and converted_from != source_signature(input_path)
+    except FileNotFoundError:
+        return False
+
+def load_manifest(staging_dir, input_path, variants):
+    """Load the list of finished segments for a staged conversion.
+
+    Segments completed by an interrupted ffmpeg run are folded in from the
+    progress playlist of each variant. Renditions are encoded in lockstep, so
+    every variant is cut back to the segments they all have. Anything else
+    left in the staging directory, such as a half-written segment, is
+    removed. A manifest for a different source file or ladder is discarded.
+    """
+    manifest_path = os.path.join(staging_dir, 'manifest.json')
+    source = source_signature(input_path)
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        manifest = None
+    if (manifest is None or manifest.get('source') != source
+            or sorted(manifest.get('variants', {})) != sorted(variants)):
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        manifest = {'source': source, 'variants': {variant: [] for variant in variants}}
+
+    for variant, segments in manifest['variants'].items():
+        variant_dir = os.path.join(staging_dir, variant)
+        os.makedirs(variant_dir, exist_ok=True)
+        finished = {segment['uri'] for segment in segments}
+        resumed = bool(segments)
+        for segment in parse_media_playlist(os.path.join(variant_dir, 'progress.m3u8')):
+            segment_path = os.path.join(variant_dir, segment['uri'])
+            if segment['uri'] in finished or not os.path.isfile(segment_path):
+                continue
+            # The first segment of a resumed run starts a new encode
+            segment['discontinuity'] = resumed
+            resumed = False
+            segments.append(segment)
+            finished.add(segment['uri'])
+
+    complete = min(len(segments) for segments in manifest['variants'].values())
+    for variant, segments in manifest['variants'].items():
+        del segments[complete:]
+        variant_dir = os.path.join(staging_dir, variant)
+        finished = {segment['uri'] for segment in segments}
+        for filename in os.listdir(variant_dir):
+            if filename.endswith(('.ts', '.tmp')) and filename not in finished:
+                os.remove(os.path.join(variant_dir, filename))
+    save_manifest(staging_dir, manifest)
+    return manifest
+
+def save_manifest(staging_dir, manifest):
+    manifest_path = os.path.join(staging_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+def publish_hls(staging_dir, output_dir, variants):
+    """Move a finished conversion into the served HLS folder with a rename"""
+    os.remove(os.path.join(staging_dir, 'manifest.json'))
+    for variant in variants:
+        progress_path = os.path.join(staging_dir, variant, 'progress.m3u8')
+        if os.path.exists(progress_path):
+            os.remove(progress_path)
+    if os.path.exists(output_dir):
+        # Directories can't be swapped in one rename, so move the old one aside
+        retired_dir = staging_dir + '.old'
+        shutil.rmtree(retired_dir, ignore_errors=True)
+        os.replace(output_dir, retired_dir)
+        os.replace(staging_dir, output_dir)
+        shutil.rmtree(retired_dir, ignore_errors=True)
+    else:
+        os.replace(staging_dir, output_dir)
+
+def ladder_renditions(source):
+    """Fit the source into each ABR_LADDER rung without upscaling it.
+
+    A rung of height h is treated as an h-high 16:9 box, so a 1920x800 film
+    still gets a 1080p rendition. Rungs that would repeat the size of a
+    smaller one are dropped. Renditions are returned largest first.
+    """
+    renditions = []
+    sizes = set()
+    for height in sorted(ABR_LADDER):
+        if source['width'] and source['height']:
+            scale = min(height * 16 / 9 / source['width'], height / source['height'], 1)
+            size = (round(source['width'] * scale / 2) * 2, round(source['height'] * scale / 2) * 2)
+        else:
+            size = (round(height * 16 / 9 / 2) * 2, height)
+        if size in sizes:
+            continue
+        sizes.add(size)
+        # Scale the 720p rate by pixel count for heights missing from the table
+        bitrate = LADDER_BITRATES.get(height) or round(LADDER_BITRATES[720] * (height / 720) ** 2)
+        renditions.append({'name': f'{height}p', 'width': size[0], 'height': size[1], 'bitrate': bitrate})
+    return renditions[::-1]
+
+def ladder_args(renditions, has_audio):
+    """ffmpeg arguments that decode once and encode every rendition"""
+    splits = ''.join(f'[v{i}]' for i in range(len(renditions)))
+    scales = ';'.join(f"[v{i}]scale={r['width']}:{r['height']}[v{i}out]" for i, r in enumerate(renditions))
+    args = ['-filter_complex', f'[0:v]split={len(renditions)}{splits};{scales}']
+    stream_map = []
+    for i, rendition in enumerate(renditions):
+        args += ['-map', f'[v{i}out]']
+        if has_audio:
+            args += ['-map', '0:a:0']
+        args += [
+            f'-b:v:{i}', f"{rendition['bitrate']}k",
+            f'-maxrate:v:{i}', f"{round(rendition['bitrate'] * 1.07)}k",
+            f'-bufsize:v:{i}', f"{rendition['bitrate'] * 2}k",
+        ]
+        stream_map.append(f"v:{i},a:{i},name:{rendition['name']}" if has_audio
+                          else f"v:{i},name:{rendition['name']}")
+    # Scene-cut keyframes differ per resolution, so disable them to keep segments aligned
+    args += ['-sc_threshold', '0', '-var_stream_map', ' '.join(stream_map)]
+    return args
+
+async def convert_to_hls(input_path, output_dir, profile_name=DEFAULT_PROFILE):
+    """Convert video to HLS format using ffmpeg asynchronously.
+
+    ffmpeg writes into a staging directory and the result is only published
+    to output_dir once the whole video has been converted. Returns whether
+    it was published.
+    """
+    profile = ENCODING_PROFILES[profile_name]
+    staging_dir = os.path.join(STAGING_FOLDER, os.path.basename(output_dir))
+    source = await asyncio.wrap_future(metadata_store.submit(input_path))
+    if ABR_LADDER:
+        # Every rendition comes out of a single decode, each in its own
+        # subdirectory, with a master.m3u8 pointing at them
+        renditions = ladder_renditions(source)
+        variants = [rendition['name'] for rendition in renditions]
+        mode = 'transcode'
+    else:
+        # An H.264 source is copied rather than re-encoded, with only the audio
+        # encoded to AAC if it has to be; anything else uses `profile_name`
+        variants = ['']
+        mode = packaging_mode(source)
+        if mode != 'transcode':
+            # Copied segments can only be cut on the source's keyframes, so the
+            # largest gap between them has to fit in a segment, not just the average
+            keyframes = await asyncio.to_thread(keyframe_times, input_path)
+            if copy_cut_points(keyframes, source['duration'] or 0, SEGMENT_DURATION) is None:
+                mode = 'transcode'
+    if mode != 'transcode':
+        # Copying runs at disk speed, so start over rather than trust a seek
+        # to land exactly on the keyframe where the last run stopped
+        await asyncio.to_thread(shutil.rmtree, staging_dir, ignore_errors=True)
+    # Disk work runs in threads, the event loop also serves the viewers
+    manifest = await asyncio.to_thread(load_manifest, staging_dir, input_path, variants)
+    converted_from = manifest['source']
+    segments = manifest['variants'][variants[0]]
+    start_number = len(segments)
+    offset = sum(segment['duration'] for segment in segments)
+    if start_number:
+        # An interrupted run resumes after its last complete segment
+        logging.info(f"Resuming {input_path} at segment {start_number} ({offset:.1f}s)")
+
+    cmd = ['ffmpeg', '-y']
+    if offset:
+        # Seeking before -i while transcoding is frame accurate
+        cmd += ['-ss', f'{offset:.3f}']
+    cmd += ['-i', input_path]
+    if mode == 'transcode':
+        cmd += video_args(profile, FFMPEG_THREADS) + audio_args(profile) + ['-sn']
+    else:
+        cmd += ['-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy', '-sn', '-dn']
+        cmd += ['-c:a', 'copy'] if mode == 'copy' else audio_args(profile)
+    if ABR_LADDER:
+        cmd += ladder_args(renditions, bool(source['audio_codec']))
+    elif mode == 'transcode':
+        cmd += quality_args(profile)
+    cmd += [
+    '-output_ts_offset', f'{offset:.3f}',  # Keep timestamps continuous across resumes
+    '-hls_time', str(SEGMENT_DURATION),
+    # EVENT playlists are rewritten after every segment, VOD ones only at the end
+    '-hls_playlist_type', 'event',
+    '-hls_flags', 'temp_file',
+    '-start_number', str(start_number),
+    '-hls_segment_filename', os.path.join(staging_dir, '%v' if ABR_LADDER else '', 'segment%03d.ts'),
     '-f', 'hls',
-    playlist_path
+    os.path.join(staging_dir, '%v' if ABR_LADDER else '', 'progress.m3u8')
 ]
-    process = await asyncio.create_subprocess_exec(*cmd)
-    await process.wait()
-    if process.returncode != 0:
-        print(f"Error converting {input_path}")
+    if (mode == 'transcode' and not ABR_LADDER and not start_number and TRANSCODE_WORKERS > 1
+            and (source['duration'] or 0) > CHUNKED_TRANSCODE_SECONDS):
+        # A long single-rendition transcode is split at keyframes, the chunks
+        # encoded in parallel and stitched into one playlist
+        encoder_args = video_args(profile, FFMPEG_THREADS) + audio_args(profile) + ['-sn'] + quality_args(profile)
+        segments = await chunked_transcoder.transcode(input_path, staging_dir, source['duration'], encoder_args)
+        ok = segments is not None
+        if ok:
+            manifest['variants'][''] = segments
+            await asyncio.to_thread(save_manifest, staging_dir, manifest)
+    elif mode == 'transcode':
+        async with encoder_slots:
+            process = await asyncio.create_subprocess_exec(*cmd)
+            await process.wait()
+        ok = process.returncode == 0
+    else:
+        # Copying hardly uses the CPU, it doesn't need an encoder slot
+        process = await asyncio.create_subprocess_exec(*cmd)
+        await process.wait()
+        ok = process.returncode == 0
+    if ok and await asyncio.to_thread(source_signature, input_path) != converted_from:
+        # Replaced while it was being converted, the queue runs it again
+        logging.warning(f"{input_path} changed during conversion, not publishing it")
+        return False
+    manifest = await asyncio.to_thread(load_manifest, staging_dir, input_path, variants)
+    if not ok:
+        logging.error(f"Error converting {input_path}")
+        return False
+    # Saved next to the playlist, so the mode and profile of a title can be looked up
+    conversion = {'source': converted_from, 'mode': mode, 'profile': profile_name if mode != 'copy' else None,
+                  'video_codec': source['video_codec'], 'audio_codec': source['audio_codec']}
+    await asyncio.to_thread(finish_conversion, staging_dir, output_dir, variants, manifest,
+                            renditions if ABR_LADDER else None, conversion)
+    return True
+
+def finish_conversion(staging_dir, output_dir, variants, manifest, renditions, conversion):
+    """Write the final playlists of a staged conversion and publish it"""
+    for variant in variants:
+        write_media_playlist(os.path.join(staging_dir, variant, 'playlist.m3u8'), manifest['variants'][variant])
+        precompress(os.path.join(staging_dir, variant, 'playlist.m3u8'))
+    if renditions:
+        write_master_playlist(os.path.join(staging_dir, 'master.m3u8'), [{
+            'uri': f"{rendition['name']}/playlist.m3u8",
+            'bandwidth': (round(rendition['bitrate'] * 1.07) + 128) * 1000,
+            'width': rendition['width'],
+            'height': rendition['height'],
+        } for rendition in renditions])
+        precompress(os.path.join(staging_dir, 'master.m3u8'))
+    with open(os.path.join(staging_dir, 'conversion.json'), 'w') as f:
+        json.dump(conversion, f)
+    publish_hls(staging_dir, output_dir, variants)
+
+def transcode_backlog_seconds():
+    """Media seconds of the queued conversions whose sources have been probed"""
+    backlog = 0
+    for job in transcode_queue.status()['queued']:
+        source = catalog.source(job['name'])
+        if source is not None:
+            backlog += source['duration'] or 0
+    return backlog
+
+async def run_transcode_job(job):
+    """Transcode queue handler for a single video"""
+    profile_name = profile_scheduler.choose(transcode_backlog_seconds())
+    started = time.monotonic()
+    ok = await convert_to_hls(job.input_path, job.output_dir, profile_name)
+    elapsed = time.monotonic() - started
+    transcode_jobs.labels('ok' if ok else 'failed').inc()
+    if ok:
+        segment_cache.invalidate(job.name)
+        await asyncio.to_thread(catalog.refresh, job.name)
+        await asyncio.to_thread(jit_packager.discard, job.name)
+        entry = catalog.get(job.name)
+        mode = entry['packaging'] if entry is not None else None
+        transcode_seconds.labels(mode or 'unknown').observe(elapsed)
+        if entry is not None and elapsed > 0:
+            transcode_realtime.labels(mode or 'unknown').observe(entry['duration'] / elapsed)
+    return ok
+
+transcode_queue = TranscodeQueue(run_transcode_job, TRANSCODE_STATE_FILE, workers=TRANSCODE_WORKERS)
 
 async def process_existing_videos():
-    """Process existing videos asynchronously"""
-    tasks = []
-    for filename in sorted(os.listdir(VIDEO_FOLDER)):
-        if filename.lower().endswith(('.mp4', '.mkv')):
-            base_name = os.path.splitext(filename)[0]
-            hls_dir = os.path.join(HLS_FOLDER, base_name)
-            
-            if not os.path.exists(os.path.join(hls_dir, 'playlist.m3u8')):
-                os.makedirs(hls_dir, exist_ok=True)
-                tasks.append(convert_to_hls(os.path.join(VIDEO_FOLDER, filename), hls_dir))
-            
-            if base_name not in video_metadata:
-                video_metadata[base_name] = {'title': base_name, 'duration': 0}
-    
-    await asyncio.gather(*tasks)
+    """Queue conversions for videos that have not been converted yet.
+
+    With JIT_PACKAGING nothing is queued, those titles are packaged as
+    they are watched.
+    """
+    # Checking every title reads its conversion.json, so scan in a thread
+    await asyncio.to_thread(queue_existing_videos)
+
+def queue_existing_videos():
+    # One write of the queue's state file for the whole library, not one per title
+    with transcode_queue.batch():
+        for filename in sorted(os.listdir(VIDEO_FOLDER)):
+            if filename.lower().endswith(('.mp4', '.mkv')):
+                base_name = os.path.splitext(filename)[0]
+                hls_dir = os.path.join(HLS_FOLDER, base_name)
+
+                if not JIT_PACKAGING and conversion_outdated(base_name, os.path.join(VIDEO_FOLDER, filename)):
+                    transcode_queue.submit(base_name, os.path.join(VIDEO_FOLDER, filename), hls_dir, PRIORITY_BACKGROUND)
+
+                # Already here before the server started, queued work rather than new uploads
+                source_changed(filename, ingest=False)
+
+def playlist_filename(movie):
+    """Playlist to hand to players: the ABR master if there is one"""
+    entry = catalog.get(movie)
+    return entry['playlist'] if entry else None
+
+def playlist_url(movie):
+    """URL of the playlist to hand to players, packaged on demand if the title isn't converted"""
+    playlist = playlist_filename(movie)
+    if playlist is None and JIT_PACKAGING and catalog.source(movie) is not None:
+        return url_for('serve_jit', movie=movie, filename='playlist.m3u8')
+    return url_for('serve_hls', movie=movie, filename=playlist)
+
+def movie_metadata(movie):
+    """Title, duration and probed source details of a movie"""
+    entry = catalog.get(movie)
+    metadata = {'title': movie, 'duration': 0}
+    if entry is not None:
+        if entry['source_path']:
+            metadata.update(metadata_store.get(entry['source_path']) or {})
+        metadata['duration'] = round(entry['duration'])
+        metadata['packaging'] = entry['packaging']
+    elif catalog.source(movie) is not None:
+        source = catalog.source(movie)
+        metadata.update(metadata_store.get(source['path']) or {})
+        metadata['duration'] = round(source['duration'] or 0)
+    return metadata
+
+def file_validator(file_path):
+    """mtime and size, used to spot playlists rewritten on disk"""
+    stat = os.stat(file_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def read_playlist(file_path, encoding):
+    """A playlist's bytes in `encoding`, from its precompressed copy when that is current"""
+    if encoding is not None:
+        contents = read_precompressed(file_path, encoding)
+        if contents is not None:
+            return contents
+    with open(file_path, 'rb') as f:
+        contents = f.read()
+    return contents if encoding is None else compression_cache.compress(contents, encoding)
+
+def load_into_cache(movie, filename, file_path=None):
+    """Read an HLS file into the segment cache, once at a time per file"""
+    key = (movie, filename)
+    with pending_cache_fills_lock:
+        if key in pending_cache_fills:
+            return
+        pending_cache_fills.add(key)
+    try:
+        if file_path is None:
+            file_path = safe_join(HLS_FOLDER, movie, filename)
+        if file_path is None:
+            return
+        validator = file_validator(file_path) if filename.endswith('.m3u8') else None
+        if segment_cache.contains(key, validator) or validator is None and os.path.getsize(file_path) > segment_cache.max_item_bytes:
+            return
+        with open(file_path, 'rb') as f:
+            segment_cache.put(key, f.read(), validator)
+    except OSError:
+        pass
+    finally:
+        with pending_cache_fills_lock:
+            pending_cache_fills.discard(key)
+
+def prefetch_title(movie):
+    """Warm the cache with a title's playlists and its first segments"""
+    playlist = playlist_filename(movie)
+    if playlist is None:
+        return
+    load_into_cache(movie, playlist)
+    if playlist == 'master.m3u8':
+        variants = parse_master_playlist(os.path.join(HLS_FOLDER, movie, playlist))
+    else:
+        variants = [playlist]
+    for variant in variants:
+        load_into_cache(movie, variant)
+        variant_dir = posixpath.dirname(variant)
+        segments = parse_media_playlist(os.path.join(HLS_FOLDER, movie, variant))
+        for segment in segments[:PREFETCH_SEGMENTS]:
+            load_into_cache(movie, posixpath.join(variant_dir, segment['uri']))
+
+def schedule_prefetch(movie):
+    with pending_cache_fills_lock:
+        if movie in pending_prefetches:
+            return
+        pending_prefetches.add(movie)
+
+    def run():
+        try:
+            prefetch_title(movie)
+        finally:
+            with pending_cache_fills_lock:
+                pending_prefetches.discard(movie)
+    background_executor.submit(run)
+
+def prefetch_session_videos():
+    """Prefetch the session's current title and the one that plays after it"""
+    user_videos = session['video_list']
+    if not user_videos:
+        return
+    index = session['current_video_index']
+    schedule_prefetch(user_videos[index])
+    schedule_prefetch(user_videos[(index + 1) % len(user_videos)])
 
 def get_movies():
-    """Get a list of movies in the HLS folder"""
-    return [movie_folder for movie_folder in os.listdir(HLS_FOLDER) 
-            if os.path.isdir(os.path.join(HLS_FOLDER, movie_folder))]
+    """Get a list of movies in the HLS folder, and with JIT_PACKAGING those not converted yet"""
+    return catalog.titles(include_sources=JIT_PACKAGING)
+
+def list_downloads():
+    """Source videos offered on the downloads page, with their sizes"""
+    files = []
+    with os.scandir(VIDEO_FOLDER) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.lower().endswith(('.mp4', '.mkv')):
+                files.append({'name': entry.name, 'size': entry.stat().st_size})
+    return sorted(files, key=lambda file: file['name'])
+
+async def channel_state(method, *args):
+    """Call a shared_state method from a request.
+
+    A shared backend writes to SQLite and may wait up to its busy timeout
+    for another worker's lock, so it runs in a thread rather than holding
+    up every viewer on the event loop.
+    """
+    if shared_state.shared:
+        return await asyncio.to_thread(method, *args)
+    return method(*args)
+
+async def hold_channel():
+    """Renew the session's channel lease, claiming a channel again if it lapsed"""
+    session_id = session.get('session_id')
+    if session_id is None:
+        return False
+    return (await channel_state(shared_state.renew_channel, session_id, CHANNEL_LEASE_SECONDS)
+            or await channel_state(shared_state.acquire_channel, session_id, MAX_CHANNELS, CHANNEL_LEASE_SECONDS) == 0)
+
+def client_id():
+    """Key for bandwidth accounting, the channel session or else the client address"""
+    return session.get('session_id') or request.remote_addr
+
+async def estimated_wait(place):
+    """Seconds until a viewer at this place in the queue gets a channel"""
+    return round(place * await channel_state(shared_state.average_hold) / MAX_CHANNELS)
+
+def reap_channels():
+    """Free the channels of viewers that left without saying so"""
+    while True:
+        time.sleep(CHANNEL_REAP_INTERVAL)
+        try:
+            freed = shared_state.reap_channels(CHANNEL_LEASE_SECONDS)
+            if freed:
+                logging.info(f"Reaped {freed} idle channel(s)")
+        except Exception as e:
+            logging.error(f"Channel reaper failed: {str(e)}")
+
+async def waiting_page(place):
+    eta = await estimated_wait(place)
+    return await render_template('hls/waiting.html', place=place, eta=eta), 503, {'Retry-After': str(max(5, eta))}
 
 @app.route('/')
 async def index():
@@ -88,513 +697,156 @@ async def index():
     session['session_id'] = session_id
     session.permanent = True
 
-    with active_channels_lock:
-        if len(active_channels) >= MAX_CHANNELS and session_id not in active_channels:
-            return render_template_string("<h1>All channels are in use. Please try again later.</h1>"), 503
-        active_channels.add(session_id)
+    place = await channel_state(shared_state.acquire_channel, session_id, MAX_CHANNELS, CHANNEL_LEASE_SECONDS)
+    if place:
+        return await waiting_page(place)
 
+    movies = get_movies()
     if 'video_list' not in session:
-        session['video_list'] = random.sample(get_movies(), len(get_movies()))
+        session['video_list'] = random.sample(movies, len(movies))
     if 'current_video_index' not in session:
         session['current_video_index'] = 0
 
     current_video_name = session['video_list'][session['current_video_index']]
-    playlist_url = url_for('serve_hls', movie=current_video_name, filename='playlist.m3u8')
-
-    return render_template_string('''
-<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Movie Streamer</title>
-    <link rel="icon" href="{{ url_for('static', filename='80654.png') }}" type="image/x-icon">
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css" rel="stylesheet">
-    <style>
-        body {
-            font-family: 'Poppins', sans-serif;
-            background-color: #1a1a1a;
-            color: #ffffff;
-            padding: 20px;
-        }
-        .navbar {
-            background-color: #333;
-            padding: 10px 20px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        .navbar h1 {
-            margin: 0;
-            font-size: 24px;
-            font-weight: 600;
-        }
-        .nav-icons {
-            display: flex;
-            gap: 15px;
-        }
-        .nav-icons a {
-            color: #007bff;
-            text-decoration: none;
-            font-size: 24px;
-            transition: color 0.3s ease;
-        }
-        .nav-icons a:hover {
-            color: #0056b3;
-        }
-        .video-container {
-            max-width: 800px;
-            margin: 0 auto;
-            text-align: center;
-            background-color: #222;
-            padding: 20px; 
-            border-radius: 10px;
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-        .video-player {
-            width: 100%;
-            height: auto;
-            border-radius: 10px;
-            margin-bottom: 20px;
-        }
-        .controls {
-            display: flex;
-            justify-content: center;
-            gap: 10px;
-            margin-top: 20px;
-        }
-        .controls .btn {
-            font-size: 14px;
-            padding: 10px 20px;
-            border-radius: 25px;
-            transition: all 0.3s ease;
-        }
-        .controls .btn-primary {
-            background-color: #007bff;
-            border: none;
-        }
-        .controls .btn-primary:hover {
-            background-color: #0056b3;
-        }
-        .controls .btn-secondary {
-            background-color: #6c757d;
-            border: none;
-        }
-        .controls .btn-secondary:hover {
-            background-color: #5a6268;
-        }
-        .controls .btn-warning {
-            background-color: #ffc107;
-            border: none;
-        }
-        .controls .btn-warning:hover {
-            background-color: #e0a800;
-        }
-        .movie-list {
-            margin-top: 30px;
-        }
-        .movie-item {
-            background-color: #333;
-            padding: 15px;
-            border-radius: 10px;
-            margin-bottom: 10px;
-            cursor: pointer;
-            transition: transform 0.3s ease, box-shadow 0.3s ease;
-        }
-        .movie-item:hover {
-            transform: translateY(-5px);
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-        .movie-item strong {
-            font-size: 18px;
-            font-weight: 600;
-        }
-        .movie-item p {
-            margin: 5px 0 0;
-            font-size: 14px;
-            color: #aaa;
-        }
-        .video-duration {
-            color: #ffc107;
-        }
-    </style>
-</head>
-<body>
-    <div class="navbar">
-        <h1>Movie Streamer</h1>
-        <div class="nav-icons">
-            <a href="{{ url_for('downloads') }}" title="Downloads"><i class="fas fa-download"></i></a>
-        </div>
-    </div>
-    <div class="container">
-        <div class="video-container">
-            <h3>Now Playing: <span id="video-title">{{ current_video_name }}</span></h3>
-            <p>Duration: <span id="video-duration">0</span> seconds</p>
-            <video id="video-player" class="video-player" controls autoplay>
-                <source id="video-source" src="{{ playlist_url }}" type="application/x-mpegURL">
-                Your browser does not support the video tag.
-            </video>
-            <div class="controls">
-                <button class="btn btn-primary" onclick="skipVideo()">Skip Video</button>
-                <button class="btn btn-secondary" onclick="shuffleVideos()">Shuffle Videos</button>
-                <button class="btn btn-warning" onclick="togglePlayPause()">Play/Pause</button>
-            </div>
-        </div>
-        <div class="movie-list">
-            <h3 class="text-center my-3">Available Movies</h3>
-            {% for movie in movies %}
-                <div class="movie-item" onclick="playMovie('{{ movie }}')">
-                    <strong>{{ movie }}</strong>
-                    <p>Duration: <span id="duration-{{ movie }}" class="video-duration">Loading...</span></p>
-                </div>
-            {% endfor %}
-        </div>
-    </div>
-
-    <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
-    <script>
-        const videoPlayer = document.getElementById('video-player');
-        const videoSource = document.getElementById('video-source');
-        const videoTitleElement = document.getElementById('video-title');
-        const videoDurationElement = document.getElementById('video-duration');
-        let hls = null;
-
-        function initializeHls() {
-            if (Hls.isSupported()) {
-                if (hls) hls.destroy();
-                hls = new Hls();
-                hls.loadSource(videoSource.src);
-                hls.attachMedia(videoPlayer);
-                hls.on(Hls.Events.MANIFEST_PARSED, () => videoPlayer.play());
-            } else if (videoPlayer.canPlayType('application/vnd.apple.mpegurl')) {
-                videoPlayer.src = videoSource.src;
-                videoPlayer.addEventListener('loadedmetadata', () => videoPlayer.play());
-            }
-        }
-
-        function playMovie(movie) {
-            fetch(`/set-video/${movie}`)
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function skipVideo() {
-            fetch('/next-video')
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function shuffleVideos() {
-            fetch('/shuffle-videos')
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function togglePlayPause() {
-            if (videoPlayer.paused) {
-                videoPlayer.play();
-            } else {
-                videoPlayer.pause();
-            }
-        }
-
-        window.onload = () => {
-            const firstMovie = document.querySelector('.movie-item');
-            if (firstMovie) {
-                playMovie(firstMovie.textContent.trim());
-            }
-        };
-
-        videoPlayer.onloadedmetadata = function() {
-            videoDurationElement.innerText = Math.round(videoPlayer.duration);
-            document.querySelector(`#duration-${videoTitleElement.innerText}`).innerText = Math.round(videoPlayer.duration);
-        };
-    </script>
-</body>
-</html>
-
-
-
-
-''',
-        movies=get_movies(), current_video_name=current_video_name, playlist_url=playlist_url)
+    prefetch_session_videos()
+
+    # The movie list is fetched separately from /catalog, which is cached
+    return await render_template('hls/index.html',
+        current_video_name=current_video_name, playlist_url=playlist_url(current_video_name),
+        current_duration=movie_metadata(current_video_name)['duration'],
+        heartbeat_seconds=CHANNEL_HEARTBEAT_SECONDS)
+
+@app.route('/catalog')
+async def catalog_list():
+    """The movie list of the player page, rendered and compressed once per catalog generation"""
+    generation = catalog.generation
+    fragment = catalog_fragment.get(generation)
+    if fragment is None:
+        # One request rebuilds it, the others wait for that rather than repeat it
+        async with catalog_fragment_lock:
+            fragment = catalog_fragment.get(generation)
+            if fragment is None:
+                movies = get_movies()
+                # Looking up every title's metadata and compressing at the highest
+                # levels take a while on a big library, so both run in threads
+                durations = await asyncio.to_thread(catalog_durations, movies)
+                html = await render_template('hls/catalog.html', movies=movies, durations=durations)
+                fragment = await asyncio.to_thread(catalog_fragment.put, generation, html)
+    return fragment.respond(request.headers)
+
+def catalog_durations(movies):
+    return {movie: movie_metadata(movie)['duration'] for movie in movies}
 
 @app.route('/downloads')
 async def downloads():
-    files = await asyncio.to_thread(os.listdir, VIDEO_FOLDER)  # Run blocking I/O in thread
-    return render_template_string('''<!DOCTYPE html>
-<html lang="en">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Movie Streamer</title>
-    <link rel="icon" href="{{ url_for('static', filename='80654.png') }}" type="image/x-icon">
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-    <link href="https://fonts.googleapis.com/css2?family=Poppins:wght@400;600&display=swap" rel="stylesheet">
-    <link href="https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0-beta3/css/all.min.css" rel="stylesheet">
-    <style>
-        body {
-            font-family: 'Poppins', sans-serif;
-            background-color: #1a1a1a;
-            color: #ffffff;
-            padding: 20px;
-        }
-        .navbar {
-            background-color: #333;
-            padding: 10px 20px;
-            border-radius: 10px;
-            margin-bottom: 20px;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-        .navbar h1 {
-            margin: 0;
-            font-size: 24px;
-            font-weight: 600;
-        }
-        .nav-icons {
-            display: flex;
-            gap: 15px;
-        }
-        .nav-icons a {
-            color: #007bff;
-            text-decoration: none;
-            font-size: 24px;
-            transition: color 0.3s ease;
-        }
-        .nav-icons a:hover {
-            color: #0056b3;
-        }
-        .video-container {
-            max-width: 800px;
-            margin: 0 auto;
-            text-align: center;
-            background-color: #222;
-            padding: 20px;
-            border-radius: 10px;
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-        .video-player {
-            width: 100%;
-            height: auto;
-            border-radius: 10px;
-            margin-bottom: 20px;
-        }
-        .controls {
-            display: flex;
-            justify-content: center;
-            gap: 10px;
-            margin-top: 20px;
-        }
-        .controls .btn {
-            font-size: 14px;
-            padding: 10px 20px;
-            border-radius: 25px;
-            transition: all 0.3s ease;
-        }
-        .controls .btn-primary {
-            background-color: #007bff;
-            border: none;
-        }
-        .controls .btn-primary:hover {
-            background-color: #0056b3;
-        }
-        .controls .btn-secondary {
-            background-color: #6c757d;
-            border: none;
-        }
-        .controls .btn-secondary:hover {
-            background-color: #5a6268;
-        }
-        .controls .btn-warning {
-            background-color: #ffc107;
-            border: none;
-        }
-        .controls .btn-warning:hover {
-            background-color: #e0a800;
-        }
-        .movie-list {
-            margin-top: 30px;
-        }
-        .movie-item {
-            background-color: #333;
-            padding: 15px;
-            border-radius: 10px;
-            margin-bottom: 10px;
-            cursor: pointer;
-            transition: transform 0.3s ease, box-shadow 0.3s ease;
-        }
-        .movie-item:hover {
-            transform: translateY(-5px);
-            box-shadow: 0 4px 15px rgba(0, 0, 0, 0.3);
-        }
-        .movie-item strong {
-            font-size: 18px;
-            font-weight: 600;
-        }
-        .movie-item p {
-            margin: 5px 0 0;
-            font-size: 14px;
-            color: #aaa;
-        }
-        .video-duration {
-            color: #ffc107;
-        }
-    </style>
-</head>
-<body>
-    <div class="navbar">
-        <h1>Movie Streamer</h1>
-        <div class="nav-icons">
-            <a href="{{ url_for('downloads') }}" title="Downloads"><i class="fas fa-download"></i></a>
-        </div>
-    </div>
-    <div class="container">
-        <div class="video-container">
-            <h3>Now Playing: <span id="video-title">{{ current_video_name }}</span></h3>
-            <p>Duration: <span id="video-duration">0</span> seconds</p>
-            <video id="video-player" class="video-player" controls autoplay>
-                <source id="video-source" src="{{ playlist_url }}" type="application/x-mpegURL">
-                Your browser does not support the video tag.
-            </video>
-            <div class="controls">
-                <button class="btn btn-primary" onclick="skipVideo()">Skip Video</button>
-                <button class="btn btn-secondary" onclick="shuffleVideos()">Shuffle Videos</button>
-                <button class="btn btn-warning" onclick="togglePlayPause()">Play/Pause</button>
-            </div>
-        </div>
-        <div class="movie-list">
-            <h3 class="text-center my-3">Available Movies</h3>
-            {% for movie in movies %}
-                <div class="movie-item" onclick="playMovie('{{ movie }}')">
-                    <strong>{{ movie }}</strong>
-                    <p>Duration: <span id="duration-{{ movie }}" class="video-duration">Loading...</span></p>
-                </div>
-            {% endfor %}
-        </div>
-    </div>
-
-    <script src="https://cdn.jsdelivr.net/npm/hls.js@latest"></script>
-    <script>
-        const videoPlayer = document.getElementById('video-player');
-        const videoSource = document.getElementById('video-source');
-        const videoTitleElement = document.getElementById('video-title');
-        const videoDurationElement = document.getElementById('video-duration');
-        let hls = null;
-
-        function initializeHls() {
-            if (Hls.isSupported()) {
-                if (hls) hls.destroy();
-                hls = new Hls();
-                hls.loadSource(videoSource.src);
-                hls.attachMedia(videoPlayer);
-                hls.on(Hls.Events.MANIFEST_PARSED, () => videoPlayer.play());
-            } else if (videoPlayer.canPlayType('application/vnd.apple.mpegurl')) {
-                videoPlayer.src = videoSource.src;
-                videoPlayer.addEventListener('loadedmetadata', () => videoPlayer.play());
-            }
-        }
-
-        function playMovie(movie) {
-            fetch(`/set-video/${movie}`)
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function skipVideo() {
-            fetch('/next-video')
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function shuffleVideos() {
-            fetch('/shuffle-videos')
-                .then(response => response.json())
-                .then(data => {
-                    videoSource.src = data.next_video_url;
-                    videoPlayer.load();
-                    initializeHls();
-                    videoTitleElement.innerText = data.video_title;
-                });
-        }
-
-        function togglePlayPause() {
-            if (videoPlayer.paused) {
-                videoPlayer.play();
-            } else {
-                videoPlayer.pause();
-            }
-        }
-
-        window.onload = () => {
-            const firstMovie = document.querySelector('.movie-item');
-            if (firstMovie) {
-                playMovie(firstMovie.textContent.trim());
-            }
-        };
-
-        videoPlayer.onloadedmetadata = function() {
-            videoDurationElement.innerText = Math.round(videoPlayer.duration);
-            document.querySelector(`#duration-${videoTitleElement.innerText}`).innerText = Math.round(videoPlayer.duration);
-        };
-    </script>
-</body>
-</html>''', files=files)
+    files = await asyncio.to_thread(list_downloads)  # Run blocking I/O in thread
+    return await render_template('hls/downloads.html', files=files)
 
 @app.route('/download/<filename>')
 async def download_file(filename):
-    """Serve files with asynchronous file reading"""
-    file_path = os.path.join(VIDEO_FOLDER, filename)
-    async with aiofiles.open(file_path, 'rb') as f:
-        contents = await f.read()
-    return await asyncio.to_thread(send_from_directory, VIDEO_FOLDER, filename, as_attachment=True)
+    """Stream a source video as an attachment in constant memory"""
+    file_path = safe_join(VIDEO_FOLDER, filename)
+    if file_path is None or not os.path.isfile(file_path):
+        abort(404)
+    return await stream_file(file_path, as_attachment=True, pace=partial(bandwidth.delay_for, client_id(), DOWNLOAD))
 
 @app.route('/hls/<movie>/<path:filename>')
 async def serve_hls(movie, filename):
-    """Serve HLS files asynchronously"""
-    movie_folder = os.path.join(HLS_FOLDER, movie)
-    file_path = os.path.join(movie_folder, filename)
-    async with aiofiles.open(file_path, 'rb') as f:
-        contents = await f.read()
-    return contents, 200, {'Content-Type': 'application/x-mpegURL' if filename.endswith('.m3u8') else 'video/MP2T'}
+    """Serve HLS files asynchronously, from memory when they are cached"""
+    # Every fetch renews the viewer's channel lease
+    if not await hold_channel():
+        return jsonify({'error': 'All channels are in use'}), 503, {'Retry-After': str(CHANNEL_REAP_INTERVAL)}
+    file_path = safe_join(HLS_FOLDER, movie, filename)
+    if file_path is None:
+        abort(404)
+    return await send_hls_file(movie, filename, file_path)
+
+@app.route('/jit/<movie>/<path:filename>')
+async def serve_jit(movie, filename):
+    """Serve a title that hasn't been converted, cutting each segment when it is first asked for"""
+    if not await hold_channel():
+        return jsonify({'error': 'All channels are in use'}), 503, {'Retry-After': str(CHANNEL_REAP_INTERVAL)}
+    source = catalog.source(movie)
+    if not JIT_PACKAGING or source is None:
+        abort(404)
+    try:
+        if filename == 'playlist.m3u8':
+            file_path = await jit_packager.playlist(movie, source['path'])
+        else:
+            file_path = await jit_packager.segment(movie, source['path'], filename)
+    except (LookupError, FileNotFoundError):
+        abort(404)
+    except (PackagingError, subprocess.CalledProcessError) as e:
+        logging.error(f"Could not package {movie}/{filename}: {str(e)}")
+        return jsonify({'error': 'Could not package this title'}), 500
+    # Cached apart from a conversion published under the same name later
+    return await send_hls_file(movie, f'.jit/{filename}', file_path)
+
+async def send_hls_file(movie, filename, file_path):
+    """Send a playlist or segment, cached under (movie, filename)"""
+    is_playlist = filename.endswith('.m3u8')
+    validator = None
+    encoding = None
+    key = (movie, filename)
+    try:
+        if is_playlist:
+            # Playlists may change on disk, so only trust a cached copy of the same version
+            validator = await asyncio.to_thread(file_validator, file_path)
+            encoding = negotiate(request.headers.get('Accept-Encoding'))
+            if encoding is not None:
+                # Compressed copies are cached next to the plain one, valid for the same version
+                key = (movie, f'{filename}:{encoding}')
+        contents = segment_cache.get(key, validator)
+        if contents is None:
+            if not is_playlist:
+                # Send the segment with sendfile and warm the cache off the request path
+                response = await stream_file(file_path, 'video/MP2T', pace=partial(bandwidth.delay_for, client_id(), PLAYBACK))
+                background_executor.submit(load_into_cache, movie, filename, file_path)
+                return response
+            contents = await asyncio.to_thread(read_playlist, file_path, encoding)
+            segment_cache.put(key, contents, validator)
+    except FileNotFoundError:
+        abort(404)
+    delay = bandwidth.delay_for(client_id(), PLAYBACK, len(contents))
+    if delay:
+        await asyncio.sleep(delay)
+    if not is_playlist:
+        return contents, 200, {'Content-Type': 'video/MP2T'}
+    headers = {'Content-Type': 'application/x-mpegURL', 'Vary': 'Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    return contents, 200, headers
+
+@app.route('/heartbeat', methods=['POST'])
+async def heartbeat():
+    if not await hold_channel():
+        return jsonify({'status': 'waiting'}), 503
+    return jsonify({'status': 'ok'})
+
+@app.route('/leave', methods=['POST'])
+async def leave():
+    session_id = session.get('session_id')
+    if session_id is not None:
+        await channel_state(shared_state.release_channel, session_id)
+    return '', 204
+
+@app.route('/queue-status')
+async def queue_status():
+    """Place in the waiting queue, 0 once the session has been given a channel"""
+    session_id = session.get('session_id')
+    if session_id is None:
+        return jsonify({'error': 'No session'}), 400
+    place = await channel_state(shared_state.acquire_channel, session_id, MAX_CHANNELS, CHANNEL_LEASE_SECONDS)
+    return jsonify({'place': place, 'eta': await estimated_wait(place)})
 
 @app.route('/next-video')
 async def next_video():
     user_videos = session['video_list']
     session['current_video_index'] = (session['current_video_index'] + 1) % len(user_videos)
     next_video_name = user_videos[session['current_video_index']]
-    next_video_url = url_for('serve_hls', movie=next_video_name, filename='playlist.m3u8')
-    metadata = video_metadata.get(next_video_name, {'title': next_video_name, 'duration': 0})
+    next_video_url = playlist_url(next_video_name)
+    metadata = movie_metadata(next_video_name)
+    prefetch_session_videos()
     
     return jsonify({
         'next_video_url': next_video_url,
@@ -604,12 +856,15 @@ async def next_video():
 
 @app.route('/set-video/<video_name>')
 async def set_video(video_name):
+    # A viewer wants this title, so convert it ahead of the backlog
+    transcode_queue.promote(video_name)
     user_videos = session['video_list']
     if video_name in user_videos:
         session['current_video_index'] = user_videos.index(video_name)
     next_video_name = user_videos[session['current_video_index']]
-    next_video_url = url_for('serve_hls', movie=next_video_name, filename='playlist.m3u8')
-    metadata = video_metadata.get(next_video_name, {'title': next_video_name, 'duration': 0})
+    next_video_url = playlist_url(next_video_name)
+    metadata = movie_metadata(next_video_name)
+    prefetch_session_videos()
     
     return jsonify({
         'next_video_url': next_video_url,
@@ -619,11 +874,13 @@ async def set_video(video_name):
 
 @app.route('/shuffle-videos')
 async def shuffle_videos():
-    session['video_list'] = random.sample(get_movies(), len(get_movies()))
+    movies = get_movies()
+    session['video_list'] = random.sample(movies, len(movies))
     session['current_video_index'] = 0
     next_video_name = session['video_list'][session['current_video_index']]
-    next_video_url = url_for('serve_hls', movie=next_video_name, filename='playlist.m3u8')
-    metadata = video_metadata.get(next_video_name, {'title': next_video_name, 'duration': 0})
+    next_video_url = playlist_url(next_video_name)
+    metadata = movie_metadata(next_video_name)
+    prefetch_session_videos()
     
     return jsonify({
         'next_video_url': next_video_url,
@@ -631,52 +888,68 @@ async def shuffle_videos():
         'video_duration': metadata['duration']
     })
 
-async def startup():
-    await process_existing_videos()
+@app.route('/metadata/<movie>')
+async def get_metadata(movie):
+    if movie not in catalog and catalog.source(movie) is None:
+        return jsonify({'error': 'Video not found'}), 404
+    return jsonify(movie_metadata(movie))
+
+@app.route('/cache-stats')
+async def cache_stats():
+    return jsonify(segment_cache.stats())
+
+@app.route('/bandwidth-stats')
+async def bandwidth_stats():
+    return jsonify(bandwidth.stats())
+
+@app.route('/transcode-status')
+async def transcode_status():
+    backlog = transcode_backlog_seconds()
+    return jsonify(dict(transcode_queue.status(), encoding={
+        'next_profile': profile_scheduler.choose(backlog),
+        'backlog_seconds': round(backlog),
+        'required_realtime_factor': round(profile_scheduler.required_rate(backlog), 4),
+        'calibration': (profile_scheduler.calibration or {}).get('profiles'),
+    }))
 
 
 
 
 import asyncio
-from werkzeug.serving import run_simple
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
 import logging
 
 
 async def startup():
     try:
-        # Your startup logic here
         print("Starting video processing...")
-        # Add your actual startup code
-        await asyncio.sleep(1)  # Example async operation
+        catalog.sync()
+        catalog_watcher.start()
+        source_watcher.start()
+        if profile_scheduler.calibration is None and profile_scheduler.fixed is None:
+            threading.Thread(target=calibrate_encoder, daemon=True).start()
+        threading.Thread(target=reap_channels, daemon=True).start()
+        # Only queues the conversions, the workers are started by run_server
+        await process_existing_videos()
     except Exception as e:
         logging.error(f"Startup failed: {str(e)}")
         raise
 
 async def run_server():
-    """Run both startup and flask server"""
+    """Run startup, the transcode workers and the ASGI server on one event loop"""
     try:
         # Run initial video processing
         await startup()
-        
-        # Create a task for Flask server
-        loop = asyncio.get_event_loop()
-        server_task = loop.run_in_executor(
-            None,
-            run_simple,
-            '0.0.0.0',
-            5001,
-            app,
-            False,
-            True
-        )
-        await server_task
+        transcode_queue.start()
+
+        config = Config()
+        config.bind = ['0.0.0.0:5001']
+        await serve(app, config)
     except Exception as e:
         logging.error(f"Server failed: {str(e)}")
         raise
 if __name__ == '__main__':
-    # Run initial video processing
-    asyncio.run(startup())
-    
     logging.basicConfig(level=logging.INFO)
     try:
         asyncio.run(run_server())
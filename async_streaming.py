@@ -0,0 +1,42 @@
+import asyncio
+import mimetypes
+import os
+
+import aiofiles
+import aiofiles.os
+from quart import Response
+
+from file_streaming import CHUNK_SIZE, content_disposition
+
+
+async def file_chunks(path, pace=None, chunk_size=CHUNK_SIZE):
+    """Read a file in fixed-size chunks without blocking the event loop.
+
+    `pace(size)`, if given, returns how many seconds to wait before the
+    next chunk goes out, which is awaited rather than slept.
+    """
+    async with aiofiles.open(path, 'rb') as f:
+        while True:
+            chunk = await f.read(chunk_size)
+            if not chunk:
+                break
+            if pace is not None:
+                delay = pace(len(chunk))
+                if delay:
+                    await asyncio.sleep(delay)
+            yield chunk
+
+
+async def stream_file(path, mimetype=None, as_attachment=False, pace=None):
+    """Stream a whole file from an ASGI app in constant memory.
+
+    Raises FileNotFoundError if the file does not exist.
+    """
+    size = (await aiofiles.os.stat(path)).st_size
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    response = Response(file_chunks(path, pace), mimetype=mimetype)
+    response.headers['Content-Length'] = str(size)
+    if as_attachment:
+        response.headers['Content-Disposition'] = content_disposition(os.path.basename(path))
+    return response
@@ -0,0 +1,474 @@
+"""Load test for the streaming servers.
+
+Builds a synthetic library of ffmpeg test clips, starts one of the
+servers on it and drives it with simulated viewers. HLS viewers fetch
+the playlist and then segments at playback speed, keeping a few seconds
+of buffer. Progressive viewers do the same with byte-range requests
+against /stream-video. Viewers also skip and shuffle titles, and on
+direct_video_good they chat. The report goes to a JSON file so runs can
+be compared across changes.
+
+    python benchmark.py --server hls --viewers 50 --duration 60
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import secrets
+import statistics
+import subprocess
+import sys
+import time
+
+from aiohttp import ClientSession, ClientTimeout, CookieJar
+
+try:
+    import psutil
+except ImportError:  # psutil is optional, /proc is read directly on Linux
+    psutil = None
+
+SERVERS = {
+    'hls': {'script': 'Hls_based.py', 'port': 5001, 'hls': True, 'chat': False},
+    'direct': {'script': 'direct_video_good.py', 'port': 5000, 'hls': False, 'chat': True},
+    'prototype': {'script': 'direct_video_prototype.py', 'port': 5000, 'hls': False, 'chat': False},
+}
+SEGMENT_DURATION = 2
+# Seconds of media a simulated player keeps buffered ahead of the playhead
+BUFFER_TARGET = 6
+# Chance that a viewer skips or shuffles after each segment
+SKIP_PROBABILITY = 0.01
+# Seconds between messages from a chatting viewer
+CHAT_INTERVAL = 10
+
+
+def build_library(workdir, clips, seconds):
+    """Generate test clips in workdir/uploads and their HLS copies in workdir/hls"""
+    uploads = os.path.join(workdir, 'uploads')
+    hls = os.path.join(workdir, 'hls')
+    os.makedirs(uploads, exist_ok=True)
+    names = []
+    for number in range(clips):
+        name = f'clip{number:02d}'
+        names.append(name)
+        source = os.path.join(uploads, name + '.mp4')
+        if not os.path.exists(source):
+            subprocess.run([
+                'ffmpeg', '-v', 'error', '-y',
+                '-f', 'lavfi', '-i', f'testsrc2=size=1280x720:rate=30:duration={seconds}',
+                '-f', 'lavfi', '-i', f'sine=frequency={220 + 20 * number}:duration={seconds}',
+                '-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(30 * SEGMENT_DURATION),
+                '-c:a', 'aac', '-b:a', '128k', '-shortest',
+                source
+            ], check=True)
+        output_dir = os.path.join(hls, name)
+        if not os.path.exists(os.path.join(output_dir, 'playlist.m3u8')):
+            os.makedirs(output_dir, exist_ok=True)
+            subprocess.run([
+                'ffmpeg', '-v', 'error', '-y', '-i', source, '-c', 'copy',
+                '-hls_time', str(SEGMENT_DURATION), '-hls_playlist_type', 'vod',
+                '-hls_segment_filename', os.path.join(output_dir, 'segment%03d.ts'),
+                os.path.join(output_dir, 'playlist.m3u8')
+            ], check=True)
+    return names
+
+
+def start_server(name, workdir):
+    server = SERVERS[name]
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), server['script'])
+    env = dict(os.environ,
+               VIDEO_FOLDER=os.path.join(workdir, 'uploads'),
+               HLS_FOLDER=os.path.join(workdir, 'hls'),
+               MAX_CHANNELS='100000',
+               # direct_video_prototype has no session key of its own
+               SECRET_KEY=secrets.token_hex(16),
+               # A fixed profile skips the encoder calibration, which would
+               # otherwise encode a 1080p clip with every preset mid-run
+               ENCODING_PROFILE='fast-ingest')
+    if server['hls']:
+        cmd = [sys.executable, script]
+    else:
+        # Without the debug reloader, so the measured process is the one serving
+        cmd = [sys.executable, '-c',
+               'import os, runpy, sys; sys.argv = [sys.argv[1]]; '
+               'sys.path.insert(0, os.path.dirname(sys.argv[0])); '
+               'module = runpy.run_path(sys.argv[0], run_name="benchmark"); '
+               f'module["app"].run(host="127.0.0.1", port={server["port"]}, threaded=True)',
+               script]
+    return subprocess.Popen(cmd, cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+class ResourceSampler:
+    """CPU and RSS of the server process, sampled once a second"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.cpu = []
+        self.rss = []
+
+    def _cpu_seconds(self):
+        if psutil is not None:
+            times = psutil.Process(self.pid).cpu_times()
+            return times.user + times.system
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def _rss_bytes(self):
+        if psutil is not None:
+            return psutil.Process(self.pid).memory_info().rss
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    async def run(self):
+        last_time, last_cpu = time.monotonic(), self._cpu_seconds()
+        while True:
+            await asyncio.sleep(1)
+            now, cpu = time.monotonic(), self._cpu_seconds()
+            self.cpu.append(100 * (cpu - last_cpu) / (now - last_time))
+            self.rss.append(self._rss_bytes())
+            last_time, last_cpu = now, cpu
+
+    def summary(self):
+        return {
+            'cpu_percent_mean': round(statistics.mean(self.cpu), 1) if self.cpu else None,
+            'cpu_percent_max': round(max(self.cpu), 1) if self.cpu else None,
+            'rss_mb_max': round(max(self.rss) / 2 ** 20, 1) if self.rss else None,
+        }
+
+
+class Stats:
+    def __init__(self):
+        # Seconds per request, by kind: playlists, HLS segments and progressive byte ranges
+        self.latencies = {'playlist': [], 'segment': [], 'range': []}
+        self.bytes = 0
+        self.errors = {}
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.rejected = 0
+        self.switches = 0
+        self.chat_sent = 0
+        self.chat_received = 0
+        self.chat_latencies = []
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def parse_playlist(text, base_url):
+    """Segment urls and durations of a media playlist, or the first variant of a master"""
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if any(line.startswith('#EXT-X-STREAM-INF') for line in lines):
+        variant = next(line for line in lines if not line.startswith('#'))
+        return None, base_url.rsplit('/', 1)[0] + '/' + variant
+    segments = []
+    duration = None
+    for line in lines:
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',')[0])
+        elif not line.startswith('#') and duration is not None:
+            segments.append((base_url.rsplit('/', 1)[0] + '/' + line, duration))
+            duration = None
+    return segments, None
+
+
+class Player:
+    """One simulated viewer playing titles back to back in real time"""
+
+    def __init__(self, client, base_url, server, clip_seconds, stats, deadline):
+        self.client = client
+        self.base_url = base_url
+        self.server = server
+        self.clip_seconds = clip_seconds
+        self.stats = stats
+        self.deadline = deadline
+
+    async def fetch(self, url, kind, headers=None):
+        """GET a url, recording its latency under `kind`; returns the body or None"""
+        started = time.monotonic()
+        try:
+            async with self.client.get(url, headers=headers) as response:
+                body = await response.read()
+                if response.status >= 400:
+                    self.stats.error(str(response.status))
+                    return None
+        except Exception as e:
+            self.stats.error(type(e).__name__)
+            return None
+        self.stats.latencies[kind].append(time.monotonic() - started)
+        self.stats.bytes += len(body)
+        return body
+
+    async def api(self, path):
+        """GET one of the JSON player endpoints, None if it failed"""
+        route = path.split('?')[0].split('/')[1]
+        try:
+            async with self.client.get(self.base_url + path) as response:
+                if response.status >= 400:
+                    self.stats.error(f'/{route} {response.status}')
+                    return None
+                return await response.json()
+        except Exception as e:
+            self.stats.error(f'/{route} {type(e).__name__}')
+            return None
+
+    async def play(self, title):
+        try:
+            async with self.client.get(self.base_url + '/') as response:
+                await response.read()
+                if response.status == 503:
+                    self.stats.rejected += 1
+                    return
+        except Exception as e:
+            self.stats.error(type(e).__name__)
+            return
+        data = None
+        while time.monotonic() < self.deadline:
+            if data is None:
+                # A failed switch is counted by api(); start over on the first
+                # title rather than leave, so one error doesn't lose the viewer
+                data = await self.api(f'/set-video/{title}')
+                if data is None:
+                    await asyncio.sleep(min(1, max(0, self.deadline - time.monotonic())))
+                    continue
+            url = self.base_url + data['next_video_url']
+            if self.server['hls']:
+                await self.play_hls(url)
+            else:
+                await self.play_progressive(url)
+            # Move on to another title after skipping away or reaching the end
+            if time.monotonic() < self.deadline:
+                data = await self.api(random.choice(['/next-video?skip=true', '/shuffle-videos']))
+                if data is not None:
+                    self.stats.switches += 1
+
+    async def pace(self, buffered, state):
+        """Wait until the buffer drops to BUFFER_TARGET, counting a stall if it ran dry"""
+        now = time.monotonic()
+        if state['start'] is None:
+            state['start'] = now
+        playhead = now - state['start'] - state['stalled']
+        if playhead > state['buffered']:
+            self.stats.stalls += 1
+            self.stats.stall_seconds += playhead - state['buffered']
+            state['stalled'] += playhead - state['buffered']
+            playhead = state['buffered']
+        state['buffered'] += buffered
+        wait = state['buffered'] - BUFFER_TARGET - playhead
+        if wait > 0:
+            await asyncio.sleep(min(wait, max(0, self.deadline - time.monotonic())))
+
+    async def play_hls(self, url):
+        """Play one title; True if the viewer skipped away before the end"""
+        segments = None
+        while segments is None:
+            body = await self.fetch(url, 'playlist')
+            if body is None:
+                return True
+            segments, url = parse_playlist(body.decode(), url)
+        state = {'start': None, 'stalled': 0.0, 'buffered': 0.0}
+        for segment_url, duration in segments:
+            if time.monotonic() >= self.deadline:
+                return False
+            if await self.fetch(segment_url, 'segment') is None:
+                continue
+            await self.pace(duration, state)
+            if random.random() < SKIP_PROBABILITY:
+                return True
+        return False
+
+    async def play_progressive(self, url):
+        try:
+            async with self.client.head(url) as response:
+                size = int(response.headers.get('Content-Length', 0))
+        except Exception as e:
+            self.stats.error(type(e).__name__)
+            return True
+        if not size:
+            self.stats.error('empty')
+            return True
+        chunk = max(1, size * SEGMENT_DURATION // self.clip_seconds)
+        state = {'start': None, 'stalled': 0.0, 'buffered': 0.0}
+        for start in range(0, size, chunk):
+            if time.monotonic() >= self.deadline:
+                return False
+            end = min(size, start + chunk) - 1
+            if await self.fetch(url, 'range', {'Range': f'bytes={start}-{end}'}) is None:
+                continue
+            await self.pace(SEGMENT_DURATION, state)
+            if random.random() < SKIP_PROBABILITY:
+                return True
+        return False
+
+    async def chat(self, name):
+        """Send a message every CHAT_INTERVAL seconds or so.
+
+        Runs in its own client, like a second tab, so the player's requests
+        don't race it for the session cookie that holds the username.
+        """
+        async with ClientSession(cookie_jar=CookieJar(unsafe=True)) as client:
+            async with client.post(self.base_url + '/set-username', json={'username': name}) as response:
+                await response.read()
+            while time.monotonic() < self.deadline:
+                await asyncio.sleep(random.uniform(0.5, 1.5) * CHAT_INTERVAL)
+                try:
+                    async with client.post(self.base_url + '/send-message',
+                                           json={'message': f'{time.time():.6f}'}) as response:
+                        await response.read()
+                        if response.status >= 400:
+                            self.stats.error(f'chat {response.status}')
+                            continue
+                    self.stats.chat_sent += 1
+                except Exception as e:
+                    self.stats.error(type(e).__name__)
+
+    async def listen(self):
+        """Follow the chat stream, measuring how long messages take to arrive"""
+        try:
+            async with self.client.get(self.base_url + '/chat-stream') as response:
+                async for line in response.content:
+                    if not line.startswith(b'data: '):
+                        continue
+                    message = json.loads(line[len(b'data: '):])
+                    self.stats.chat_received += 1
+                    try:
+                        self.stats.chat_latencies.append(time.time() - float(message['message']))
+                    except ValueError:
+                        pass
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.stats.error(type(e).__name__)
+
+
+async def run_viewers(args, server, titles, stats):
+    base_url = f"http://127.0.0.1:{server['port']}"
+    deadline = time.monotonic() + args.duration
+    sessions = []
+    tasks = []
+    for number in range(args.viewers):
+        # Every viewer gets its own cookie jar, so its own server session
+        client = ClientSession(cookie_jar=CookieJar(unsafe=True), timeout=ClientTimeout(total=None, sock_read=30))
+        sessions.append(client)
+        player = Player(client, base_url, server, args.clip_seconds, stats, deadline)
+        tasks.append(asyncio.create_task(player.play(random.choice(titles))))
+        if server['chat']:
+            tasks.append(asyncio.create_task(player.listen()))
+            if number < args.chatters:
+                tasks.append(asyncio.create_task(player.chat(f'viewer{number}')))
+        # Ramp up over the first few seconds rather than all at once
+        await asyncio.sleep(min(0.05, 5 / max(1, args.viewers)))
+    await asyncio.sleep(max(0, deadline - time.monotonic()))
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        # Cancellation at the deadline is expected, anything else ended a viewer early
+        if isinstance(result, Exception):
+            stats.error(f'viewer {type(result).__name__}')
+    for client in sessions:
+        await client.close()
+
+
+async def wait_for_server(process, port, timeout=120):
+    started = time.monotonic()
+    async with ClientSession() as client:
+        while time.monotonic() - started < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f'Server exited with status {process.returncode}')
+            try:
+                async with client.get(f'http://127.0.0.1:{port}/'):
+                    return
+            except OSError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f'Server on port {port} did not come up')
+
+
+async def benchmark(args):
+    server = SERVERS[args.server]
+    workdir = os.path.abspath(args.workdir)
+    titles = build_library(workdir, args.clips, args.clip_seconds)
+    process = start_server(args.server, workdir)
+    try:
+        await wait_for_server(process, server['port'])
+        sampler = ResourceSampler(process.pid)
+        sampler_task = asyncio.create_task(sampler.run())
+        stats = Stats()
+        started = time.monotonic()
+        await run_viewers(args, server, titles if server['hls'] else [t + '.mp4' for t in titles], stats)
+        elapsed = time.monotonic() - started
+        sampler_task.cancel()
+    finally:
+        process.terminate()
+        process.wait()
+
+    latency_ms = {}
+    for kind, latencies in stats.latencies.items():
+        latencies = [latency * 1000 for latency in latencies]
+        if latencies:
+            latency_ms[kind] = {
+                'requests': len(latencies),
+                'p50': percentile(latencies, 0.50),
+                'p95': percentile(latencies, 0.95),
+                'p99': percentile(latencies, 0.99),
+                'max': max(latencies),
+            }
+    chat_latencies = [latency * 1000 for latency in stats.chat_latencies]
+    return {
+        'server': args.server,
+        'viewers': args.viewers,
+        'duration': args.duration,
+        'clips': args.clips,
+        'clip_seconds': args.clip_seconds,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'requests': sum(kind['requests'] for kind in latency_ms.values()),
+        'latency_ms': latency_ms,
+        'stalls': stats.stalls,
+        'stall_seconds': round(stats.stall_seconds, 2),
+        'rejected_viewers': stats.rejected,
+        'switches': stats.switches,
+        'errors': stats.errors,
+        'throughput_mbps': round(stats.bytes * 8 / elapsed / 1e6, 2),
+        'bytes': stats.bytes,
+        'chat': {
+            'sent': stats.chat_sent,
+            'received': stats.chat_received,
+            'latency_ms_p50': percentile(chat_latencies, 0.50),
+            'latency_ms_p95': percentile(chat_latencies, 0.95),
+        } if server['chat'] else None,
+        'server_resources': sampler.summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--server', choices=sorted(SERVERS), default='hls')
+    parser.add_argument('--viewers', type=int, default=20)
+    parser.add_argument('--duration', type=int, default=60, help='seconds of load')
+    parser.add_argument('--clips', type=int, default=5)
+    parser.add_argument('--clip-seconds', type=int, default=60)
+    parser.add_argument('--chatters', type=int, default=5, help='viewers that send chat messages')
+    parser.add_argument('--workdir', default='benchmark_library')
+    parser.add_argument('--output', help='JSON report, default benchmark-<server>-<time>.json')
+    args = parser.parse_args()
+
+    results = asyncio.run(benchmark(args))
+    output = args.output or f"benchmark-{args.server}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+
+class ChatHub:
+    """Hand new chat messages to every client waiting for them.
+
+    Each message gets a monotonic `id`. Clients remember the last id they
+    have seen and block in `wait` until something newer is published, so
+    an idle chat costs nothing however many viewers are connected.
+
+    The newest `size` messages are kept in a ring buffer indexed by id, so
+    reading recent messages never touches the disk and costs the same
+    however long the history is. Published messages are also appended to
+    `log`, if given, in id order, and older pages are read back from it.
+
+    With `follow_interval` the log is shared by several worker processes.
+    It hands out the ids, and a thread polls it for messages published by
+    the other workers.
+    """
+
+    def __init__(self, messages, log=None, size=1000, follow_interval=None):
+        self.log = log
+        self.size = size
+        self.follow_interval = follow_interval
+        self._ring = [None] * size
+        self.last_id = 0
+        self.first_id = 1
+        messages = messages[-size:]
+        if messages:
+            self.first_id = messages[0]['id']
+        for message in messages:
+            self._store(message)
+        self._condition = threading.Condition()
+        if follow_interval is not None:
+            threading.Thread(target=self._follow, daemon=True).start()
+
+    def _store(self, message):
+        self.last_id = message['id']
+        self._ring[self.last_id % self.size] = message
+        self.first_id = max(self.first_id, self.last_id - self.size + 1)
+
+    def publish(self, message):
+        """Give a message the next id and wake up every waiting client"""
+        if self.follow_interval is not None:
+            self.log.append(message)
+            self.poll()
+            return message
+        with self._condition:
+            message['id'] = self.last_id + 1
+            self._store(message)
+            if self.log is not None:
+                self.log.append(message)
+            self._condition.notify_all()
+        return message
+
+    def poll(self):
+        """Take in messages other workers added to the shared log"""
+        while True:
+            messages = self.log.after(self.last_id, self.size)
+            with self._condition:
+                for message in messages:
+                    if message['id'] > self.last_id:
+                        self._store(message)
+                self._condition.notify_all()
+            if len(messages) < self.size:
+                return
+
+    def _follow(self):
+        while True:
+            time.sleep(self.follow_interval)
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Could not poll the shared chat log")
+
+    def _range(self, start, end):
+        """Messages with ids from `start` to `end`, from the ring buffer or the log"""
+        with self._condition:
+            end = min(end, self.last_id)
+            if start >= self.first_id or self.log is None:
+                return [self._ring[i % self.size] for i in range(max(start, self.first_id), end + 1)]
+        # Compaction and retention leave gaps in the log's ids, so a count
+        # alone could reach past `end`
+        return [message for message in self.log.after(start - 1, end - start + 1) if message['id'] <= end]
+
+    def since(self, message_id, limit=None):
+        """Messages newer than `message_id`, oldest first, at most `limit` of them"""
+        end = self.last_id if limit is None else message_id + limit
+        return self._range(message_id + 1, end)
+
+    def before(self, message_id, limit):
+        """Up to `limit` messages older than `message_id`, oldest first"""
+        end = min(message_id, self.last_id + 1) - 1
+        return self._range(max(1, end - limit + 1), end)
+
+    def latest(self, limit):
+        return self.before(self.last_id + 1, limit)
+
+    def wait(self, message_id, timeout, limit=None):
+        """Block until there are messages newer than `message_id` or `timeout` runs out"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.last_id > message_id, timeout)
+        return self.since(message_id, limit)
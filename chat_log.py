@@ -0,0 +1,192 @@
+import json
+import logging
+import os
+import threading
+
+# Bytes read per step when scanning backwards for the last messages
+TAIL_BLOCK = 64 * 1024
+
+
+class ChatLog:
+    """Append-only JSON Lines store for chat messages.
+
+    Each message is one line, so sending a message is a single short write
+    no matter how long the history is. Writes reach the OS immediately but
+    are fsynced in batches every `sync_interval` seconds by a background
+    thread. A crash loses at most that window, and a torn last line is
+    skipped on the next read. Once the file grows past `max_bytes` it is
+    compacted down to the newest `retain` messages.
+    """
+
+    def __init__(self, path, sync_interval=1.0, max_bytes=64 * 1024 * 1024, retain=100000):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.max_bytes = max_bytes
+        self.retain = retain
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._file = self._open()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sync_loop, daemon=True)
+        self._thread.start()
+
+    def _open(self):
+        f = open(self.path, 'a+b')
+        size = f.tell()
+        if size > 0:
+            f.seek(max(0, size - TAIL_BLOCK))
+            block = f.read()
+            if not block.endswith(b'\n'):
+                # Drop a line the last run didn't finish writing
+                newline = block.rfind(b'\n')
+                if newline >= 0 or size <= TAIL_BLOCK:
+                    f.truncate(size - len(block) + newline + 1)
+                else:
+                    f.write(b'\n')
+        return f
+
+    def append(self, message):
+        line = json.dumps(message, separators=(',', ':')).encode() + b'\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self._dirty = True
+
+    def sync(self):
+        """fsync everything appended so far"""
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def _sync_loop(self):
+        while not self._stop.wait(self.sync_interval):
+            try:
+                self.sync()
+                if os.path.getsize(self.path) > self.max_bytes:
+                    self.compact()
+            except OSError:
+                logging.exception(f"Could not sync {self.path}")
+
+    def tail(self, count):
+        """The newest `count` messages, oldest first, read from the end of the file"""
+        with open(self.path, 'rb') as f:
+            return self._read_back(f, f.seek(0, os.SEEK_END), count)
+
+    def before(self, message_id, count):
+        """Up to `count` messages with ids below `message_id`, oldest first"""
+        with open(self.path, 'rb') as f:
+            return self._read_back(f, self._offset_of(f, message_id), count)
+
+    def after(self, message_id, count):
+        """Up to `count` messages with ids above `message_id`, oldest first"""
+        messages = []
+        with open(self.path, 'rb') as f:
+            f.seek(self._offset_of(f, message_id + 1))
+            while len(messages) < count:
+                line = f.readline()
+                if not line.endswith(b'\n'):
+                    break
+                message = self._parse(line)
+                if message is not None:
+                    messages.append(message)
+        return messages
+
+    def _parse(self, line):
+        if not line.strip():
+            return None
+        try:
+            return json.loads(line)
+        except ValueError:
+            logging.warning(f"Skipping damaged line in {self.path}")
+            return None
+
+    def _offset_of(self, f, message_id):
+        """Byte offset of the first line whose id is at least `message_id`.
+
+        Ids only grow through the file, so this is a binary search over byte
+        offsets down to one block, followed by a short scan.
+        """
+        low, high = 0, f.seek(0, os.SEEK_END)
+        while high - low > TAIL_BLOCK:
+            middle = (low + high) // 2
+            f.seek(middle)
+            f.readline()
+            message = self._parse(f.readline())
+            if message is not None and message.get('id', 0) < message_id:
+                low = middle
+            else:
+                high = middle
+        f.seek(low)
+        if low > 0:
+            f.readline()
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                return offset
+            message = self._parse(line)
+            if message is not None and message.get('id', 0) >= message_id:
+                return offset
+
+    def _read_back(self, f, end, count):
+        """Up to `count` whole messages ending at byte offset `end`"""
+        if count <= 0:
+            return []
+        position = end
+        blocks = []
+        newlines = 0
+        while position > 0 and newlines <= count:
+            step = min(TAIL_BLOCK, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step)
+            blocks.append(block)
+            newlines += block.count(b'\n')
+        lines = b''.join(reversed(blocks)).split(b'\n')
+        if position > 0:
+            # The first line was only read in part
+            lines = lines[1:]
+        messages = []
+        for line in lines[-(count + 1):]:
+            message = self._parse(line)
+            if message is not None:
+                messages.append(message)
+        return messages[-count:]
+
+    def compact(self):
+        """Rewrite the log with only the newest `retain` messages"""
+        with self._lock:
+            self._file.flush()
+            messages = self.tail(self.retain)
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for message in messages:
+                    f.write(json.dumps(message, separators=(',', ':')).encode() + b'\n')
+                f.flush()
+                os.fsync(f.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._file = self._open()
+            self._dirty = False
+
+    def migrate(self, legacy_path):
+        """Import a chat file from the old whole-list JSON format, once"""
+        if not os.path.exists(legacy_path) or os.path.getsize(self.path) > 0:
+            return
+        try:
+            with open(legacy_path, 'r') as f:
+                messages = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            logging.exception(f"Could not migrate {legacy_path}")
+            return
+        for number, message in enumerate(messages, 1):
+            message.setdefault('id', number)
+            self.append(message)
+        self.sync()
+        os.replace(legacy_path, legacy_path + '.migrated')
+
+    def close(self):
+        self._stop.set()
+        self.sync()
+        self._file.close()
@@ -0,0 +1,129 @@
+import asyncio
+import bisect
+import json
+import logging
+import os
+import shutil
+
+from hls_playlist import parse_media_playlist
+from media_probe import keyframe_times
+
+# Chunks shorter than this fraction of the target are merged into the one before
+MIN_CHUNK_FRACTION = 0.5
+
+
+def plan_chunks(keyframes, duration, target):
+    """Chunk start times roughly `target` seconds apart, each on a source keyframe.
+
+    A chunk starts on the last keyframe before its target time, so the
+    encoder seeks straight to it without decoding anything it throws away.
+    Without keyframes to go by, chunks start exactly at the target times.
+    """
+    starts = [0.0]
+    count = max(1, round(duration / target))
+    for number in range(1, count):
+        wanted = number * duration / count
+        if not keyframes:
+            starts.append(wanted)
+            continue
+        position = bisect.bisect_right(keyframes, wanted) - 1
+        if position >= 0 and keyframes[position] >= starts[-1] + target * MIN_CHUNK_FRACTION:
+            starts.append(keyframes[position])
+    return starts
+
+
+class ChunkedTranscoder:
+    """Encode one long source as several chunks at once and stitch the results.
+
+    The source is cut at keyframes into chunks that are encoded by separate
+    ffmpeg processes. Every encode holds one of `slots`, a semaphore shared
+    with the server's other transcodes, so chunking spreads one title over
+    the idle workers instead of adding encoders on top of them. Each chunk keeps its timestamps, so the segments line up into
+    one continuous playlist. A chunk that finished before an interruption
+    is not encoded again.
+    """
+
+    def __init__(self, slots, chunk_seconds, segment_duration):
+        self.slots = slots
+        self.chunk_seconds = chunk_seconds
+        self.segment_duration = segment_duration
+
+    def _plan(self, input_path, staging_dir, duration):
+        """The chunk start times saved in the staging directory, or a new plan"""
+        plan_path = os.path.join(staging_dir, 'chunks.json')
+        try:
+            with open(plan_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        starts = plan_chunks(keyframe_times(input_path), duration, self.chunk_seconds)
+        with open(plan_path + '.tmp', 'w') as f:
+            json.dump(starts, f)
+        os.replace(plan_path + '.tmp', plan_path)
+        return starts
+
+    async def _encode(self, input_path, chunk_dir, start, end, encoder_args):
+        playlist_path = os.path.join(chunk_dir, 'playlist.m3u8')
+        segments = parse_media_playlist(playlist_path)
+        if segments and all(os.path.exists(os.path.join(chunk_dir, segment['uri'])) for segment in segments):
+            return True
+        await asyncio.to_thread(shutil.rmtree, chunk_dir, ignore_errors=True)
+        os.makedirs(chunk_dir)
+        cmd = ['ffmpeg', '-v', 'error', '-y']
+        if start:
+            cmd += ['-ss', f'{start:.3f}']
+        cmd += ['-i', input_path]
+        if end is not None:
+            cmd += ['-t', f'{end - start:.3f}']
+        cmd += encoder_args + [
+            '-output_ts_offset', f'{start:.3f}',
+            '-hls_time', str(self.segment_duration),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(chunk_dir, 'segment%03d.ts'),
+            '-f', 'hls',
+            os.path.join(chunk_dir, 'progress.m3u8'),
+        ]
+        async with self.slots:
+            process = await asyncio.create_subprocess_exec(*cmd, stderr=asyncio.subprocess.PIPE)
+            _, stderr = await process.communicate()
+        if process.returncode != 0:
+            logging.error(f"Chunk at {start:.1f}s of {input_path} failed: {stderr.decode(errors='replace').strip()}")
+            return False
+        # Only a finished chunk has a playlist.m3u8
+        os.replace(os.path.join(chunk_dir, 'progress.m3u8'), playlist_path)
+        return True
+
+    async def transcode(self, input_path, staging_dir, duration, encoder_args):
+        """Encode `input_path` into staging_dir/segmentNNN.ts.
+
+        Returns the segments for the playlist, or None if a chunk failed.
+        The first segment of every chunk after the first is marked as a
+        discontinuity: the chunks are separate encodes, and their audio
+        priming and MPEG-TS continuity counters don't carry over.
+        """
+        starts = await asyncio.to_thread(self._plan, input_path, staging_dir, duration)
+        ends = starts[1:] + [None]
+        chunk_dirs = [os.path.join(staging_dir, f'chunk{number:03d}') for number in range(len(starts))]
+        results = await asyncio.gather(*[
+            self._encode(input_path, chunk_dir, start, end, encoder_args)
+            for chunk_dir, start, end in zip(chunk_dirs, starts, ends)
+        ])
+        if not all(results):
+            return None
+        # Moving the segments and deleting the chunks is disk work, off the event loop
+        segments = await asyncio.to_thread(self._stitch, staging_dir, chunk_dirs)
+        logging.info(f"Encoded {input_path} in {len(starts)} chunks, {len(segments)} segments")
+        return segments
+
+    def _stitch(self, staging_dir, chunk_dirs):
+        segments = []
+        for number, chunk_dir in enumerate(chunk_dirs):
+            for index, segment in enumerate(parse_media_playlist(os.path.join(chunk_dir, 'playlist.m3u8'))):
+                uri = f'segment{len(segments):03d}.ts'
+                os.replace(os.path.join(chunk_dir, segment['uri']), os.path.join(staging_dir, uri))
+                segments.append({'uri': uri, 'duration': segment['duration'],
+                                 'discontinuity': number > 0 and index == 0})
+        for chunk_dir in chunk_dirs:
+            shutil.rmtree(chunk_dir, ignore_errors=True)
+        os.remove(os.path.join(staging_dir, 'chunks.json'))
+        return segments
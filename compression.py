@@ -0,0 +1,179 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # Optional, gzip is used when brotli isn't installed
+    brotli = None
+
+# Content codings we can produce, best first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# File name suffix of a precompressed copy
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+# Levels for bodies compressed per request, files written ahead of time get the maximum
+DYNAMIC_LEVELS = {'br': 5, 'gzip': 6}
+# Bodies smaller than this gain less than the Content-Encoding header costs
+MIN_COMPRESS_BYTES = 512
+# Media types worth compressing. Video and audio are compressed already.
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript',
+                      'application/x-mpegurl', 'application/vnd.apple.mpegurl', 'image/svg+xml')
+# Paths never compressed whatever their Content-Type says
+SKIP_EXTENSIONS = ('.ts', '.mp4', '.mkv', '.m4s', '.gz', '.br')
+COMPRESSION_CACHE_BYTES = int(os.getenv('COMPRESSION_CACHE_BYTES', 32 * 1024 * 1024))
+
+
+def negotiate(accept_encoding, available=ENCODINGS):
+    """Pick the best of `available` codings allowed by an Accept-Encoding header.
+
+    Returns None when the body should be sent as it is.
+    """
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        weights[coding.strip().lower()] = quality
+    best, best_quality = None, 0.0
+    for coding in available:
+        quality = weights.get(coding, weights.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(body, encoding, level=None):
+    """Compress `body`, at the highest level unless one is given"""
+    if encoding == 'br':
+        return brotli.compress(body, quality=11 if level is None else level)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=9 if level is None else level, mtime=0)
+    raise ValueError(f"Unsupported content coding: {encoding}")
+
+
+def precompress(path):
+    """Write a compressed copy of a file next to it for every coding we produce.
+
+    Servers send `playlist.m3u8.gz` instead of compressing `playlist.m3u8`
+    on each request, as long as the copy is not older than the file.
+    """
+    with open(path, 'rb') as f:
+        body = f.read()
+    for encoding in ENCODINGS:
+        target = path + SUFFIXES[encoding]
+        with open(target + '.tmp', 'wb') as f:
+            f.write(compress(body, encoding))
+        os.replace(target + '.tmp', target)
+
+
+def read_precompressed(path, encoding):
+    """The precompressed copy of a file, None if it is missing or older than the file"""
+    try:
+        with open(path + SUFFIXES[encoding], 'rb') as f:
+            if os.fstat(f.fileno()).st_mtime_ns < os.stat(path).st_mtime_ns:
+                return None
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class CompressionCache:
+    """Compressed bodies keyed by a hash of their content, least recently used evicted first.
+
+    Playlists, pages and JSON answers are often byte-for-byte the same for
+    many requests, so hashing the body, which is much cheaper than
+    compressing it, lets them be compressed once.
+    """
+
+    def __init__(self, max_bytes=COMPRESSION_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def compress(self, body, encoding):
+        key = (hashlib.blake2b(body, digest_size=16).digest(), encoding)
+        with self._lock:
+            compressed = self._items.get(key)
+            if compressed is not None:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        compressed = compress(body, encoding, DYNAMIC_LEVELS[encoding])
+        if len(compressed) > self.max_bytes // 8:
+            return compressed
+        with self._lock:
+            if key not in self._items:
+                self._items[key] = compressed
+                self.size += len(compressed)
+                while self.size > self.max_bytes:
+                    _, evicted = self._items.popitem(last=False)
+                    self.size -= len(evicted)
+        return compressed
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+def compress_responses(app, cache=None):
+    """Compress the buffered text responses of a Flask or Quart app.
+
+    Streamed bodies (files, segments, event streams), partial content and
+    responses that already carry a Content-Encoding are left alone.
+    Returns the CompressionCache in use.
+    """
+    is_quart = type(app).__module__.split('.')[0] == 'quart'
+    if is_quart:
+        from quart import request
+        from quart.wrappers.response import DataBody
+    else:
+        from flask import request
+    cache = cache if cache is not None else CompressionCache()
+
+    def compressible(response):
+        if response.status_code != 200 or 'Content-Encoding' in response.headers:
+            return False
+        if not (response.mimetype or '').lower().startswith(COMPRESSIBLE_TYPES):
+            return False
+        return not request.path.lower().endswith(SKIP_EXTENSIONS)
+
+    def encode(response, body):
+        response.vary.add('Accept-Encoding')
+        if len(body) < MIN_COMPRESS_BYTES:
+            return response
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None:
+            return response
+        response.set_data(cache.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{encoding}', weak)
+        return response
+
+    if is_quart:
+        async def compress_response(response):
+            if not compressible(response) or not isinstance(response.response, DataBody):
+                return response
+            return encode(response, await response.get_data())
+    else:
+        def compress_response(response):
+            if not compressible(response) or response.is_streamed or response.direct_passthrough:
+                return response
+            return encode(response, response.get_data())
+
+    app.after_request(compress_response)
+    return cache
@@ -1,692 +1,145 @@
-from flask import Flask, send_file, jsonify, render_template_string, request, session, url_for
+from flask import Flask, Response, jsonify, render_template, request, session, url_for
 import os
 import random
+import secrets
 from datetime import datetime
 import json
+from chat_hub import ChatHub
+from chat_log import ChatLog
+from file_streaming import send_media
+from media_probe import MetadataStore
+from fs_watcher import UploadWatcher
+from shared_state import open_state
+from rate_limit import BandwidthShaper, PLAYBACK
+from metrics import Registry, instrument
+from static_assets import FragmentCache, fingerprint_static
+from compression import compress_responses
 
 app = Flask(__name__)
 app.secret_key = os.getenv('SECRET_KEY', 'your_secret_key_here')  # Use environment variable for secret key
+fingerprint_static(app)  # Pages are templates/direct/*.html, CSS and JS are in static/
+compress_responses(app)  # gzip or brotli for pages and JSON, never for the videos
 
 # Configuration
 VIDEO_FOLDER = os.getenv('VIDEO_FOLDER', 'uploads')  # Path to your video folder
-CHAT_FILE = os.getenv('CHAT_FILE', 'chat_messages.json')  # File to store chat messages
+CHAT_FILE = os.getenv('CHAT_FILE', 'chat_messages.json')  # Old whole-list chat file, migrated on startup
+CHAT_LOG = os.getenv('CHAT_LOG', 'chat_messages.jsonl')  # Append-only chat log
+CHAT_HISTORY = 1000  # Recent messages kept in memory, older ones are read from the log
+CHAT_PAGE_SIZE = 50  # Default and largest number of messages per /get-messages page
+METADATA_DB = os.getenv('METADATA_DB', 'video_metadata.sqlite3')  # Cached ffprobe results
+# 'memory' for a single process, or e.g. 'sqlite:///chat_state.sqlite3' so several
+# gunicorn workers share one chat
+SHARED_STATE = os.getenv('SHARED_STATE', 'memory')
+# Per-viewer and total streaming limits in megabits per second, 0 for no limit
+PLAYBACK_MBPS = float(os.getenv('PLAYBACK_MBPS', 0))
+LINK_MBPS = float(os.getenv('LINK_MBPS', 0))
+CHAT_FOLLOW_INTERVAL = 0.5  # Seconds between checks for other workers' messages
+CHAT_KEEPALIVE = 15  # Seconds between keep-alive comments on an idle chat stream
+CHAT_LONG_POLL_TIMEOUT = 30  # Longest a /get-messages long-poll may wait
+UPLOAD_SETTLE_SECONDS = float(os.getenv('UPLOAD_SETTLE_SECONDS', 5))  # New files are listed once they stop growing
+LIBRARY_REFRESH_SECONDS = 30  # How often open pages check the video list for changes
 
 # Ensure required directories and files exist
 if not os.path.exists(VIDEO_FOLDER):
     os.makedirs(VIDEO_FOLDER)
 
-if not os.path.exists(CHAT_FILE):
-    with open(CHAT_FILE, 'w') as f:
-        json.dump([], f)
-
 # Load video metadata
 videos = [video for video in os.listdir(VIDEO_FOLDER) if video.endswith(('.mp4', '.mkv'))]
 video_metadata = {}
-for video in videos:
+metadata_store = MetadataStore(METADATA_DB)
+
+# Bumped whenever the video list or a duration changes
+library_version = 0
+video_list_fragment = FragmentCache()
+
+def library_changed():
+    global library_version
+    library_version += 1
+
+def update_video_metadata(path, metadata):
+    entry = video_metadata.get(os.path.basename(path))
+    if entry is None:
+        # Deleted while it was being probed
+        return
+    entry.update(metadata, duration=round(metadata['duration']))
+    library_changed()
+
+def add_video(video):
     video_metadata[video] = {
         'title': video.split('.')[0],
-        'duration': 0  # Duration will be handled by frontend
+        'duration': 0  # Filled in by ffprobe in the background
     }
+    metadata_store.submit(os.path.join(VIDEO_FOLDER, video), update_video_metadata)
 
-# Load chat messages
-def load_chat_messages():
-    try:
-        with open(CHAT_FILE, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError):
-        return []
-
-def save_chat_messages(messages):
-    with open(CHAT_FILE, 'w') as f:
-        json.dump(messages, f, indent=2)
+for video in videos:
+    add_video(video)
+
+def video_uploaded(video):
+    """A file finished arriving in VIDEO_FOLDER, new or replacing one with the same name"""
+    if video not in videos:
+        videos.append(video)
+    add_video(video)
+    library_changed()
+
+def video_removed(video):
+    if video in videos:
+        videos.remove(video)
+        video_metadata.pop(video, None)
+        library_changed()
+
+# Keeps `videos` in step with the folder without rescanning it
+upload_watcher = UploadWatcher(VIDEO_FOLDER, video_uploaded, video_removed, settle=UPLOAD_SETTLE_SECONDS,
+                               extensions=('.mp4', '.mkv'))
+upload_watcher.start()
+
+bandwidth = BandwidthShaper(LINK_MBPS * 125000, PLAYBACK_MBPS * 125000)
+
+# Prometheus metrics, served on /metrics
+registry = Registry()
+instrument(app, registry)
+chat_published = registry.counter('chat_messages_total', 'Chat messages sent')
+chat_delivered = registry.counter('chat_deliveries_total', 'Chat messages handed to clients (fan-out)')
+chat_streams = registry.gauge('chat_stream_clients', 'Open /chat-stream connections')
 
-chat_messages = load_chat_messages()
+# Load chat messages
+shared_state = open_state(SHARED_STATE)
+if shared_state.shared:
+    chat_log = shared_state.chat_log()
+    chat_hub = ChatHub(chat_log.tail(CHAT_HISTORY), chat_log, CHAT_HISTORY, CHAT_FOLLOW_INTERVAL)
+else:
+    chat_log = ChatLog(CHAT_LOG)
+    chat_log.migrate(CHAT_FILE)
+    chat_hub = ChatHub(chat_log.tail(CHAT_HISTORY), chat_log, CHAT_HISTORY)
+
+def current_video():
+    """Name of the session's video, or None while the library is empty.
+
+    Uploads and deletions change `videos` under the index kept in the
+    session, so it is wrapped back into the list first.
+    """
+    playlist = list(videos)
+    index = session.get('current_video_index', 0)
+    session['current_video_index'] = index % len(playlist) if playlist else 0
+    return playlist[session['current_video_index']] if playlist else None
+
+def no_videos():
+    return jsonify({'error': 'No videos available'}), 404
 
 @app.route('/')
 def index():
-    if 'current_video_index' not in session:
-        session['current_video_index'] = 0
-    
-    username_set = 'username' in session
-    return render_template_string('''
-<!DOCTYPE html>
-<html lang="en" data-theme="light">
-<head>
-    <meta charset="UTF-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>Miu Alpha Streamer</title>
-    <link href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-    <style>
-        :root {
-            --primary: #6366f1;
-            --primary-hover: #4f46e5;
-            --background: #ffffff;
-            --text: #1e293b;
-            --card-bg: rgba(255, 255, 255, 0.9);
-            --border: rgba(0, 0, 0, 0.1);
-            --shadow: 0 8px 32px rgba(0, 0, 0, 0.1);
-        }
-
-        [data-theme="dark"] {
-            --background: #0f172a;
-            --text: #f8fafc;
-            --card-bg: rgba(15, 23, 42, 0.9);
-            --border: rgba(255, 255, 255, 0.1);
-            --shadow: 0 8px 32px rgba(0, 0, 0, 0.3);
-        }
-
-        body {
-            font-family: 'Inter', system-ui, -apple-system, sans-serif;
-            background: var(--background);
-            color: var(--text);
-            transition: all 0.3s ease;
-            min-height: 100vh;
-            margin: 0;
-            overflow-x: hidden;
-        }
-
-        .container {
-            max-width: 1200px;
-            margin: 0 auto;
-            padding: 2rem;
-            transition: transform 0.3s ease;
-        }
-
-        .container.shifted {
-            transform: translateX(-400px);
-        }
-
-        .theme-toggle {
-            position: fixed;
-            top: 1.5rem;
-            right: 1.5rem;
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            padding: 0.75rem;
-            border-radius: 50%;
-            backdrop-filter: blur(10px);
-            cursor: pointer;
-            z-index: 1000;
-            box-shadow: var(--shadow);
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            transition: transform 0.3s ease;
-        }
-
-        .theme-toggle.shifted {
-            transform: translateX(-400px);
-        }
-
-        .header {
-            text-align: center;
-            margin-bottom: 2rem;
-            position: relative;
-        }
-
-        .header h1 {
-            font-size: 2.5rem;
-            font-weight: 700;
-            color: var(--primary);
-            margin-bottom: 0.5rem;
-        }
-
-        .video-container {
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            border-radius: 1.5rem;
-            padding: 2rem;
-            margin: 2rem 0;
-            backdrop-filter: blur(10px);
-            box-shadow: var(--shadow);
-        }
-
-        #video-player {
-            width: 100%;
-            border-radius: 1rem;
-            aspect-ratio: 16/9;
-            background: #000;
-            margin-bottom: 1.5rem;
-        }
-
-        .video-info {
-            text-align: center;
-            margin-bottom: 1.5rem;
-        }
-
-        .video-info h3 {
-            font-size: 1.5rem;
-            margin-bottom: 0.5rem;
-        }
-
-        .controls {
-            display: flex;
-            gap: 1rem;
-            justify-content: center;
-            margin: 2rem 0;
-            flex-wrap: wrap;
-        }
-
-        .btn {
-            padding: 0.75rem 1.5rem;
-            border: none;
-            border-radius: 0.75rem;
-            font-weight: 600;
-            transition: all 0.2s ease;
-            display: inline-flex;
-            align-items: center;
-            gap: 0.5rem;
-        }
-
-        .btn-primary {
-            background: var(--primary);
-            color: white;
-        }
-
-        .btn-primary:hover {
-            background: var(--primary-hover);
-            transform: translateY(-1px);
-        }
-
-        .btn-secondary {
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            color: var(--text);
-        }
-
-        .btn-secondary:hover {
-            background: var(--border);
-            transform: translateY(-1px);
-        }
-
-        .video-list {
-            display: grid;
-            gap: 1rem;
-            margin-top: 2rem;
-        }
-
-        .video-item {
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            border-radius: 1rem;
-            padding: 1.5rem;
-            transition: transform 0.2s ease;
-            display: flex;
-            justify-content: space-between;
-            align-items: center;
-        }
-
-        .video-item:hover {
-            transform: translateY(-2px);
-        }
-
-        .video-content {
-            flex-grow: 1;
-        }
-
-        .video-item strong {
-            font-size: 1.1rem;
-            display: block;
-            margin-bottom: 0.5rem;
-        }
-
-        .chat-sidebar {
-            position: fixed;
-            top: 0;
-            right: -400px;
-            width: 400px;
-            height: 100vh;
-            background: var(--card-bg);
-            border-left: 1px solid var(--border);
-            backdrop-filter: blur(10px);
-            box-shadow: var(--shadow);
-            transition: right 0.3s ease;
-            z-index: 999;
-        }
-
-        .chat-sidebar.open {
-            right: 0;
-        }
-
-        .chat-header {
-            padding: 1rem;
-            border-bottom: 1px solid var(--border);
-            text-align: center;
-        }
-
-        .chat-messages {
-            height: calc(100vh - 150px);
-            overflow-y: auto;
-            padding: 1rem;
-        }
-
-        .chat-message {
-            margin-bottom: 1rem;
-            padding: 0.75rem;
-            border-radius: 0.75rem;
-            background: var(--background);
-            border: 1px solid var(--border);
-        }
-
-        .chat-message strong {
-            color: var(--primary);
-        }
-
-        .chat-message small {
-            color: var(--text);
-            opacity: 0.7;
-        }
-
-        .chat-input {
-            display: flex;
-            gap: 1rem;
-            padding: 1rem;
-            border-top: 1px solid var(--border);
-        }
-
-        .chat-input input {
-            flex-grow: 1;
-            padding: 0.75rem;
-            border: 1px solid var(--border);
-            border-radius: 0.75rem;
-            background: var(--background);
-            color: var(--text);
-        }
-
-        .chat-input button {
-            padding: 0.75rem 1.5rem;
-            border: none;
-            border-radius: 0.75rem;
-            background: var(--primary);
-            color: white;
-            cursor: pointer;
-        }
-
-        .chat-input button:hover {
-            background: var(--primary-hover);
-        }
-
-        .chat-hover-box {
-            position: fixed;
-            bottom: 20px;
-            right: 20px;
-            width: 50px;
-            height: 50px;
-            background: rgba(0, 0, 0, 0.7);
-            border-radius: 50%;
-            display: flex;
-            align-items: center;
-            justify-content: center;
-            cursor: pointer;
-            z-index: 1000;
-            transition: background 0.3s ease, transform 0.3s ease;
-        }
-
-        .chat-hover-box.shifted {
-            transform: translateX(-400px);
-        }
-
-        .chat-hover-box:hover {
-            background: rgba(0, 0, 0, 0.9);
-        }
-
-        .chat-hover-box span {
-            font-size: 24px;
-            color: white;
-        }
-
-        .login-container {
-            max-width: 400px;
-            margin: 0 auto;
-            padding: 2rem;
-            background: var(--card-bg);
-            border: 1px solid var(--border);
-            border-radius: 1.5rem;
-            backdrop-filter: blur(10px);
-            box-shadow: var(--shadow);
-            margin-top: 10%;
-        }
-
-        .login-container h2 {
-            text-align: center;
-            margin-bottom: 1.5rem;
-        }
-
-        .login-container input {
-            width: 100%;
-            padding: 0.75rem;
-            border: 1px solid var(--border);
-            border-radius: 0.75rem;
-            background: var(--background);
-            color: var(--text);
-            margin-bottom: 1rem;
-        }
-
-        .login-container button {
-            width: 100%;
-            padding: 0.75rem;
-            border: none;
-            border-radius: 0.75rem;
-            background: var(--primary);
-            color: white;
-            cursor: pointer;
-        }
-
-        .login-container button:hover {
-            background: var(--primary-hover);
-        }
-
-        @media (max-width: 768px) {
-            .container {
-                padding: 1rem;
-            }
-            
-            .video-container {
-                padding: 1.5rem;
-                margin: 1rem 0;
-            }
-            
-            .btn {
-                width: 100%;
-                justify-content: center;
-            }
-            
-            .video-item {
-                flex-direction: column;
-                align-items: flex-start;
-                gap: 1rem;
-            }
-
-            .chat-sidebar {
-                width: 100%;
-                right: -100%;
-            }
-
-            .chat-sidebar.open {
-                right: 0;
-            }
-        }
-
-        .username-prompt {
-            padding: 2rem;
-            display: flex;
-            flex-direction: column;
-            gap: 1rem;
-        }
-
-        .username-prompt input {
-            padding: 0.75rem;
-            border: 1px solid var(--border);
-            border-radius: 0.75rem;
-            background: var(--background);
-            color: var(--text);
-        }
-
-        .username-prompt button {
-            padding: 0.75rem;
-            border: none;
-            border-radius: 0.75rem;
-            background: var(--primary);
-            color: white;
-            cursor: pointer;
-        }
-
-        .username-prompt button:hover {
-            background: var(--primary-hover);
-        }
-
-        #username-feedback {
-            margin-left: 0.5rem;
-            color: green;
-        }
-    </style>
-</head>
-<body>
-    <button class="theme-toggle" id="theme-toggle">
-        <span id="theme-icon">🌙</span>
-    </button>
-
-    <div class="chat-hover-box" id="chat-hover-box">
-        <span>💬</span>
-    </div>
-
-    <div class="chat-sidebar" id="chat-sidebar">
-        <div class="chat-header">
-            <h3>Chat</h3>
-        </div>
-        <div id="username-prompt-section" style="{{ 'display: none;' if username_set else '' }}">
-            <div class="username-prompt">
-                <input type="text" id="username-input" placeholder="Enter your username">
-                <button onclick="setUsername()">Register</button>
-                <span id="username-feedback"></span>
-            </div>
-        </div>
-        <div class="chat-messages" id="chat-messages" style="{{ 'display: block;' if username_set else 'display: none;' }}">
-            <!-- Messages loaded dynamically -->
-        </div>
-        <div class="chat-input" style="{{ 'display: flex;' if username_set else 'display: none;' }}">
-            <input type="text" id="chat-input" placeholder="Type your message...">
-            <button onclick="sendMessage()">Send</button>
-        </div>
-    </div>
-
-    <div class="container" id="main-container">
-        <div class="header">
-            <h1>Miu Alpha Streamer</h1>
-            <p class="text-muted">Next-Generation Video Streaming</p>
-        </div>
-
-        <div class="video-container">
-            <div class="video-info">
-                <h3>Now Playing: <span id="video-title">{{ videos[session['current_video_index']] }}</span></h3>
-                <p>Duration: <span id="video-duration" class="loading-duration"></span> seconds</p>
-            </div>
-            <video id="video-player" controls autoplay>
-                <source src="{{ url_for('stream_video', video_name=videos[session['current_video_index']]) }}" type="video/mp4">
-                <source src="{{ url_for('stream_video', video_name=videos[session['current_video_index']]) }}" type="video/x-matroska">
-                Your browser does not support the video tag.
-            </video>
-            
-            <div class="controls">
-                <button class="btn btn-primary" onclick="skipVideo()">
-                    <span>⏭️</span> Skip Video
-                </button>
-                <button class="btn btn-secondary" onclick="shuffleVideos()">
-                    <span>🔀</span> Shuffle
-                </button>
-                <button class="btn btn-secondary" onclick="togglePlayPause()">
-                    <span>⏯️</span> Play/Pause
-                </button>
-            </div>
-        </div>
-
-        <div class="video-list">
-            <h2 class="section-title">Available Videos</h2>
-            {% for video in videos %}
-                <div class="video-item">
-                    <div class="video-content">
-                        <strong>{{ video }}</strong>
-                        <p>Duration: <span id="duration-{{ video }}" class="loading-duration"></span></p>
-                    </div>
-                    <button class="btn btn-primary" onclick="playVideo('{{ video }}')">
-                        <span>▶️</span> Play
-                    </button>
-                </div>
-            {% endfor %}
-        </div>
-    </div>
-
-    <script>
-        // Theme Management
-        function toggleTheme() {
-            const html = document.documentElement;
-            const themeIcon = document.getElementById('theme-icon');
-            const isDark = html.getAttribute('data-theme') === 'dark';
-            
-            html.setAttribute('data-theme', isDark ? 'light' : 'dark');
-            themeIcon.textContent = isDark ? '🌙' : '☀️';
-            localStorage.setItem('theme', isDark ? 'light' : 'dark');
-        }
-
-        // Initialize theme
-        const savedTheme = localStorage.getItem('theme') || 'light';
-        document.documentElement.setAttribute('data-theme', savedTheme);
-        document.getElementById('theme-icon').textContent = savedTheme === 'dark' ? '☀️' : '🌙';
-
-        // Video Controls
-        let videoElement = document.getElementById('video-player');
-        let videoTitleElement = document.getElementById('video-title');
-        let videoDurationElement = document.getElementById('video-duration');
-        let currentVideoIndex = {{ session['current_video_index'] if 'current_video_index' in session else 0 }};
-
-        videoElement.onloadedmetadata = function() {
-            const duration = Math.round(videoElement.duration);
-            videoDurationElement.textContent = duration;
-            document.querySelectorAll('.loading-duration').forEach(el => {
-                if(el.textContent === 'Loading...') el.textContent = duration;
-            });
-        };
-
-        videoElement.onended = function() {
-            handleVideoTransition('/next-video');
-        };
-
-        function playVideo(videoName) {
-            handleVideoTransition(`/set-video/${videoName}`);
-        }
-
-        function skipVideo() {
-            handleVideoTransition('/next-video?skip=true');
-        }
-
-        function shuffleVideos() {
-            fetch('/shuffle-videos')
-                .then(response => response.json())
-                .then(data => {
-                    currentVideoIndex = 0;
-                    updatePlayer(data);
-                    location.reload();
-                });
-        }
-
-        function togglePlayPause() {
-            videoElement.paused ? videoElement.play() : videoElement.pause();
-        }
-
-        function handleVideoTransition(url) {
-            fetch(url)
-                .then(response => response.json())
-                .then(data => updatePlayer(data));
-        }
-
-        function updatePlayer(data) {
-            currentVideoIndex = data.index;
-            videoTitleElement.textContent = data.video_title;
-            videoDurationElement.textContent = data.video_duration;
-            videoElement.src = data.next_video_url;
-            videoElement.play();
-        }
-
-        // Chat Controls
-        function setUsername() {
-            const usernameInput = document.getElementById('username-input');
-            const feedback = document.getElementById('username-feedback');
-            const username = usernameInput.value.trim();
-            
-            if (!username) {
-                feedback.textContent = 'Please enter a username';
-                feedback.style.color = 'red';
-                return;
-            }
-
-            fetch('/set-username', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ username: username })
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.status === 'success') {
-                    document.getElementById('username-prompt-section').style.display = 'none';
-                    document.getElementById('chat-messages').style.display = 'block';
-                    document.getElementById('chat-input').style.display = 'flex';
-                    feedback.textContent = '✅ Registered';
-                    feedback.style.color = 'green';
-                    loadMessages();
-                    startMessagePolling();
-                } else {
-                    feedback.textContent = data.message;
-                    feedback.style.color = 'red';
-                }
-            });
-        }
-
-        function sendMessage() {
-            const chatInput = document.getElementById('chat-input');
-            const message = chatInput.value.trim();
-            
-            if (message) {
-                fetch('/send-message', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ message: message })
-                })
-                .then(response => {
-                    if (!response.ok) throw new Error('Message send failed');
-                    chatInput.value = '';
-                })
-                .catch(error => console.error('Error:', error));
-            }
-        }
-
-        function loadMessages() {
-            fetch('/get-messages')
-                .then(response => response.json())
-                .then(messages => {
-                    const chatMessages = document.getElementById('chat-messages');
-                    chatMessages.innerHTML = messages.map(msg => `
-                        <div class="chat-message">
-                            <strong>${msg.username}</strong> <small>${msg.timestamp}</small><br>
-                            ${msg.message}
-                        </div>
-                    `).join('');
-                    chatMessages.scrollTop = chatMessages.scrollHeight;
-                });
-        }
-
-        function startMessagePolling() {
-            setInterval(loadMessages, 1000);
-        }
-
-        // Event Listeners
-        document.getElementById('chat-input').addEventListener('keypress', function(event) {
-            if (event.key === 'Enter') sendMessage();
-        });
-
-        document.getElementById('chat-hover-box').addEventListener('click', toggleChat);
-        document.getElementById('theme-toggle').addEventListener('click', toggleTheme);
-
-        // Initialize chat state
-        if ({{ 'true' if username_set else 'false' }}) {
-            loadMessages();
-            startMessagePolling();
-        }
-
-        function toggleChat() {
-            const chatSidebar = document.getElementById('chat-sidebar');
-            const mainContainer = document.getElementById('main-container');
-            const chatHoverBox = document.getElementById('chat-hover-box');
-            const themeToggle = document.getElementById('theme-toggle');
-            
-            chatSidebar.classList.toggle('open');
-            mainContainer.classList.toggle('shifted');
-            chatHoverBox.classList.toggle('shifted');
-            themeToggle.classList.toggle('shifted');
-        }
-    </script>
-</body>
-</html>
-    ''', videos=videos, video_metadata=video_metadata, username_set='username' in session)
+    # The video list is fetched separately from /video-list, which is cached
+    return render_template('direct/index.html', current_video=current_video(), video_metadata=video_metadata,
+                           username_set='username' in session, library_refresh=LIBRARY_REFRESH_SECONDS)
+
+@app.route('/video-list')
+def video_list():
+    """The video list of the player page, rendered and compressed once per library version"""
+    version = library_version
+    fragment = video_list_fragment.get(version)
+    if fragment is None:
+        html = render_template('direct/video_list.html', videos=videos, video_metadata=video_metadata)
+        fragment = video_list_fragment.put(version, html)
+    return fragment.respond(request.headers)
 
 @app.route('/set-username', methods=['POST'])
 def set_username():
@@ -715,31 +168,99 @@ def send_message():
         'message': message,
         'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     }
-    chat_messages.append(chat_message)
-    save_chat_messages(chat_messages)
+    chat_hub.publish(chat_message)
+    chat_published.inc()
     return jsonify(chat_message)
 
 @app.route('/get-messages')
 def get_messages():
-    return jsonify(chat_messages)
+    """A page of chat history.
+
+    `since=<id>` returns messages newer than that id, waiting up to `wait`
+    seconds for one to arrive (the long-poll fallback for clients without
+    EventSource). `before=<id>` pages backwards through older history.
+    Without either the newest page is returned.
+    """
+    limit = min(max(request.args.get('limit', CHAT_PAGE_SIZE, type=int), 1), CHAT_PAGE_SIZE)
+    since = request.args.get('since', type=int)
+    before = request.args.get('before', type=int)
+    if since is not None:
+        wait = min(request.args.get('wait', 0, type=float), CHAT_LONG_POLL_TIMEOUT)
+        messages = chat_hub.wait(since, wait, limit)
+        chat_delivered.inc(len(messages))
+    elif before is not None:
+        messages = chat_hub.before(before, limit)
+    else:
+        messages = chat_hub.latest(limit)
+    if messages:
+        next_cursor = messages[-1]['id']
+    else:
+        next_cursor = since if since is not None else chat_hub.last_id
+    return jsonify({
+        'messages': messages,
+        'next_cursor': next_cursor,
+        'prev_cursor': messages[0]['id'] if messages and messages[0]['id'] > 1 else None
+    })
+
+@app.route('/chat-stream')
+def chat_stream():
+    # EventSource sends Last-Event-ID when it reconnects
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('since', chat_hub.last_id, type=int)
+
+    def events(last_id):
+        chat_streams.inc()
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                messages = chat_hub.wait(last_id, CHAT_KEEPALIVE, CHAT_PAGE_SIZE)
+                if not messages:
+                    yield ': keepalive\n\n'
+                    continue
+                chat_delivered.inc(len(messages))
+                for message in messages:
+                    yield f"id: {message['id']}\ndata: {json.dumps(message)}\n\n"
+                last_id = messages[-1]['id']
+        finally:
+            chat_streams.dec()
+
+    return Response(events(last_id), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def viewer_id():
+    """Bandwidth key of the session, so viewers behind one address don't share a budget"""
+    if 'viewer_id' not in session:
+        session['viewer_id'] = secrets.token_hex(8)
+    return session['viewer_id']
 
 @app.route('/stream-video/<video_name>')
 def stream_video(video_name):
     video_path = os.path.join(VIDEO_FOLDER, video_name)
-    if not os.path.exists(video_path):
+    if not os.path.isfile(video_path):
         return jsonify({'error': 'Video not found'}), 404
-    return send_file(video_path, as_attachment=False)
+    # Range requests let the player seek without re-downloading the file
+    return send_media(video_path, throttle=bandwidth.throttle(viewer_id(), PLAYBACK))
+
+@app.route('/bandwidth-stats')
+def bandwidth_stats():
+    return jsonify(bandwidth.stats())
+
+@app.route('/metadata/<video_name>')
+def get_metadata(video_name):
+    if video_name not in video_metadata:
+        return jsonify({'error': 'Video not found'}), 404
+    return jsonify(video_metadata[video_name])
 
 @app.route('/next-video')
 def next_video():
-    skip = request.args.get('skip', 'false').lower() == 'true'
-    
-    if skip:
-        session['current_video_index'] = (session['current_video_index'] + 1) % len(videos)
-    else:
-        session['current_video_index'] = (session['current_video_index'] + 1) % len(videos)
-
-    next_video_name = videos[session['current_video_index']]
+    # Skipping and reaching the end (?skip=true or not) both move on by one
+    if current_video() is None:
+        return no_videos()
+    session['current_video_index'] += 1
+    next_video_name = current_video()
+    if next_video_name is None:
+        return no_videos()
     next_video_url = url_for('stream_video', video_name=next_video_name)
     video_title = video_metadata[next_video_name]['title']
     video_duration = video_metadata[next_video_name]['duration']
@@ -755,7 +276,9 @@ def next_video():
 def set_video(video_name):
     if video_name in videos:
         session['current_video_index'] = videos.index(video_name)
-    next_video_name = videos[session['current_video_index']]
+    next_video_name = current_video()
+    if next_video_name is None:
+        return no_videos()
     next_video_url = url_for('stream_video', video_name=next_video_name)
     video_title = video_metadata[next_video_name]['title']
     video_duration = video_metadata[next_video_name]['duration']
@@ -770,8 +293,11 @@ def set_video(video_name):
 @app.route('/shuffle-videos')
 def shuffle_videos():
     random.shuffle(videos)
+    library_changed()
     session['current_video_index'] = 0
-    next_video_name = videos[session['current_video_index']]
+    next_video_name = current_video()
+    if next_video_name is None:
+        return no_videos()
     next_video_url = url_for('stream_video', video_name=next_video_name)
     video_title = video_metadata[next_video_name]['title']
     video_duration = video_metadata[next_video_name]['duration']
@@ -1,22 +1,48 @@
-from flask import Flask, send_file, jsonify, render_template_string, request, url_for
+from flask import Flask, jsonify, render_template, render_template_string, request, url_for
 import os
 import random
 from flask import session
+from file_streaming import send_media
+from media_probe import MetadataStore
+from metrics import Registry, instrument
+from static_assets import FragmentCache, fingerprint_static
+from compression import compress_responses
 
 app = Flask(__name__)
+# Sessions need a key; unset, every route that uses one fails
+app.secret_key = os.getenv('SECRET_KEY')
+fingerprint_static(app)
+compress_responses(app)
+registry = Registry()
+instrument(app, registry)
 
 VIDEO_FOLDER = "uploads"  # Path to your video folder
+METADATA_DB = "video_metadata.sqlite3"  # Cached ffprobe results
 video_metadata = {}
+metadata_store = MetadataStore(METADATA_DB)
 
 # Get a list of all video files in the folder
 videos = [video for video in os.listdir(VIDEO_FOLDER) if video.endswith(('.mp4', '.mkv'))]
 
-# Add video metadata (title) without calculating the duration via moviepy
+# Bumped whenever the video list or a duration changes
+library_version = 0
+video_list_fragment = FragmentCache()
+
+def library_changed():
+    global library_version
+    library_version += 1
+
+def update_video_metadata(path, metadata):
+    video_metadata[os.path.basename(path)].update(metadata, duration=round(metadata['duration']))
+    library_changed()
+
+# Add video metadata (title), the duration and codecs are probed in the background
 for video in videos:
     video_metadata[video] = {
         'title': video.split('.')[0],
-        'duration': 0  # Placeholder, as duration can be extracted from the frontend (HTML5 video)
+        'duration': 0
     }
+    metadata_store.submit(os.path.join(VIDEO_FOLDER, video), update_video_metadata)
 
 @app.route('/')
 def index():
@@ -24,134 +50,34 @@ def index():
     if 'current_video_index' not in session:
         session['current_video_index'] = 0  # Default to the first video
 
-    return render_template_string("""
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Miu ALfha Streamer</title>
-        <link href="https://maxcdn.bootstrapcdn.com/bootstrap/4.5.2/css/bootstrap.min.css" rel="stylesheet">
-        <style>
-            body { font-family: Arial, sans-serif; }
-            .controls { margin-top: 20px; text-align: center; }
-            .btn { margin: 5px; }
-            .video-container { margin: 20px auto; text-align: center; }
-            .video-list { margin-top: 30px; }
-            .video-item { padding: 10px; border: 1px solid #ddd; margin-bottom: 10px; }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1 class="text-center my-4">Miu Alfha Streamer</h1>
-            <div class="video-container">
-                <h3>Now Playing: <span id="video-title">{{ videos[session['current_video_index']] }}</span></h3>
-                <p>Duration: <span id="video-duration">0</span> seconds</p>
-                <video id="video-player" controls autoplay style="width: 100%; max-width: 720px;">
-                    <source src="{{ url_for('stream_video', video_name=videos[session['current_video_index']]) }}" type="video/mp4">
-                    <source src="{{ url_for('stream_video', video_name=videos[session['current_video_index']]) }}" type="video/x-matroska">
-                    Your browser does not support the video tag.
-                </video>
-            </div>
-            <div class="controls">
-                <button class="btn btn-primary" onclick="skipVideo()">Skip Video</button>
-                <button class="btn btn-secondary" onclick="shuffleVideos()">Shuffle Videos</button>
-                <button class="btn btn-warning" onclick="togglePlayPause()">Play/Pause</button>
-            </div>
-
-            <!-- Displaying Video List -->
-            <div class="video-list">
-                <h3>Available Videos</h3>
-                {% for video in videos %}
-                    <div class="video-item">
-                        <strong>{{ video }}</strong>
-                        <p>Duration: <span id="duration-{{ video }}" class="video-duration">Loading...</span></p>
-                        <button class="btn btn-info" onclick="playVideo('{{ video }}')">Play Video</button>
-                    </div>
-                {% endfor %}
-            </div>
-        </div>
-
-        <script>
-            let videoElement = document.getElementById('video-player');
-            let videoTitleElement = document.getElementById('video-title');
-            let videoDurationElement = document.getElementById('video-duration');
-            let currentVideoIndex = {{ session['current_video_index'] }};
-
-            // Fetch and update video duration dynamically when the video metadata is loaded
-            videoElement.onloadedmetadata = function() {
-                videoDurationElement.innerText = Math.round(videoElement.duration); // Duration in seconds
-                document.getElementById('duration-' + videoTitleElement.innerText).innerText = Math.round(videoElement.duration);
-            };
-
-            videoElement.onended = function() {
-                fetch('/next-video')
-                    .then(response => response.json())
-                    .then(data => {
-                        currentVideoIndex = data.index;
-                        videoTitleElement.innerText = data.video_title;
-                        videoDurationElement.innerText = data.video_duration;
-                        videoElement.src = data.next_video_url;
-                        videoElement.play();
-                    });
-            }
-
-            function playVideo(videoName) {
-                fetch('/set-video/' + videoName)
-                    .then(response => response.json())
-                    .then(data => {
-                        currentVideoIndex = data.index;
-                        videoTitleElement.innerText = data.video_title;
-                        videoDurationElement.innerText = data.video_duration;
-                        videoElement.src = data.next_video_url;
-                        videoElement.play();
-                    });
-            }
-
-            function skipVideo() {
-                fetch('/next-video?skip=true')
-                    .then(response => response.json())
-                    .then(data => {
-                        currentVideoIndex = data.index;
-                        videoTitleElement.innerText = data.video_title;
-                        videoDurationElement.innerText = data.video_duration;
-                        videoElement.src = data.next_video_url;
-                        videoElement.play();
-                    });
-            }
-
-            function shuffleVideos() {
-                fetch('/shuffle-videos')
-                    .then(response => response.json())
-                    .then(data => {
-                        currentVideoIndex = 0;
-                        videoTitleElement.innerText = data.video_title;
-                        videoDurationElement.innerText = data.video_duration;
-                        videoElement.src = data.next_video_url;
-                        videoElement.play();
-                    });
-            }
-
-            function togglePlayPause() {
-                if (videoElement.paused) {
-                    videoElement.play();
-                } else {
-                    videoElement.pause();
-                }
-            }
-        </script>
-    </body>
-    </html>
-    """, videos=videos, video_metadata=video_metadata)
+    # The video list is fetched separately from /video-list, which is cached
+    return render_template('prototype/index.html', videos=videos, video_metadata=video_metadata)
+
+@app.route('/video-list')
+def video_list():
+    """The video list, rendered and compressed once per library version"""
+    version = library_version
+    fragment = video_list_fragment.get(version)
+    if fragment is None:
+        html = render_template('prototype/video_list.html', videos=videos, video_metadata=video_metadata)
+        fragment = video_list_fragment.put(version, html)
+    return fragment.respond(request.headers)
 
 @app.route('/stream-video/<video_name>')
 def stream_video(video_name):
     video_path = os.path.join(VIDEO_FOLDER, video_name)
-    if os.path.exists(video_path):
-        return send_file(video_path, as_attachment=False)
+    if os.path.isfile(video_path):
+        # Range requests let the player seek without re-downloading the file
+        return send_media(video_path)
     else:
         return render_template_string("""<h1>Sorry, this video is unavailable!</h1><a href="/">Go back to the main page</a>"""), 404
 
+@app.route('/metadata/<video_name>')
+def get_metadata(video_name):
+    if video_name not in video_metadata:
+        return jsonify({'error': 'Video not found'}), 404
+    return jsonify(video_metadata[video_name])
+
 @app.route('/next-video')
 def next_video():
     skip = request.args.get('skip', 'false').lower() == 'true'
@@ -193,6 +119,7 @@ def set_video(video_name):
 @app.route('/shuffle-videos')
 def shuffle_videos():
     random.shuffle(videos)
+    library_changed()
     session['current_video_index'] = 0
     next_video_name = videos[session['current_video_index']]
     next_video_url = url_for('stream_video', video_name=next_video_name)
@@ -0,0 +1,211 @@
+"""Named encoder settings for full transcodes and the measurements used to pick one.
+
+Each profile trades encoding speed for quality. How fast a profile runs
+depends on the machine, so a calibration run encodes the same reference
+clip with every profile and records its realtime factor (media seconds
+encoded per wall-clock second) and output bitrate. ProfileScheduler then
+picks the best profile that still keeps up with the uploads.
+
+    python encoding_profiles.py --output encoder_calibration.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
+
+# Fastest first. `fps` None keeps the source frame rate, `max_width` None its size.
+PROFILES = {
+    'fast-ingest': {'preset': 'ultrafast', 'crf': 28, 'max_width': 1280, 'fps': 30, 'audio_bitrate': 128},
+    'balanced': {'preset': 'veryfast', 'crf': 23, 'max_width': 1920, 'fps': None, 'audio_bitrate': 128},
+    'archival': {'preset': 'slow', 'crf': 20, 'max_width': None, 'fps': None, 'audio_bitrate': 192},
+}
+DEFAULT_PROFILE = 'fast-ingest'
+# Seconds between forced keyframes, so segments can be cut on any boundary
+KEYFRAME_SECONDS = 1
+# Uploads older than this no longer count towards the ingest rate
+INGEST_WINDOW_SECONDS = 6 * 3600
+# The backlog should be gone within this many seconds on top of keeping up with new uploads
+DRAIN_HORIZON_SECONDS = 12 * 3600
+# Reference clip encoded by the calibration
+CALIBRATION_SECONDS = 10
+CALIBRATION_SIZE = '1920x1080'
+
+
+def load_profiles(path):
+    """PROFILES updated from a JSON file of {name: settings}, missing keys taken from fast-ingest"""
+    profiles = {name: dict(settings) for name, settings in PROFILES.items()}
+    if path and os.path.exists(path):
+        with open(path, 'r') as f:
+            for name, settings in json.load(f).items():
+                profiles[name] = dict(profiles.get(name, PROFILES[DEFAULT_PROFILE]), **settings)
+    return profiles
+
+
+def video_args(profile, threads):
+    """ffmpeg libx264 arguments of a profile, without any scaling or rate control by bitrate"""
+    args = ['-c:v', 'libx264', '-preset', profile['preset']]
+    if profile['fps']:
+        args += ['-r', str(profile['fps']), '-g', str(profile['fps'] * KEYFRAME_SECONDS)]
+    else:
+        args += ['-force_key_frames', f'expr:gte(t,n_forced*{KEYFRAME_SECONDS})']
+    return args + ['-threads', str(threads)]
+
+
+def audio_args(profile):
+    return ['-c:a', 'aac', '-b:a', f"{profile['audio_bitrate']}k"]
+
+
+def quality_args(profile):
+    """Constant-quality rate control and downscaling for a single rendition"""
+    args = ['-crf', str(profile['crf'])]
+    if profile['max_width']:
+        # Never upscale, and keep the height even as libx264 requires
+        args += ['-vf', f"scale='min({profile['max_width']},iw)':-2"]
+    return args
+
+
+def transcode_args(profile, threads):
+    """Everything needed to encode one rendition with a profile"""
+    return video_args(profile, threads) + quality_args(profile) + audio_args(profile)
+
+
+def machine():
+    """What a calibration is only valid for"""
+    return {'node': platform.node(), 'cpus': os.cpu_count(), 'processor': platform.processor()}
+
+
+def make_reference(path, seconds=CALIBRATION_SECONDS, size=CALIBRATION_SIZE):
+    """Write a detailed, moving test clip at a high bitrate, as a camera upload would be"""
+    subprocess.run([
+        'ffmpeg', '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30:duration={seconds}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={seconds}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '16',
+        '-c:a', 'aac', '-b:a', '192k', '-shortest', path
+    ], check=True)
+
+
+def calibrate(profiles, threads, reference=None, seconds=CALIBRATION_SECONDS):
+    """Encode a reference clip with every profile and measure it.
+
+    Without `reference` a synthetic clip is generated. Returns a dict that
+    can be saved with `save_calibration`.
+    """
+    generated = reference is None
+    with tempfile.TemporaryDirectory() as workdir:
+        if generated:
+            reference = os.path.join(workdir, 'reference.mp4')
+            make_reference(reference, seconds)
+        duration = float(subprocess.run([
+            'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', reference
+        ], capture_output=True, text=True, check=True).stdout.strip())
+        results = {}
+        for name, profile in profiles.items():
+            output = os.path.join(workdir, f'{name}.ts')
+            started = time.monotonic()
+            subprocess.run(['ffmpeg', '-v', 'error', '-y', '-i', reference]
+                           + transcode_args(profile, threads) + ['-f', 'mpegts', output], check=True)
+            elapsed = time.monotonic() - started
+            results[name] = {
+                'realtime_factor': round(duration / elapsed, 3),
+                'bitrate_kbps': round(os.path.getsize(output) * 8 / duration / 1000),
+                'encode_seconds': round(elapsed, 3),
+            }
+    return {
+        'machine': machine(),
+        'threads': threads,
+        'reference': {'path': None if generated else reference, 'duration': duration},
+        'measured': time.time(),
+        'profiles': results,
+    }
+
+
+def save_calibration(path, calibration):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_calibration(path, threads):
+    """A saved calibration if it was measured on this machine with these settings, else None"""
+    try:
+        with open(path, 'r') as f:
+            calibration = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+    if calibration.get('machine') != machine() or calibration.get('threads') != threads:
+        return None
+    return calibration
+
+
+class ProfileScheduler:
+    """Pick the encoding profile for each transcode from the measured speeds.
+
+    The transcodes have to keep up with the media arriving, `ingest_rate`
+    seconds of video per second averaged over INGEST_WINDOW_SECONDS, and
+    also work off what is already queued within DRAIN_HORIZON_SECONDS. The
+    slowest, best looking profile whose realtime factor across all workers
+    covers both is chosen, and the fastest one when none does. Until there
+    is a calibration, or when `fixed` names a profile, that one is used.
+    """
+
+    def __init__(self, profiles, workers, calibration=None, fixed=None):
+        self.profiles = profiles
+        self.workers = workers
+        self.calibration = calibration
+        self.fixed = fixed
+        self._arrivals = deque()
+        self._lock = threading.Lock()
+
+    def ingested(self, media_seconds):
+        """Record the duration of a newly uploaded source"""
+        with self._lock:
+            self._arrivals.append((time.monotonic(), media_seconds))
+
+    def ingest_rate(self):
+        """Media seconds uploaded per second over the window"""
+        now = time.monotonic()
+        with self._lock:
+            while self._arrivals and now - self._arrivals[0][0] > INGEST_WINDOW_SECONDS:
+                self._arrivals.popleft()
+            return sum(seconds for _, seconds in self._arrivals) / INGEST_WINDOW_SECONDS
+
+    def required_rate(self, backlog_seconds):
+        return self.ingest_rate() + backlog_seconds / DRAIN_HORIZON_SECONDS
+
+    def choose(self, backlog_seconds):
+        """Name of the profile to encode the next title with"""
+        if self.fixed is not None:
+            return self.fixed
+        measured = (self.calibration or {}).get('profiles', {})
+        # Profiles from a file come after the built-in ones whatever their speed,
+        # so order by the measurement rather than by definition
+        candidates = sorted((name for name in self.profiles if name in measured),
+                            key=lambda name: measured[name]['realtime_factor'], reverse=True)
+        if not candidates:
+            return DEFAULT_PROFILE
+        required = self.required_rate(backlog_seconds)
+        for name in reversed(candidates):
+            if measured[name]['realtime_factor'] * self.workers >= required:
+                return name
+        return candidates[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure every encoding profile on this machine')
+    parser.add_argument('--output', default='encoder_calibration.json')
+    parser.add_argument('--profiles', help='JSON file adding to or overriding the built-in profiles')
+    parser.add_argument('--reference', help='clip to encode instead of a generated test pattern')
+    parser.add_argument('--seconds', type=float, default=CALIBRATION_SECONDS,
+                        help='length of the generated clip')
+    parser.add_argument('--threads', type=int, default=2, help='threads per ffmpeg, as the server uses')
+    args = parser.parse_args()
+    calibration = calibrate(load_profiles(args.profiles), args.threads, args.reference, args.seconds)
+    save_calibration(args.output, calibration)
+    for name, result in calibration['profiles'].items():
+        print(f"{name:12} {result['realtime_factor']:8.2f}x realtime {result['bitrate_kbps']:7d} kbps")
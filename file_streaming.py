@@ -0,0 +1,217 @@
+import mimetypes
+import mmap
+import os
+import secrets
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date
+
+CHUNK_SIZE = 256 * 1024
+# More ranges than this in one request are answered with the whole file
+MAX_RANGES = 16
+
+
+class MmapFileIterator:
+    """Yield parts of a file in fixed-size chunks through mmap.
+
+    `pieces` is a list of (start, end) byte ranges of the file, end
+    exclusive, optionally interleaved with literal bytes such as multipart
+    headers. Used when the WSGI server has no wsgi.file_wrapper. Only one
+    chunk is held in Python memory at a time, however large the file is.
+    `throttle(size)`, if given, is called before each chunk and may block
+    to pace the transfer.
+    """
+
+    def __init__(self, f, pieces, chunk_size=CHUNK_SIZE, throttle=None):
+        self.f = f
+        self.pieces = pieces
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+
+    def __iter__(self):
+        mapped = None
+        try:
+            for piece in self.pieces:
+                if isinstance(piece, bytes):
+                    yield piece
+                    continue
+                position, end = piece
+                if position >= end:
+                    continue
+                if mapped is None:
+                    mapped = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+                while position < end:
+                    size = min(self.chunk_size, end - position)
+                    if self.throttle is not None:
+                        self.throttle(size)
+                    yield mapped[position:position + size]
+                    position += size
+        finally:
+            if mapped is not None:
+                mapped.close()
+            self.close()
+
+    def close(self):
+        self.f.close()
+
+
+def file_body(f, start, length, size, throttle=None):
+    """Response body for `length` bytes of an open file starting at `start`.
+
+    Servers that provide wsgi.file_wrapper (gunicorn, uWSGI) send it with
+    os.sendfile, which copies straight from the page cache to the socket.
+    A file wrapper sends up to the end of the file, so it is only used when
+    the range runs to the end and the transfer isn't throttled; everything
+    else streams through mmap.
+    """
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is not None and start + length == size and throttle is None:
+        f.seek(start)
+        return file_wrapper(f, CHUNK_SIZE)
+    return MmapFileIterator(f, [(start, start + length)], throttle=throttle)
+
+
+def content_disposition(filename):
+    try:
+        filename.encode('ascii')
+        return 'attachment; filename="{}"'.format(filename.replace('"', ''))
+    except UnicodeEncodeError:
+        return "attachment; filename*=UTF-8''{}".format(quote(filename, safe=''))
+
+
+def parse_byte_ranges(header, size):
+    """Turn a Range header into sorted, merged (start, end) pairs, end exclusive.
+
+    Returns None when the header is malformed or asks for too many ranges,
+    in which case it is ignored, and an empty list when none of the ranges
+    can be satisfied.
+    """
+    if not header or not header.startswith('bytes='):
+        return None
+    ranges = []
+    for spec in header[len('bytes='):].split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        first, dash, last = spec.partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) + 1 if last else max(size, start + 1)
+                if end <= start:
+                    return None
+            else:
+                suffix = int(last)
+                if suffix == 0:
+                    continue
+                start, end = max(0, size - suffix), size
+        except ValueError:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, min(end, size)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def etag_matches(header, etag):
+    """Weak comparison against an If-None-Match header"""
+    for candidate in header.split(','):
+        candidate = candidate.strip()
+        if candidate == '*' or candidate.removeprefix('W/') == etag:
+            return True
+    return False
+
+
+def is_not_modified(etag, mtime):
+    if 'If-None-Match' in request.headers:
+        return etag_matches(request.headers['If-None-Match'], etag)
+    since = parse_date(request.headers.get('If-Modified-Since'))
+    return since is not None and int(since.timestamp()) >= int(mtime)
+
+
+def if_range_matches(etag, mtime):
+    """Whether a Range request may be honoured under its If-Range header"""
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith(('"', 'W/')):
+        # If-Range needs a strong match, so a weak tag never matches
+        return value == etag
+    date = parse_date(value)
+    return date is not None and int(date.timestamp()) == int(mtime)
+
+
+def send_media(path, mimetype=None, max_age=3600, throttle=None):
+    """Send a file with byte-range and conditional request support.
+
+    Implements single and multipart range requests (RFC 7233) with a strong
+    ETag built from the file's size and mtime, If-None-Match,
+    If-Modified-Since and If-Range. Seeking in a large video then costs one
+    small range read instead of a new transfer of the whole file.
+
+    Raises FileNotFoundError if the file does not exist.
+    """
+    f = open(path, 'rb')
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': f'public, max-age={max_age}',
+        'Accept-Ranges': 'bytes',
+    }
+
+    if is_not_modified(etag, stat.st_mtime):
+        f.close()
+        return Response(status=304, headers=headers)
+
+    ranges = None
+    if 'Range' in request.headers and if_range_matches(etag, stat.st_mtime):
+        ranges = parse_byte_ranges(request.headers['Range'], size)
+
+    if ranges is None:
+        response = Response(file_body(f, 0, size, size, throttle), mimetype=mimetype,
+                            headers=headers, direct_passthrough=True)
+        response.content_length = size
+        return response
+
+    if not ranges:
+        f.close()
+        headers['Content-Range'] = f'bytes */{size}'
+        return Response(status=416, headers=headers)
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        response = Response(file_body(f, start, end - start, size, throttle), status=206,
+                            mimetype=mimetype, headers=headers, direct_passthrough=True)
+        response.content_length = end - start
+        return response
+
+    boundary = secrets.token_hex(16)
+    pieces = []
+    for start, end in ranges:
+        pieces.append((f'\r\n--{boundary}\r\nContent-Type: {mimetype}\r\n'
+                       f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode())
+        pieces.append((start, end))
+    pieces.append(f'\r\n--{boundary}--\r\n'.encode())
+    length = sum(len(p) if isinstance(p, bytes) else p[1] - p[0] for p in pieces)
+    response = Response(MmapFileIterator(f, pieces, throttle=throttle), status=206, headers=headers,
+                        content_type=f'multipart/byteranges; boundary={boundary}',
+                        direct_passthrough=True)
+    response.content_length = length
+    return response
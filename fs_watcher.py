@@ -0,0 +1,198 @@
+import os
+import threading
+import time
+import logging
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # watchdog is optional, fall back to polling
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class _EntryEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type in ('opened', 'closed_no_write'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', '')):
+            if path and os.path.dirname(os.path.abspath(path)) == self.watcher.folder:
+                self.watcher._changed(os.path.basename(os.path.abspath(path)))
+
+
+class DirectoryWatcher:
+    """Call `callback(name)` when a top-level entry of `folder` changes.
+
+    Uses watchdog (inotify on Linux, ReadDirectoryChangesW on Windows) when
+    it is installed. Without it a thread polls the folder every `interval`
+    seconds. The poller only lists the folder again when the folder's own
+    mtime changes, which happens when entries are created, renamed or
+    deleted. With `watch_contents` it also stats every entry on each poll,
+    so files growing in place are reported too; `sweep` does the same only
+    every `sweep` seconds. `extensions` limits it to names ending in one of
+    them, and the poller doesn't stat the others.
+
+    Entries whose names start with a dot are ignored. The callback runs on
+    the watcher's thread and should not block for long.
+    """
+
+    def __init__(self, folder, callback, interval=2.0, watch_contents=False, sweep=None, extensions=None):
+        self.folder = os.path.abspath(folder)
+        self.callback = callback
+        self.interval = interval
+        self.watch_contents = watch_contents
+        self.sweep = sweep
+        self.extensions = tuple(extensions) if extensions else None
+        self._observer = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _wanted(self, name):
+        return not name.startswith('.') and (self.extensions is None or name.lower().endswith(self.extensions))
+
+    def _changed(self, name):
+        if not self._wanted(name):
+            return
+        try:
+            self.callback(name)
+        except Exception:
+            logging.exception(f"Watcher callback failed for {name}")
+
+    def start(self):
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_EntryEventHandler(self), self.folder, recursive=False)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            self._thread = threading.Thread(target=self._poll, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+
+    def _scan(self):
+        entries = {}
+        with os.scandir(self.folder) as it:
+            for entry in it:
+                if not self._wanted(entry.name):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries[entry.name] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return entries
+
+    def _poll(self):
+        folder_mtime = os.stat(self.folder).st_mtime_ns
+        entries = self._scan()
+        swept = time.monotonic()
+        while not self._stop.wait(self.interval):
+            try:
+                mtime = os.stat(self.folder).st_mtime_ns
+                sweeping = self.sweep is not None and time.monotonic() - swept >= self.sweep
+                if mtime == folder_mtime and not self.watch_contents and not sweeping:
+                    continue
+                folder_mtime = mtime
+                swept = time.monotonic()
+                current = self._scan()
+            except OSError:
+                logging.exception(f"Could not poll {self.folder}")
+                continue
+            for name in entries.keys() | current.keys():
+                if entries.get(name) != current.get(name):
+                    self._changed(name)
+            entries = current
+
+
+class UploadWatcher:
+    """Report files of `folder` once they have finished arriving, and once they are gone.
+
+    Uploads and copies land a chunk at a time, so a file is handed to
+    `on_ready(name)` only after its size and mtime have stayed the same for
+    `settle` seconds, and again whenever it changes and settles after that.
+    `on_removed(name)` is called as soon as a file disappears. `extensions`
+    limits it to files ending in one of them, which also skips partial
+    uploads that are renamed when done.
+
+    Changes come from a DirectoryWatcher. Without watchdog it lists the
+    folder when its mtime changes, which catches new, renamed and deleted
+    files, and stats the matching files every `sweep` seconds to catch one
+    rewritten in place. Between sweeps only the files still settling are
+    stat'ed each `interval`.
+    """
+
+    def __init__(self, folder, on_ready, on_removed, settle=5.0, interval=1.0, extensions=None, sweep=10.0):
+        self.folder = os.path.abspath(folder)
+        self.on_ready = on_ready
+        self.on_removed = on_removed
+        self.settle = settle
+        self.interval = interval
+        self.watcher = DirectoryWatcher(folder, self._changed, interval=interval, sweep=sweep,
+                                        extensions=extensions)
+        # name -> (size, mtime, when it was last seen changing)
+        self._pending = {}
+        # name -> (size, mtime) last handed to on_ready
+        self._reported = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _report(self, callback, name):
+        try:
+            callback(name)
+        except Exception:
+            logging.exception(f"Upload watcher callback failed for {name}")
+
+    def _changed(self, name):
+        try:
+            stat = os.stat(os.path.join(self.folder, name))
+        except FileNotFoundError:
+            with self._lock:
+                self._pending.pop(name, None)
+                self._reported.pop(name, None)
+            self._report(self.on_removed, name)
+            return
+        with self._lock:
+            self._pending[name] = (stat.st_size, stat.st_mtime_ns, time.monotonic())
+
+    def _settled(self):
+        """Names of pending files that haven't changed for `settle` seconds"""
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for name, (size, mtime, since) in list(self._pending.items()):
+                if now - since < self.settle:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    # The watcher reports the removal
+                    del self._pending[name]
+                    continue
+                if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                    self._pending[name] = (stat.st_size, stat.st_mtime_ns, now)
+                    continue
+                del self._pending[name]
+                if self._reported.get(name) != (size, mtime):
+                    self._reported[name] = (size, mtime)
+                    ready.append(name)
+        return ready
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            for name in self._settled():
+                self._report(self.on_ready, name)
+
+    def start(self):
+        self.watcher.start()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+        self.watcher.stop()
@@ -0,0 +1,77 @@
+import math
+import os
+
+
+def parse_media_playlist(path):
+    """Read the segments listed in an HLS media playlist.
+
+    Returns a list of dicts with the segment uri, its duration and whether it
+    is preceded by a discontinuity tag. A missing playlist reads as empty.
+    """
+    segments = []
+    duration = None
+    discontinuity = False
+    try:
+        with open(path, 'r') as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return segments
+    for line in lines:
+        line = line.strip()
+        if line.startswith('#EXTINF:'):
+            duration = float(line[len('#EXTINF:'):].split(',', 1)[0])
+        elif line == '#EXT-X-DISCONTINUITY':
+            discontinuity = True
+        elif line and not line.startswith('#') and duration is not None:
+            segments.append({'uri': line, 'duration': duration, 'discontinuity': discontinuity})
+            duration = None
+            discontinuity = False
+    return segments
+
+
+def parse_master_playlist(path):
+    """Read the variant playlist uris listed in an HLS master playlist"""
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.startswith('#')]
+
+
+def write_media_playlist(path, segments, ended=True):
+    """Write a VOD media playlist for `segments`, replacing `path` atomically"""
+    target = max((segment['duration'] for segment in segments), default=0)
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{math.ceil(target)}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD' if ended else '#EXT-X-PLAYLIST-TYPE:EVENT',
+    ]
+    for segment in segments:
+        if segment.get('discontinuity'):
+            lines.append('#EXT-X-DISCONTINUITY')
+        lines.append(f"#EXTINF:{segment['duration']:.6f},")
+        lines.append(segment['uri'])
+    if ended:
+        lines.append('#EXT-X-ENDLIST')
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
+
+
+
+def write_master_playlist(path, variants):
+    """Write a master playlist listing one media playlist per rendition.
+
+    Each variant is a dict with the playlist `uri`, its peak `bandwidth` in
+    bits per second and its `width` and `height`.
+    """
+    lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for variant in variants:
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={variant['bandwidth']},"
+                     f"RESOLUTION={variant['width']}x{variant['height']}")
+        lines.append(variant['uri'])
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
@@ -0,0 +1,257 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import shutil
+
+from compression import precompress
+from hls_playlist import write_media_playlist
+from media_probe import keyframe_times, packaging_mode, probe
+
+SEGMENT_PATTERN = re.compile(r'segment(\d{5})\.ts')
+# Longest segment stream copy may produce; sources with sparser keyframes are transcoded
+MAX_COPY_SEGMENT_SECONDS = 10
+# A shorter tail is folded into the segment before it
+MIN_LAST_SEGMENT_SECONDS = 0.5
+# A copied segment's seek lands on the keyframe at or before the requested time,
+# so aim just past the cut in case the float printed is a hair early
+COPY_SEEK_SLACK = 0.001
+# Containers that index every keyframe, so a seek lands exactly on a cut. Matroska
+# seeks by cue points, which may be a cluster or an audio preroll away from it.
+SEEKABLE_CONTAINERS = ('mov', 'mp4')
+# Segments produced ahead of the one a player asked for
+LOOKAHEAD_SEGMENTS = 1
+
+
+class PackagingError(Exception):
+    """ffmpeg could not produce a segment"""
+
+
+def copy_cut_points(keyframes, duration, target):
+    """Segment start times on keyframes, at least `target` seconds apart.
+
+    Returns None if some segment would be longer than
+    MAX_COPY_SEGMENT_SECONDS, because the keyframes are too sparse.
+    """
+    starts = [0.0]
+    for keyframe in keyframes:
+        if keyframe - starts[-1] >= target and duration - keyframe > MIN_LAST_SEGMENT_SECONDS:
+            starts.append(keyframe)
+    ends = starts[1:] + [duration]
+    if any(end - start > MAX_COPY_SEGMENT_SECONDS for start, end in zip(starts, ends)):
+        return None
+    return starts
+
+
+def build_index(source_path, target):
+    """Probe a source and decide how to package it and where to cut it"""
+    stat = os.stat(source_path)
+    metadata = probe(source_path)
+    duration = metadata['duration']
+    mode = packaging_mode(metadata)
+    if not set((metadata.get('container') or '').split(',')) & set(SEEKABLE_CONTAINERS):
+        mode = 'transcode'
+    starts = None
+    if mode != 'transcode':
+        starts = copy_cut_points(keyframe_times(source_path), duration, target)
+        if starts is None:
+            mode = 'transcode'
+    if starts is None:
+        # Encoded segments start with a keyframe wherever they are cut
+        count = max(1, math.ceil((duration - MIN_LAST_SEGMENT_SECONDS) / target))
+        starts = [i * target for i in range(count)]
+    ends = starts[1:] + [duration]
+    return {
+        'source': {'path': source_path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns},
+        'mode': mode,
+        'has_audio': bool(metadata['audio_codec']),
+        'segments': [{'start': start, 'duration': end - start} for start, end in zip(starts, ends)],
+    }
+
+
+class JitPackager:
+    """Serve titles as HLS straight from their source files.
+
+    The first playlist request probes the source's keyframes and writes
+    the whole playlist at once. Each segment is then cut by its own ffmpeg
+    run when a player first asks for it: stream-copied when the codecs
+    allow, encoded with `transcode_args` otherwise. Segments are kept under
+    `folder`, one directory per title, and the least recently used ones
+    are deleted once they take up more than `max_bytes`.
+    """
+
+    def __init__(self, folder, segment_duration, transcode_args, max_bytes, workers=2):
+        self.folder = folder
+        self.segment_duration = segment_duration
+        self.transcode_args = transcode_args
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.size = None
+        self._indexes = {}
+        self._pending = {}
+        self._slots = None
+        os.makedirs(folder, exist_ok=True)
+
+    def _title_dir(self, name):
+        return os.path.join(self.folder, name)
+
+    @staticmethod
+    def _current(index, source_path):
+        stat = os.stat(source_path)
+        return index['source'] == {'path': source_path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def _load_index(self, name, source_path):
+        """The saved index if it is for this version of the source, else a new one"""
+        title_dir = self._title_dir(name)
+        index_path = os.path.join(title_dir, 'index.json')
+        try:
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if self._current(index, source_path):
+                return index
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        # The source changed, nothing cut from the old one is valid
+        shutil.rmtree(title_dir, ignore_errors=True)
+        os.makedirs(title_dir)
+        index = build_index(source_path, self.segment_duration)
+        playlist_path = os.path.join(title_dir, 'playlist.m3u8')
+        write_media_playlist(playlist_path, [
+            {'uri': f'segment{number:05d}.ts', 'duration': segment['duration']}
+            for number, segment in enumerate(index['segments'])
+        ])
+        precompress(playlist_path)
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(index_path + '.tmp', index_path)
+        logging.info(f"Packaging {name} just in time: {len(index['segments'])} segments, {index['mode']}")
+        return index
+
+    async def _once(self, key, factory):
+        """Run `factory()` once for concurrent callers asking for the same key"""
+        task = self._pending.get(key)
+        if task is None:
+            task = self._pending[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self._pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def index(self, name, source_path):
+        index = self._indexes.get(name)
+        if index is not None and self._current(index, source_path):
+            return index
+        index = await self._once(('index', name), lambda: asyncio.to_thread(self._load_index, name, source_path))
+        self._indexes[name] = index
+        return index
+
+    async def playlist(self, name, source_path):
+        """Path of a title's media playlist, probing the source the first time"""
+        await self.index(name, source_path)
+        return os.path.join(self._title_dir(name), 'playlist.m3u8')
+
+    async def segment(self, name, source_path, filename):
+        """Path of one segment, cut from the source if it isn't on disk yet.
+
+        Raises LookupError for a segment the playlist doesn't list and
+        PackagingError if ffmpeg fails.
+        """
+        match = SEGMENT_PATTERN.fullmatch(filename)
+        index = await self.index(name, source_path)
+        if match is None or int(match.group(1)) >= len(index['segments']):
+            raise LookupError(filename)
+        number = int(match.group(1))
+        path = await self._segment(name, index, number)
+        for ahead in range(number + 1, min(number + 1 + LOOKAHEAD_SEGMENTS, len(index['segments']))):
+            asyncio.ensure_future(self._prefetch(name, index, ahead))
+        return path
+
+    async def _prefetch(self, name, index, number):
+        try:
+            await self._segment(name, index, number)
+        except Exception as e:
+            logging.warning(f"Could not prepare segment {number} of {name}: {e}")
+
+    async def _segment(self, name, index, number):
+        path = os.path.join(self._title_dir(name), f'segment{number:05d}.ts')
+        try:
+            # Mark it recently used for the pruning
+            os.utime(path)
+            return path
+        except FileNotFoundError:
+            pass
+        return await self._once(path, lambda: self._cut(index, number, path))
+
+    def _command(self, index, number, path):
+        segment = index['segments'][number]
+        copy_video = index['mode'] in ('copy', 'audio')
+        cmd = ['ffmpeg', '-v', 'error', '-y']
+        if segment['start']:
+            seek = segment['start'] + COPY_SEEK_SLACK if copy_video else segment['start']
+            cmd += ['-ss', f'{seek:.3f}']
+        cmd += ['-i', index['source']['path'], '-t', f"{segment['duration']:.3f}", '-map', '0:v:0']
+        if index['has_audio']:
+            cmd += ['-map', '0:a:0']
+        if index['mode'] == 'copy':
+            cmd += ['-c', 'copy']
+        elif index['mode'] == 'audio':
+            cmd += ['-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k']
+        else:
+            cmd += self.transcode_args
+        cmd += ['-sn', '-dn', '-output_ts_offset', f"{segment['start']:.3f}", '-f', 'mpegts', path + '.tmp']
+        return cmd
+
+    async def _cut(self, index, number, path):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        async with self._slots:
+            process = await asyncio.create_subprocess_exec(*self._command(index, number, path),
+                                                           stderr=asyncio.subprocess.PIPE)
+            _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise PackagingError(stderr.decode(errors='replace').strip() or f'ffmpeg exited with {process.returncode}')
+        os.replace(path + '.tmp', path)
+        await self._account(os.path.getsize(path))
+        return path
+
+    async def _account(self, added):
+        if self.size is None:
+            self.size = await asyncio.to_thread(self._disk_usage)
+        else:
+            self.size += added
+        if self.size > self.max_bytes:
+            self.size = await asyncio.to_thread(self._prune)
+
+    def _segments_on_disk(self):
+        found = []
+        for root, _, files in os.walk(self.folder):
+            for filename in files:
+                if SEGMENT_PATTERN.fullmatch(filename):
+                    try:
+                        stat = os.stat(os.path.join(root, filename))
+                    except FileNotFoundError:
+                        continue
+                    found.append((stat.st_mtime, stat.st_size, os.path.join(root, filename)))
+        return found
+
+    def _disk_usage(self):
+        return sum(size for _, size, _ in self._segments_on_disk())
+
+    def _prune(self):
+        """Delete least recently used segments until the cache is at 90% of its size"""
+        found = sorted(self._segments_on_disk())
+        size = sum(size for _, size, _ in found)
+        for _, file_size, path in found:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def discard(self, name):
+        """Forget a title, e.g. once a full conversion of it has been published"""
+        self._indexes.pop(name, None)
+        shutil.rmtree(self._title_dir(name), ignore_errors=True)
@@ -0,0 +1,238 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import posixpath
+
+from hls_playlist import parse_master_playlist, parse_media_playlist
+
+VIDEO_EXTENSIONS = ('.mp4', '.mkv')
+# Seconds between checks of the shared generation counter
+GENERATION_CHECK_INTERVAL = 1.0
+
+
+class MediaCatalog:
+    """Index of the published HLS titles.
+
+    Every title's playlist, duration, renditions, size, mtime and packaging
+    mode are kept in a SQLite database so a restart doesn't have to walk the
+    library again, and mirrored in memory so routes never touch the disk.
+    Entries are updated one title at a time through `refresh`, normally
+    called by a DirectoryWatcher on the HLS folder.
+
+    With a shared `state`, the generation is a counter shared by every
+    worker process. Workers that don't run a watcher notice it move and
+    reload their copy from the database.
+
+    Source files in `video_folder` are tracked too, in memory only, so
+    titles that have not been converted yet can be listed and packaged on
+    demand. They are updated through `refresh_source`.
+    """
+
+    def __init__(self, hls_folder, db_path, video_folder=None, state=None):
+        self.hls_folder = hls_folder
+        self.video_folder = video_folder
+        self.state = state
+        # Bumped on every change so callers can cache things derived from the catalog
+        self.generation = state.counter('catalog') if state is not None else 0
+        self._checked = time.monotonic()
+        self._titles = {}
+        self._names = []
+        # name -> {'path', 'size', 'mtime', 'duration'} of every source video
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS titles (
+                name TEXT PRIMARY KEY,
+                hls_path TEXT NOT NULL,
+                source_path TEXT,
+                playlist TEXT NOT NULL,
+                duration REAL NOT NULL,
+                renditions TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                packaging TEXT
+            )
+        ''')
+        try:
+            # Databases created before conversions recorded their mode
+            self._db.execute('ALTER TABLE titles ADD COLUMN packaging TEXT')
+        except sqlite3.OperationalError:
+            pass
+        self._db.commit()
+        self._load()
+
+    def _load(self):
+        titles = {}
+        for row in self._db.execute('SELECT name, hls_path, source_path, playlist, duration, '
+                                    'renditions, size, mtime, packaging FROM titles'):
+            entry = dict(zip(('name', 'hls_path', 'source_path', 'playlist', 'duration',
+                              'renditions', 'size', 'mtime', 'packaging'), row))
+            entry['renditions'] = json.loads(entry['renditions'])
+            titles[entry['name']] = entry
+        self._titles = titles
+        self._names = sorted(titles)
+
+    def _check_generation(self):
+        """Reload the index if another process changed it"""
+        if self.state is None or not self.state.shared:
+            return
+        now = time.monotonic()
+        if now - self._checked < GENERATION_CHECK_INTERVAL:
+            return
+        self._checked = now
+        generation = self.state.counter('catalog')
+        if generation != self.generation:
+            with self._lock:
+                self._load()
+                self.generation = generation
+
+    def titles(self, include_sources=False):
+        """Names of all published titles, sorted, with `include_sources` also unconverted ones"""
+        self._check_generation()
+        if include_sources:
+            return sorted(self._titles.keys() | self._sources.keys())
+        return list(self._names)
+
+    def source(self, name):
+        """The source video of a title, published or not, None if there is none"""
+        return self._sources.get(name)
+
+    def get(self, name):
+        self._check_generation()
+        return self._titles.get(name)
+
+    def __contains__(self, name):
+        self._check_generation()
+        return name in self._titles
+
+    def _scan(self, name):
+        """Build a catalog entry from a title's HLS directory, None if unpublished"""
+        hls_path = os.path.join(self.hls_folder, name)
+        for playlist in ('master.m3u8', 'playlist.m3u8'):
+            playlist_path = os.path.join(hls_path, playlist)
+            if os.path.isfile(playlist_path):
+                break
+        else:
+            return None
+        if playlist == 'master.m3u8':
+            variants = parse_master_playlist(playlist_path)
+            renditions = [posixpath.dirname(variant) for variant in variants]
+            media_playlist = os.path.join(hls_path, variants[0]) if variants else playlist_path
+        else:
+            renditions = ['']
+            media_playlist = playlist_path
+        try:
+            with open(os.path.join(hls_path, 'conversion.json'), 'r') as f:
+                packaging = json.load(f).get('mode')
+        except (FileNotFoundError, json.JSONDecodeError):
+            packaging = None
+        size = 0
+        for root, _, files in os.walk(hls_path):
+            for filename in files:
+                size += os.path.getsize(os.path.join(root, filename))
+        return {
+            'name': name,
+            'hls_path': hls_path,
+            'source_path': self._source_path(name),
+            'playlist': playlist,
+            'duration': sum(segment['duration'] for segment in parse_media_playlist(media_playlist)),
+            'renditions': renditions,
+            'size': size,
+            'mtime': os.stat(playlist_path).st_mtime_ns,
+            # 'copy', 'audio' or 'transcode', None for titles converted before it was recorded
+            'packaging': packaging,
+        }
+
+    def _source_path(self, name):
+        if self.video_folder is None:
+            return None
+        for extension in VIDEO_EXTENSIONS:
+            path = os.path.join(self.video_folder, name + extension)
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _changed(self):
+        self.generation = self.state.bump('catalog') if self.state is not None else self.generation + 1
+
+    def refresh_source(self, filename, duration=None):
+        """Re-read one file of the video folder, adding, updating or removing its source entry.
+
+        `duration` comes from probing the file. Without it, a known file
+        that hasn't changed keeps the duration it had.
+        """
+        name, extension = os.path.splitext(filename)
+        if extension.lower() not in VIDEO_EXTENSIONS:
+            return
+        path = os.path.join(self.video_folder, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        with self._lock:
+            known = self._sources.get(name)
+            if stat is None:
+                if known is None or known['path'] != path:
+                    return
+                del self._sources[name]
+            else:
+                entry = {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'duration': duration}
+                if duration is None and known is not None and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime_ns:
+                    entry['duration'] = known['duration']
+                if entry == known:
+                    return
+                self._sources[name] = entry
+            self._changed()
+
+    def refresh(self, name):
+        """Re-read one title from disk, adding, updating or removing it"""
+        try:
+            entry = self._scan(name)
+        except OSError:
+            # Still being moved into place, the next event will pick it up
+            return
+        with self._lock:
+            if entry is None:
+                if name not in self._titles:
+                    return
+                del self._titles[name]
+                self._db.execute('DELETE FROM titles WHERE name = ?', (name,))
+            else:
+                if self._titles.get(name) == entry:
+                    return
+                self._titles[name] = entry
+                self._db.execute(
+                    'INSERT OR REPLACE INTO titles (name, hls_path, source_path, playlist, duration, '
+                    'renditions, size, mtime, packaging) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (name, entry['hls_path'], entry['source_path'], entry['playlist'], entry['duration'],
+                     json.dumps(entry['renditions']), entry['size'], entry['mtime'], entry['packaging']))
+            self._db.commit()
+            self._names = sorted(self._titles)
+            self._changed()
+
+    def sync(self):
+        """Reconcile the index with the HLS folder, e.g. after downtime.
+
+        Titles whose playlist mtime matches the index are not read again.
+        """
+        on_disk = set()
+        with os.scandir(self.hls_folder) as it:
+            for entry in it:
+                if entry.name.startswith('.') or not entry.is_dir():
+                    continue
+                on_disk.add(entry.name)
+                known = self._titles.get(entry.name)
+                try:
+                    mtime = os.stat(os.path.join(entry.path, known['playlist'])).st_mtime_ns if known else None
+                except OSError:
+                    mtime = None
+                if mtime is None or mtime != known['mtime']:
+                    self.refresh(entry.name)
+        for name in set(self._titles) - on_disk:
+            self.refresh(name)
+        if self.video_folder is not None:
+            for filename in os.listdir(self.video_folder):
+                self.refresh_source(filename)
@@ -0,0 +1,176 @@
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+# How much of the start of a file is read to measure the keyframe interval
+KEYFRAME_SAMPLE_SECONDS = 120
+# Codecs that can go into MPEG-TS HLS segments without re-encoding
+HLS_VIDEO_CODECS = ('h264',)
+HLS_AUDIO_CODECS = ('aac', 'mp3')
+
+
+def probe(path):
+    """Read duration, codecs and dimensions of a media file with ffprobe"""
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-print_format', 'json',
+        '-show_format', '-show_streams',
+        path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    data = json.loads(result.stdout)
+    streams = data.get('streams', [])
+    # Cover art shows up as a single-frame video stream
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    fmt = data.get('format', {})
+    return {
+        'duration': float(fmt.get('duration') or 0),
+        'width': int(video.get('width') or 0),
+        'height': int(video.get('height') or 0),
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name'),
+        'bitrate': int(fmt.get('bit_rate') or 0),
+        'container': fmt.get('format_name'),
+    }
+
+
+def keyframe_times(path, seconds=None):
+    """Sorted presentation times of the video keyframes, from packet flags only.
+
+    Only packets are read, no frames are decoded, so even a whole film
+    takes about as long as reading it from disk. `seconds` limits the scan
+    to the start of the file.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0']
+    if seconds is not None:
+        cmd += ['-read_intervals', f'%+{seconds}']
+    cmd += ['-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', path]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            times.append(float(pts_time))
+    times.sort()
+    return times
+
+
+def keyframe_interval(path):
+    """Average seconds between video keyframes"""
+    times = keyframe_times(path, KEYFRAME_SAMPLE_SECONDS)
+    if len(times) < 2:
+        return None
+    return round((times[-1] - times[0]) / (len(times) - 1), 3)
+
+
+def packaging_mode(metadata):
+    """How a source can be cut into MPEG-TS HLS segments.
+
+    'copy' when both streams can be copied as they are, 'audio' when only
+    the audio has to be encoded to AAC, 'transcode' otherwise.
+    """
+    if metadata.get('video_codec') not in HLS_VIDEO_CODECS:
+        return 'transcode'
+    if metadata.get('audio_codec') not in HLS_AUDIO_CODECS + (None,):
+        return 'audio'
+    return 'copy'
+
+
+def extract_metadata(path):
+    """Everything the apps need to know about a video, run in a pool worker"""
+    metadata = probe(path)
+    metadata['keyframe_interval'] = keyframe_interval(path) if metadata['video_codec'] else None
+    return metadata
+
+
+class MetadataStore:
+    """Persistent cache of ffprobe results keyed by path, size and mtime.
+
+    Results are kept in SQLite and in memory. A file that changes on disk
+    gets a new size or mtime, so its old entry is simply ignored. Extraction
+    runs in a process pool, so probing a large library doesn't hold up
+    request threads.
+    """
+
+    def __init__(self, db_path, workers=None):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self._entries = {}
+        self._pending = {}
+        self._pool = None
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute('''
+            CREATE TABLE IF NOT EXISTS metadata (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime INTEGER NOT NULL,
+                data TEXT NOT NULL
+            )
+        ''')
+        self._db.commit()
+        for path, size, mtime, data in self._db.execute('SELECT path, size, mtime, data FROM metadata'):
+            self._entries[path] = (size, mtime, json.loads(data))
+
+    @staticmethod
+    def _key(path):
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def get(self, path):
+        """Cached metadata for the current version of a file, or None"""
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        try:
+            if self._key(path) != entry[:2]:
+                return None
+        except OSError:
+            return None
+        return entry[2]
+
+    def submit(self, path, callback=None):
+        """Probe a file in the pool unless it is cached already.
+
+        Returns a Future for the metadata. `callback(path, metadata)` runs
+        once it is available. In a pool worker process, where Windows
+        re-imports the app module, nothing is scheduled and None is returned.
+        """
+        if multiprocessing.parent_process() is not None:
+            return None
+        cached = self.get(path)
+        if cached is not None:
+            future = Future()
+            future.set_result(cached)
+        else:
+            with self._lock:
+                future = self._pending.get(path)
+                if future is None:
+                    if self._pool is None:
+                        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+                    key = self._key(path)
+                    future = self._pool.submit(extract_metadata, path)
+                    future.add_done_callback(lambda done: self._store(path, key, done))
+                    self._pending[path] = future
+        if callback is not None:
+            future.add_done_callback(
+                lambda done: callback(path, done.result()) if done.exception() is None else None)
+        return future
+
+    def _store(self, path, key, future):
+        with self._lock:
+            self._pending.pop(path, None)
+            if future.exception() is not None:
+                logging.error(f"Could not probe {path}: {future.exception()}")
+                return
+            data = future.result()
+            self._entries[path] = (key[0], key[1], data)
+            self._db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                             (path, key[0], key[1], json.dumps(data)))
+            self._db.commit()
@@ -0,0 +1,234 @@
+import bisect
+import itertools
+import threading
+import time
+
+# Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Upper bounds in seconds of the ffmpeg job duration buckets
+JOB_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+# Realtime factor is media seconds transcoded per wall-clock second
+REALTIME_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+# Shards per metric, threads share them round robin
+SHARDS = 16
+
+
+class _Sharded:
+    """Base for metrics whose values are spread over a fixed set of shards.
+
+    Each thread is given one of SHARDS shards the first time it records
+    something, round robin, and only takes that shard's lock, so threads
+    rarely contend. The set is fixed, so a server that starts a thread per
+    request doesn't add a shard per request. A scrape adds them up.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._shards = [([0] * size, threading.Lock()) for _ in range(SHARDS)]
+        self._next = itertools.count()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._shards[next(self._next) % SHARDS]
+            return shard
+
+    def _totals(self):
+        totals = [0] * self._size
+        for values, lock in self._shards:
+            with lock:
+                for i, value in enumerate(values):
+                    totals[i] += value
+        return totals
+
+
+class Counter(_Sharded):
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        values, lock = self._shard()
+        with lock:
+            values[0] += amount
+
+    def dec(self, amount=1):
+        values, lock = self._shard()
+        with lock:
+            values[0] -= amount
+
+    def value(self):
+        return self._totals()[0]
+
+
+class Histogram(_Sharded):
+    """Cumulative histogram with fixed buckets; the last two slots hold the +Inf count and the sum"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        super().__init__(len(self.buckets) + 2)
+
+    def observe(self, value):
+        bucket = bisect.bisect_left(self.buckets, value)
+        values, lock = self._shard()
+        with lock:
+            values[bucket] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        totals = self._totals()
+        cumulative = []
+        running = 0
+        for count in totals[:-1]:
+            running += count
+            cumulative.append(running)
+        return cumulative, totals[-1]
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class _Family:
+    """A metric with a fixed set of label names and one child per label combination"""
+
+    def __init__(self, kind, name, help, labels, factory):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._factory = factory
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        """The child for these label values; keep it around on hot paths"""
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._factory())
+        return child
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} {self.kind}')
+        for values, child in list(self._children.items()):
+            labels = _labels(self.label_names, values)
+            if isinstance(child, Histogram):
+                cumulative, total = child.snapshot()
+                for bound, count in zip(child.buckets + ('+Inf',), cumulative):
+                    bucket_labels = _labels(self.label_names + ('le',), values + (bound,))
+                    lines.append(f'{self.name}_bucket{bucket_labels} {count}')
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {cumulative[-1]}')
+            else:
+                lines.append(f'{self.name}{labels} {child.value()}')
+
+
+class _Callback:
+    """A gauge read from a function at scrape time"""
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.function = function
+
+    def render(self, lines):
+        try:
+            value = self.function()
+        except Exception:
+            return
+        lines.append(f'# HELP {self.name} {self.help}')
+        lines.append(f'# TYPE {self.name} gauge')
+        lines.append(f'{self.name} {value}')
+
+
+class Registry:
+    """Metrics of one app, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, help, labels=()):
+        family = _Family('counter', name, help, labels, Counter)
+        self._metrics.append(family)
+        return family if labels else family.labels()
+
+    def gauge(self, name, help, labels=()):
+        family = _Family('gauge', name, help, labels, Counter)
+        self._metrics.append(family)
+        return family if labels else family.labels()
+
+    def histogram(self, name, help, buckets, labels=()):
+        family = _Family('histogram', name, help, labels, lambda: Histogram(buckets))
+        self._metrics.append(family)
+        return family if labels else family.labels()
+
+    def gauge_function(self, name, help, function):
+        self._metrics.append(_Callback(name, help, function))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+
+class _RouteMetrics:
+    __slots__ = ('latency', 'bytes', 'errors')
+
+    def __init__(self, latency, bytes, errors):
+        self.latency = latency
+        self.bytes = bytes
+        self.errors = errors
+
+
+def instrument(app, registry):
+    """Time every request of a Flask or Quart app and serve `registry` on /metrics.
+
+    Requests are labelled with their URL rule, not the path, so the number
+    of series stays fixed however many movies and segments there are.
+    """
+    if type(app).__module__.split('.')[0] == 'quart':
+        from quart import g, request
+    else:
+        from flask import g, request
+
+    latency = registry.histogram('http_request_duration_seconds', 'Time spent handling requests',
+                                 LATENCY_BUCKETS, ('route',))
+    sent = registry.counter('http_response_bytes_total', 'Bytes in response bodies', ('route',))
+    errors = registry.counter('http_errors_total', 'Responses with a 4xx or 5xx status', ('route',))
+    routes = {}
+
+    def route_metrics(rule):
+        metrics = routes.get(rule)
+        if metrics is None:
+            metrics = routes[rule] = _RouteMetrics(latency.labels(rule), sent.labels(rule), errors.labels(rule))
+        return metrics
+
+    def start_timer():
+        g.request_started = time.perf_counter()
+
+    def record(response):
+        started = getattr(g, 'request_started', None)
+        if started is None:
+            return response
+        metrics = route_metrics(request.url_rule.rule if request.url_rule is not None else 'unmatched')
+        metrics.latency.observe(time.perf_counter() - started)
+        if response.content_length:
+            metrics.bytes.inc(response.content_length)
+        if response.status_code >= 400:
+            metrics.errors.inc()
+        return response
+
+    def serve_metrics():
+        return registry.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+    app.before_request(start_timer)
+    app.after_request(record)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
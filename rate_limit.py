@@ -0,0 +1,128 @@
+import threading
+import time
+
+PLAYBACK = 'playback'
+DOWNLOAD = 'download'
+# Seconds of traffic a bucket may send at once after being idle
+BURST_SECONDS = 2.0
+# Sessions not seen for this long are dropped from the stats
+SESSION_IDLE_SECONDS = 300
+# Seconds between sweeps for idle sessions
+SESSION_PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """Token bucket for `rate` bytes per second, 0 meaning unlimited.
+
+    `reserve` always takes the tokens, letting the bucket go into debt, and
+    returns how long the caller should wait before sending. The whole debt
+    is carried, so a chunk larger than the burst is still charged in full
+    and the rate holds whatever the chunk size. That keeps a
+    reservation a constant-time operation under the lock, and the caller
+    decides whether to sleep in a thread or await in an event loop.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate * BURST_SECONDS
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Take `amount` tokens and return the seconds to wait before using them"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class _SessionUsage:
+    def __init__(self, playback_rate, download_rate):
+        self.buckets = {PLAYBACK: TokenBucket(playback_rate), DOWNLOAD: TokenBucket(download_rate)}
+        self.bytes = {PLAYBACK: 0, DOWNLOAD: 0}
+        self.started = time.time()
+        self.last_seen = self.started
+
+
+class BandwidthShaper:
+    """Per-session rate shaping and byte accounting for playback and downloads.
+
+    Every session has one bucket for playback and one for downloads. When
+    `link_rate` is set, all traffic is also charged to a shared link bucket.
+    Playback is charged without ever waiting on it, while downloads wait
+    for the debt playback leaves behind. On a congested link downloads
+    therefore only get the bandwidth that playback doesn't use.
+    """
+
+    def __init__(self, link_rate=0, playback_rate=0, download_rate=0):
+        self.link = TokenBucket(link_rate)
+        self.playback_rate = playback_rate
+        self.download_rate = download_rate
+        self._sessions = {}
+        self._pruned = time.time()
+        self._lock = threading.Lock()
+
+    def _prune(self, now):
+        """Forget sessions idle for SESSION_IDLE_SECONDS, called with the lock held"""
+        for session_id in [s for s, usage in self._sessions.items()
+                           if now - usage.last_seen > SESSION_IDLE_SECONDS]:
+            del self._sessions[session_id]
+        self._pruned = now
+
+    def _usage(self, session_id):
+        with self._lock:
+            usage = self._sessions.get(session_id)
+            if usage is None:
+                now = time.time()
+                if now - self._pruned > SESSION_PRUNE_INTERVAL:
+                    self._prune(now)
+                usage = self._sessions[session_id] = _SessionUsage(self.playback_rate, self.download_rate)
+            return usage
+
+    def delay_for(self, session_id, kind, amount):
+        """Account `amount` bytes and return the seconds to wait before sending them"""
+        usage = self._usage(session_id)
+        usage.bytes[kind] += amount
+        usage.last_seen = time.time()
+        delay = usage.buckets[kind].reserve(amount)
+        link_delay = self.link.reserve(amount)
+        if kind == DOWNLOAD:
+            delay = max(delay, link_delay)
+        return delay
+
+    def throttle(self, session_id, kind):
+        """A blocking `throttle(amount)` for the chunk loop of a streamed response"""
+        def throttle(amount):
+            delay = self.delay_for(session_id, kind, amount)
+            if delay:
+                time.sleep(delay)
+        return throttle
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            sessions = {
+                session_id: {
+                    'playback_bytes': usage.bytes[PLAYBACK],
+                    'download_bytes': usage.bytes[DOWNLOAD],
+                    'seconds': round(now - usage.started, 1),
+                    'idle_seconds': round(now - usage.last_seen, 1),
+                }
+                for session_id, usage in self._sessions.items()
+            }
+        return {
+            'link_rate': self.link.rate,
+            'playback_rate': self.playback_rate,
+            'download_rate': self.download_rate,
+            'playback_bytes': sum(s['playback_bytes'] for s in sessions.values()),
+            'download_bytes': sum(s['download_bytes'] for s in sessions.values()),
+            'sessions': sessions,
+        }
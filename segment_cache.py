@@ -0,0 +1,82 @@
+"""In-memory cache of HLS playlists and segments for one server process.
+
+The cache is per worker. Hypercorn workers, and servers sharing a
+SHARED_STATE backend, each keep their own copy, so a title hot in every
+worker is held once per worker and each one warms up on its own misses.
+What they do share is the operating system's page cache: a miss is sent
+straight from the file, and the file's pages are then in memory for every
+worker. Size SEGMENT_CACHE_BYTES per worker with that in mind.
+"""
+import threading
+from collections import OrderedDict
+
+
+class SegmentCache:
+    """Byte-bounded LRU cache of HLS files keyed by (movie, filename).
+
+    One instance is shared by every request of a server process. Entries
+    can carry a validator, such as the file's mtime and size, and a lookup
+    with a different validator counts as a miss so rewritten playlists are
+    never served stale.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        # Keep one huge file from flushing the whole cache
+        self.max_item_bytes = max_item_bytes or max_bytes // 8
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, validator=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] != validator:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def contains(self, key, validator=None):
+        """Whether `key` is cached, without counting a hit or a miss"""
+        with self._lock:
+            item = self._items.get(key)
+            return item is not None and item[1] == validator
+
+    def put(self, key, data, validator=None):
+        if len(data) > self.max_item_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[key] = (data, validator)
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, movie):
+        """Drop every cached file of a movie, e.g. after it is re-published"""
+        with self._lock:
+            for key in [key for key in self._items if key[0] == movie]:
+                data, _ = self._items.pop(key)
+                self.size -= len(data)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._items),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
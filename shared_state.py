@@ -0,0 +1,312 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Chat messages kept by the SQLite backend, older ones are deleted
+CHAT_RETAIN = 100000
+# Assumed length of a viewing session before any have been measured
+DEFAULT_HOLD_SECONDS = 600
+# Weight of the newest session in the running average hold time
+HOLD_SMOOTHING = 0.1
+
+
+class LocalState:
+    """State for a server running as a single process, kept in memory.
+
+    Channels are leases that lapse unless renewed within `ttl` seconds.
+    Sessions that find every channel taken wait in a FIFO queue, and keep
+    their place only while they keep asking.
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # session_id -> [acquired, renewed, expires]
+        self._leases = {}
+        # session_id -> last time it asked, in arrival order
+        self._waiting = OrderedDict()
+        self._counters = {}
+        self._average_hold = DEFAULT_HOLD_SECONDS
+
+    def _record_hold(self, seconds):
+        self._average_hold += HOLD_SMOOTHING * (seconds - self._average_hold)
+
+    def acquire_channel(self, session_id, limit, ttl):
+        """Claim or renew a channel lease for a session.
+
+        Returns 0 once the session holds a channel, otherwise its place in
+        the waiting queue, starting at 1.
+        """
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(session_id)
+            if lease is not None and lease[2] > now:
+                lease[1:] = [now, now + ttl]
+                return 0
+            self._reap(now, ttl)
+            self._waiting[session_id] = now
+            free = limit - len(self._leases)
+            place = list(self._waiting).index(session_id) + 1
+            if place > free:
+                return place - free
+            del self._waiting[session_id]
+            self._leases[session_id] = [now, now, now + ttl]
+            return 0
+
+    def renew_channel(self, session_id, ttl):
+        """Extend a session's lease, False if it holds none"""
+        now = time.time()
+        with self._lock:
+            lease = self._leases.get(session_id)
+            if lease is None or lease[2] <= now:
+                return False
+            lease[1:] = [now, now + ttl]
+            return True
+
+    def release_channel(self, session_id):
+        with self._lock:
+            lease = self._leases.pop(session_id, None)
+            if lease is not None:
+                self._record_hold(time.time() - lease[0])
+            self._waiting.pop(session_id, None)
+
+    def reap_channels(self, ttl):
+        """Drop expired leases and waiters that stopped asking, returns the leases freed"""
+        with self._lock:
+            return self._reap(time.time(), ttl)
+
+    def _reap(self, now, ttl):
+        expired = [session_id for session_id, lease in self._leases.items() if lease[2] <= now]
+        for session_id in expired:
+            acquired, renewed, _ = self._leases.pop(session_id)
+            self._record_hold(renewed - acquired)
+        for session_id in [s for s, seen in self._waiting.items() if seen <= now - ttl]:
+            del self._waiting[session_id]
+        return len(expired)
+
+    def channel_count(self):
+        return len(self._leases)
+
+    def waiting_count(self):
+        return len(self._waiting)
+
+    def average_hold(self):
+        """Running average of how long a session keeps its channel, in seconds"""
+        return self._average_hold
+
+    def counter(self, name):
+        return self._counters.get(name, 0)
+
+    def bump(self, name):
+        """Increment a counter and return its new value"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+            return self._counters[name]
+
+    def chat_log(self):
+        """Chat messages are only shared between workers by the SQLite backend"""
+        return None
+
+
+class _SQLiteStore:
+    """One connection per thread to a SQLite file in WAL mode"""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def _db(self):
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            # Autocommit, transactions are opened explicitly where needed
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        """Hold the database's write lock for the whole block"""
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+
+class SQLiteState(_SQLiteStore):
+    """State shared by every worker process on one host through a SQLite file.
+
+    Admission runs in an IMMEDIATE transaction, which takes the database's
+    write lock up front, so two workers can never both claim the last
+    channel or reorder the waiting queue.
+    """
+
+    shared = True
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._db().executescript('''
+            CREATE TABLE IF NOT EXISTS channel_leases (
+                session_id TEXT PRIMARY KEY,
+                acquired REAL NOT NULL,
+                renewed REAL NOT NULL,
+                expires REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS channel_queue (
+                position INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT UNIQUE NOT NULL,
+                seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS counters (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+        ''')
+
+    def acquire_channel(self, session_id, limit, ttl):
+        """Claim or renew a channel lease for a session.
+
+        Returns 0 once the session holds a channel, otherwise its place in
+        the waiting queue, starting at 1.
+        """
+        now = time.time()
+        with self._transaction() as db:
+            if db.execute('UPDATE channel_leases SET renewed = ?, expires = ? WHERE session_id = ? AND expires > ?',
+                          (now, now + ttl, session_id, now)).rowcount:
+                return 0
+            self._reap(db, now, ttl)
+            db.execute('INSERT INTO channel_queue (session_id, seen) VALUES (?, ?) '
+                       'ON CONFLICT(session_id) DO UPDATE SET seen = excluded.seen', (session_id, now))
+            free = limit - db.execute('SELECT COUNT(*) FROM channel_leases').fetchone()[0]
+            place = db.execute('SELECT COUNT(*) FROM channel_queue WHERE position <= '
+                               '(SELECT position FROM channel_queue WHERE session_id = ?)',
+                               (session_id,)).fetchone()[0]
+            if place > free:
+                return place - free
+            db.execute('DELETE FROM channel_queue WHERE session_id = ?', (session_id,))
+            db.execute('INSERT INTO channel_leases VALUES (?, ?, ?, ?)', (session_id, now, now, now + ttl))
+            return 0
+
+    def renew_channel(self, session_id, ttl):
+        """Extend a session's lease, False if it holds none"""
+        now = time.time()
+        return self._db().execute(
+            'UPDATE channel_leases SET renewed = ?, expires = ? WHERE session_id = ? AND expires > ?',
+            (now, now + ttl, session_id, now)).rowcount > 0
+
+    def release_channel(self, session_id):
+        with self._transaction() as db:
+            row = db.execute('DELETE FROM channel_leases WHERE session_id = ? RETURNING acquired',
+                             (session_id,)).fetchone()
+            if row is not None:
+                self._record_hold(db, time.time() - row[0])
+            db.execute('DELETE FROM channel_queue WHERE session_id = ?', (session_id,))
+
+    def reap_channels(self, ttl):
+        """Drop expired leases and waiters that stopped asking, returns the leases freed"""
+        with self._transaction() as db:
+            return self._reap(db, time.time(), ttl)
+
+    def _reap(self, db, now, ttl):
+        expired = db.execute('DELETE FROM channel_leases WHERE expires <= ? RETURNING acquired, renewed',
+                             (now,)).fetchall()
+        for acquired, renewed in expired:
+            self._record_hold(db, renewed - acquired)
+        db.execute('DELETE FROM channel_queue WHERE seen <= ?', (now - ttl,))
+        return len(expired)
+
+    def _record_hold(self, db, seconds):
+        average = self._counter(db, 'average_hold') or DEFAULT_HOLD_SECONDS
+        average += HOLD_SMOOTHING * (seconds - average)
+        db.execute('INSERT OR REPLACE INTO counters VALUES (?, ?)', ('average_hold', round(average)))
+
+    def channel_count(self):
+        return self._db().execute('SELECT COUNT(*) FROM channel_leases').fetchone()[0]
+
+    def waiting_count(self):
+        return self._db().execute('SELECT COUNT(*) FROM channel_queue').fetchone()[0]
+
+    def average_hold(self):
+        """Running average of how long a session keeps its channel, in seconds"""
+        return self.counter('average_hold') or DEFAULT_HOLD_SECONDS
+
+    @staticmethod
+    def _counter(db, name):
+        row = db.execute('SELECT value FROM counters WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else 0
+
+    def counter(self, name):
+        return self._counter(self._db(), name)
+
+    def bump(self, name):
+        """Increment a counter and return its new value"""
+        return self._db().execute(
+            'INSERT INTO counters VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET value = value + 1 '
+            'RETURNING value', (name,)).fetchone()[0]
+
+    def chat_log(self):
+        return SQLiteChatLog(self.path)
+
+
+class SQLiteChatLog(_SQLiteStore):
+    """Chat history in the shared state database.
+
+    Has the same reading interface as ChatLog, but `append` also assigns
+    the message its id, so ids stay unique and ordered across workers.
+    """
+
+    def __init__(self, path, retain=CHAT_RETAIN):
+        super().__init__(path)
+        self.retain = retain
+        self._db().execute('''
+            CREATE TABLE IF NOT EXISTS chat (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                data TEXT NOT NULL
+            )
+        ''')
+
+    @staticmethod
+    def _message(row):
+        message = json.loads(row[1])
+        message['id'] = row[0]
+        return message
+
+    def append(self, message):
+        data = json.dumps({key: value for key, value in message.items() if key != 'id'})
+        message['id'] = self._db().execute('INSERT INTO chat (data) VALUES (?)', (data,)).lastrowid
+        if message['id'] % 1000 == 0:
+            self._db().execute('DELETE FROM chat WHERE id <= ?', (message['id'] - self.retain,))
+        return message
+
+    def tail(self, count):
+        rows = self._db().execute('SELECT id, data FROM chat ORDER BY id DESC LIMIT ?', (count,)).fetchall()
+        return [self._message(row) for row in reversed(rows)]
+
+    def before(self, message_id, count):
+        rows = self._db().execute('SELECT id, data FROM chat WHERE id < ? ORDER BY id DESC LIMIT ?',
+                                  (message_id, count)).fetchall()
+        return [self._message(row) for row in reversed(rows)]
+
+    def after(self, message_id, count):
+        rows = self._db().execute('SELECT id, data FROM chat WHERE id > ? ORDER BY id LIMIT ?',
+                                  (message_id, count)).fetchall()
+        return [self._message(row) for row in rows]
+
+
+def open_state(url):
+    """Backend for a SHARED_STATE setting, 'memory' or 'sqlite:///path/to/state.sqlite3'"""
+    if url == 'memory':
+        return LocalState()
+    if url.startswith('sqlite:///'):
+        return SQLiteState(url[len('sqlite:///'):])
+    raise ValueError(f"Unknown shared state backend: {url}")
@@ -0,0 +1,238 @@
+// Theme Management
+function toggleTheme() {
+    const html = document.documentElement;
+    const themeIcon = document.getElementById('theme-icon');
+    const isDark = html.getAttribute('data-theme') === 'dark';
+
+    html.setAttribute('data-theme', isDark ? 'light' : 'dark');
+    themeIcon.textContent = isDark ? '🌙' : '☀️';
+    localStorage.setItem('theme', isDark ? 'light' : 'dark');
+}
+
+// Initialize theme
+const savedTheme = localStorage.getItem('theme') || 'light';
+document.documentElement.setAttribute('data-theme', savedTheme);
+document.getElementById('theme-icon').textContent = savedTheme === 'dark' ? '☀️' : '🌙';
+
+// Video Controls
+let videoElement = document.getElementById('video-player');
+let videoTitleElement = document.getElementById('video-title');
+let videoDurationElement = document.getElementById('video-duration');
+let currentVideoIndex = Number(document.body.dataset.videoIndex);
+
+videoElement.onended = function() {
+    handleVideoTransition('/next-video');
+};
+
+function playVideo(videoName) {
+    handleVideoTransition(`/set-video/${videoName}`);
+}
+
+function skipVideo() {
+    handleVideoTransition('/next-video?skip=true');
+}
+
+function shuffleVideos() {
+    fetch('/shuffle-videos')
+        .then(response => response.json())
+        .then(data => {
+            currentVideoIndex = 0;
+            if (data.next_video_url) updatePlayer(data);
+            location.reload();
+        });
+}
+
+function togglePlayPause() {
+    videoElement.paused ? videoElement.play() : videoElement.pause();
+}
+
+function handleVideoTransition(url) {
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            // An emptied library answers with an error and nothing to play
+            if (data.next_video_url) updatePlayer(data);
+        });
+}
+
+function updatePlayer(data) {
+    currentVideoIndex = data.index;
+    videoTitleElement.textContent = data.video_title;
+    videoDurationElement.textContent = data.video_duration;
+    videoElement.src = data.next_video_url;
+    videoElement.play();
+}
+
+// The list is cached by the server until the library changes, and revalidated with its ETag,
+// so checking it for new uploads costs a 304 while nothing changed
+let videoListHtml = null;
+
+function loadVideoList() {
+    const videoList = document.getElementById('video-list');
+    fetch(videoList.dataset.src)
+        .then(response => response.text())
+        .then(html => {
+            if (html === videoListHtml) return;
+            videoListHtml = html;
+            videoList.querySelectorAll('.video-item').forEach(item => item.remove());
+            videoList.insertAdjacentHTML('beforeend', html);
+        });
+}
+
+loadVideoList();
+setInterval(loadVideoList, Number(document.getElementById('video-list').dataset.refresh) * 1000);
+
+// Chat Controls
+function setUsername() {
+    const usernameInput = document.getElementById('username-input');
+    const feedback = document.getElementById('username-feedback');
+    const username = usernameInput.value.trim();
+
+    if (!username) {
+        feedback.textContent = 'Please enter a username';
+        feedback.style.color = 'red';
+        return;
+    }
+
+    fetch('/set-username', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ username: username })
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.status === 'success') {
+            document.getElementById('username-prompt-section').style.display = 'none';
+            document.getElementById('chat-messages').style.display = 'block';
+            document.getElementById('chat-input').style.display = 'flex';
+            feedback.textContent = '✅ Registered';
+            feedback.style.color = 'green';
+            loadMessages().then(startMessageStream);
+        } else {
+            feedback.textContent = data.message;
+            feedback.style.color = 'red';
+        }
+    });
+}
+
+function sendMessage() {
+    const chatInput = document.getElementById('chat-input');
+    const message = chatInput.value.trim();
+
+    if (message) {
+        fetch('/send-message', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ message: message })
+        })
+        .then(response => {
+            if (!response.ok) throw new Error('Message send failed');
+            chatInput.value = '';
+        })
+        .catch(error => console.error('Error:', error));
+    }
+}
+
+let lastMessageId = 0;
+let prevCursor = null;
+let loadingOlder = false;
+let chatStarted = false;
+
+function renderMessage(msg) {
+    const div = document.createElement('div');
+    div.className = 'chat-message';
+    const name = document.createElement('strong');
+    name.textContent = msg.username;
+    const time = document.createElement('small');
+    time.textContent = msg.timestamp;
+    div.append(name, ' ', time, document.createElement('br'), msg.message);
+    return div;
+}
+
+function appendMessages(messages) {
+    const chatMessages = document.getElementById('chat-messages');
+    messages.forEach(msg => {
+        if (msg.id <= lastMessageId) return;
+        lastMessageId = msg.id;
+        chatMessages.appendChild(renderMessage(msg));
+    });
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+function loadMessages() {
+    return fetch('/get-messages')
+        .then(response => response.json())
+        .then(data => {
+            prevCursor = data.prev_cursor;
+            appendMessages(data.messages);
+        });
+}
+
+function loadOlderMessages() {
+    if (prevCursor === null || loadingOlder) return;
+    loadingOlder = true;
+    fetch(`/get-messages?before=${prevCursor}`)
+        .then(response => response.json())
+        .then(data => {
+            const chatMessages = document.getElementById('chat-messages');
+            const height = chatMessages.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => fragment.appendChild(renderMessage(msg)));
+            chatMessages.insertBefore(fragment, chatMessages.firstChild);
+            // Keep the messages the user was reading in place
+            chatMessages.scrollTop += chatMessages.scrollHeight - height;
+            prevCursor = data.prev_cursor;
+        })
+        .finally(() => { loadingOlder = false; });
+}
+
+function pollMessages() {
+    fetch(`/get-messages?since=${lastMessageId}&wait=25`)
+        .then(response => response.json())
+        .then(data => {
+            appendMessages(data.messages);
+            pollMessages();
+        })
+        .catch(() => setTimeout(pollMessages, 3000));
+}
+
+function startMessageStream() {
+    if (chatStarted) return;
+    chatStarted = true;
+    if (window.EventSource) {
+        // Only new messages are pushed, the browser reconnects on its own
+        const source = new EventSource(`/chat-stream?since=${lastMessageId}`);
+        source.onmessage = event => appendMessages([JSON.parse(event.data)]);
+    } else {
+        pollMessages();
+    }
+}
+
+// Event Listeners
+document.getElementById('chat-input').addEventListener('keypress', function(event) {
+    if (event.key === 'Enter') sendMessage();
+});
+
+document.getElementById('chat-messages').addEventListener('scroll', function() {
+    if (this.scrollTop === 0) loadOlderMessages();
+});
+
+document.getElementById('chat-hover-box').addEventListener('click', toggleChat);
+document.getElementById('theme-toggle').addEventListener('click', toggleTheme);
+
+// Initialize chat state
+if (document.body.dataset.usernameSet === 'true') {
+    loadMessages().then(startMessageStream);
+}
+
+function toggleChat() {
+    const chatSidebar = document.getElementById('chat-sidebar');
+    const mainContainer = document.getElementById('main-container');
+    const chatHoverBox = document.getElementById('chat-hover-box');
+    const themeToggle = document.getElementById('theme-toggle');
+
+    chatSidebar.classList.toggle('open');
+    mainContainer.classList.toggle('shifted');
+    chatHoverBox.classList.toggle('shifted');
+    themeToggle.classList.toggle('shifted');
+}
@@ -0,0 +1,67 @@
+const videoPlayer = document.getElementById('video-player');
+const videoSource = document.getElementById('video-source');
+const videoTitleElement = document.getElementById('video-title');
+const videoDurationElement = document.getElementById('video-duration');
+const catalogElement = document.getElementById('catalog');
+let hls = null;
+
+function initializeHls() {
+    if (Hls.isSupported()) {
+        if (hls) hls.destroy();
+        hls = new Hls();
+        hls.loadSource(videoSource.src);
+        hls.attachMedia(videoPlayer);
+        hls.on(Hls.Events.MANIFEST_PARSED, () => videoPlayer.play());
+    } else if (videoPlayer.canPlayType('application/vnd.apple.mpegurl')) {
+        videoPlayer.src = videoSource.src;
+        videoPlayer.addEventListener('loadedmetadata', () => videoPlayer.play());
+    }
+}
+
+function switchVideo(url) {
+    fetch(url)
+        .then(response => response.json())
+        .then(data => {
+            videoSource.src = data.next_video_url;
+            videoPlayer.load();
+            initializeHls();
+            videoTitleElement.innerText = data.video_title;
+            videoDurationElement.innerText = data.video_duration;
+        });
+}
+
+function playMovie(movie) {
+    switchVideo(`/set-video/${encodeURIComponent(movie)}`);
+}
+
+function togglePlayPause() {
+    if (videoPlayer.paused) {
+        videoPlayer.play();
+    } else {
+        videoPlayer.pause();
+    }
+}
+
+// The list is cached by the server until the library changes, and revalidated with its ETag
+function loadCatalog() {
+    fetch(catalogElement.dataset.src)
+        .then(response => response.text())
+        .then(html => { catalogElement.innerHTML = html; });
+}
+
+catalogElement.addEventListener('click', event => {
+    const item = event.target.closest('.movie-item');
+    if (item) playMovie(item.dataset.movie);
+});
+document.getElementById('skip-button').addEventListener('click', () => switchVideo('/next-video'));
+document.getElementById('shuffle-button').addEventListener('click', () => switchVideo('/shuffle-videos'));
+document.getElementById('play-pause-button').addEventListener('click', togglePlayPause);
+
+window.addEventListener('load', () => {
+    loadCatalog();
+    playMovie(videoTitleElement.textContent.trim());
+});
+
+// Keep the channel while paused, and hand it back as soon as the page closes
+setInterval(() => fetch('/heartbeat', { method: 'POST' }), document.body.dataset.heartbeat * 1000);
+window.addEventListener('pagehide', () => navigator.sendBeacon('/leave'));
@@ -0,0 +1,70 @@
+let videoElement = document.getElementById('video-player');
+let videoTitleElement = document.getElementById('video-title');
+let videoDurationElement = document.getElementById('video-duration');
+let currentVideoIndex = Number(document.body.dataset.videoIndex);
+
+videoElement.onended = function() {
+    fetch('/next-video')
+        .then(response => response.json())
+        .then(data => {
+            currentVideoIndex = data.index;
+            videoTitleElement.innerText = data.video_title;
+            videoDurationElement.innerText = data.video_duration;
+            videoElement.src = data.next_video_url;
+            videoElement.play();
+        });
+}
+
+function playVideo(videoName) {
+    fetch('/set-video/' + videoName)
+        .then(response => response.json())
+        .then(data => {
+            currentVideoIndex = data.index;
+            videoTitleElement.innerText = data.video_title;
+            videoDurationElement.innerText = data.video_duration;
+            videoElement.src = data.next_video_url;
+            videoElement.play();
+        });
+}
+
+function skipVideo() {
+    fetch('/next-video?skip=true')
+        .then(response => response.json())
+        .then(data => {
+            currentVideoIndex = data.index;
+            videoTitleElement.innerText = data.video_title;
+            videoDurationElement.innerText = data.video_duration;
+            videoElement.src = data.next_video_url;
+            videoElement.play();
+        });
+}
+
+function shuffleVideos() {
+    fetch('/shuffle-videos')
+        .then(response => response.json())
+        .then(data => {
+            currentVideoIndex = 0;
+            videoTitleElement.innerText = data.video_title;
+            videoDurationElement.innerText = data.video_duration;
+            videoElement.src = data.next_video_url;
+            videoElement.play();
+        });
+}
+
+// The list is cached by the server until the library changes, and revalidated with its ETag
+function loadVideoList() {
+    const videoList = document.getElementById('video-list');
+    fetch(videoList.dataset.src)
+        .then(response => response.text())
+        .then(html => videoList.insertAdjacentHTML('beforeend', html));
+}
+
+function togglePlayPause() {
+    if (videoElement.paused) {
+        videoElement.play();
+    } else {
+        videoElement.pause();
+    }
+}
+
+loadVideoList();
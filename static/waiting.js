@@ -0,0 +1,13 @@
+function checkQueue() {
+    fetch('/queue-status')
+        .then(response => response.json())
+        .then(data => {
+            if (data.place === 0) {
+                location.reload();
+                return;
+            }
+            document.getElementById('place').innerText = data.place;
+            document.getElementById('eta').innerText = `${Math.floor(data.eta / 60)} min ${data.eta % 60} s`;
+        });
+}
+setInterval(checkQueue, 5000);
@@ -0,0 +1,108 @@
+import hashlib
+import os
+import threading
+
+from compression import ENCODINGS, compress, negotiate
+
+# Fingerprinted URLs change whenever the file does, so browsers may keep them for a year
+ASSET_MAX_AGE = 365 * 24 * 3600
+
+
+class AssetFingerprints:
+    """Content hashes of the files in a static folder.
+
+    A hash is recomputed only when the file's size or mtime changes, so
+    looking one up while rendering a page costs a stat.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def digest(self, filename):
+        path = os.path.join(self.folder, filename)
+        stat = os.stat(path)
+        validator = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(filename)
+        if cached is not None and cached[0] == validator:
+            return cached[1]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        with self._lock:
+            self._digests[filename] = (validator, digest)
+        return digest
+
+
+def fingerprint_static(app):
+    """Give a Flask or Quart app's static files cache-busting URLs.
+
+    Templates call `asset_url('player.js')` for `/static/player.js?v=<hash>`.
+    Responses to versioned URLs may be cached for a year, since an edited
+    file gets a new URL; unversioned ones keep the framework's default.
+    """
+    if type(app).__module__.split('.')[0] == 'quart':
+        from quart import request, url_for
+    else:
+        from flask import request, url_for
+
+    fingerprints = AssetFingerprints(app.static_folder)
+
+    def asset_url(filename):
+        return url_for('static', filename=filename, v=fingerprints.digest(filename))
+
+    def cache_versioned(response):
+        if request.endpoint == 'static' and 'v' in request.args and response.status_code in (200, 304):
+            response.headers['Cache-Control'] = f'public, max-age={ASSET_MAX_AGE}, immutable'
+        return response
+
+    app.add_template_global(asset_url)
+    app.after_request(cache_versioned)
+    return fingerprints
+
+
+class _Fragment:
+    def __init__(self, version, html):
+        body = html.encode('utf-8')
+        self.etag = f'"{version}-{hashlib.sha256(body).hexdigest()[:16]}"'
+        self.bodies = {None: body}
+        for encoding in ENCODINGS:
+            self.bodies[encoding] = compress(body, encoding)
+
+    def respond(self, headers):
+        """A (body, status, headers) response, 304 if the client has this version"""
+        response_headers = {
+            'Content-Type': 'text/html; charset=utf-8',
+            'Cache-Control': 'no-cache',
+            'ETag': self.etag,
+            'Vary': 'Accept-Encoding',
+        }
+        if self.etag in headers.get('If-None-Match', ''):
+            return '', 304, response_headers
+        encoding = negotiate(headers.get('Accept-Encoding'))
+        if encoding is not None:
+            response_headers['Content-Encoding'] = encoding
+        return self.bodies[encoding], 200, response_headers
+
+
+class FragmentCache:
+    """A rendered piece of HTML kept, with its compressed copies, until its version changes.
+
+    Rendering and compressing at the highest levels happens once per
+    version rather than once per request. Clients revalidate with the
+    ETag, so a repeat visit to an unchanged library gets a bare 304.
+    """
+
+    def __init__(self):
+        # (version, fragment), swapped as a whole so readers never see a mix
+        self._entry = (None, None)
+
+    def get(self, version):
+        """The cached fragment if it was rendered for `version`, else None"""
+        cached_version, fragment = self._entry
+        return fragment if cached_version == version else None
+
+    def put(self, version, html):
+        fragment = _Fragment(version, html)
+        self._entry = (version, fragment)
+        return fragment
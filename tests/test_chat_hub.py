@@ -0,0 +1,31 @@
+from chat_hub import ChatHub
+from chat_log import ChatLog
+
+
+def make_log(path, ids):
+    log = ChatLog(str(path), sync_interval=60, retain=5)
+    for message_id in ids:
+        log.append({'id': message_id, 'username': 'viewer', 'message': str(message_id)})
+    return log
+
+
+def test_older_pages_after_compaction_stop_at_the_cursor(tmp_path):
+    log = make_log(tmp_path / 'chat.jsonl', range(1, 101))
+    log.compact()
+    hub = ChatHub(log.tail(3), log, size=3)
+    hub.publish({'username': 'viewer', 'message': 'new'})
+
+    page = hub.before(98, 10)
+    assert [message['id'] for message in page] == [96, 97]
+    # Nothing older is left, and the page before it must not repeat newer messages
+    assert hub.before(96, 10) == []
+    log.close()
+
+
+def test_older_pages_from_the_log(tmp_path):
+    log = make_log(tmp_path / 'chat.jsonl', range(1, 21))
+    hub = ChatHub(log.tail(3), log, size=3)
+
+    assert [message['id'] for message in hub.before(10, 4)] == [6, 7, 8, 9]
+    assert [message['id'] for message in hub.latest(2)] == [19, 20]
+    log.close()
@@ -0,0 +1,37 @@
+from chunked_transcode import plan_chunks
+from jit_packager import copy_cut_points
+
+
+def test_chunks_start_on_the_last_keyframe_before_each_target():
+    keyframes = [float(second) for second in range(0, 600, 50)]
+    assert plan_chunks(keyframes, 600, 120) == [0.0, 100.0, 200.0, 350.0, 450.0]
+
+
+def test_chunks_without_keyframes_are_cut_evenly():
+    assert plan_chunks([], 300, 120) == [0.0, 150.0]
+
+
+def test_keyframes_too_far_apart_give_fewer_chunks():
+    # Each target's keyframe would leave a chunk under half the target
+    assert plan_chunks([0.0, 500.0], 600, 120) == [0.0]
+    assert plan_chunks([0.0, 70.0], 600, 120) == [0.0, 70.0]
+
+
+def test_a_short_source_is_one_chunk():
+    assert plan_chunks([0.0, 10.0, 20.0], 50, 120) == [0.0]
+
+
+def test_copy_cuts_on_keyframes_at_least_the_target_apart():
+    keyframes = [second / 2 for second in range(20)]
+    assert copy_cut_points(keyframes, 10, 2) == [0.0, 2.0, 4.0, 6.0, 8.0]
+
+
+def test_a_short_tail_joins_the_segment_before_it():
+    keyframes = [0.0, 2.0, 4.0, 6.0, 8.0, 10.0]
+    assert copy_cut_points(keyframes, 10.3, 2) == [0.0, 2.0, 4.0, 6.0, 8.0]
+
+
+def test_sparse_keyframes_cannot_be_copied():
+    # Average gap of 10 seconds, but one of them is 15
+    assert copy_cut_points([0.0, 15.0], 20, 2) is None
+    assert copy_cut_points([], 30, 2) is None
@@ -0,0 +1,83 @@
+import importlib
+import json
+import os
+
+import pytest
+
+from hls_playlist import write_media_playlist
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    root = tmp_path_factory.mktemp('server')
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv('HLS_FOLDER', str(root / 'hls'))
+        env.setenv('VIDEO_FOLDER', str(root / 'uploads'))
+        env.setenv('ENCODING_PROFILE', 'fast-ingest')
+        return importlib.import_module('Hls_based')
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'movie.mp4'
+    path.write_bytes(b'source')
+    return str(path)
+
+
+def stage_segments(directory, count, playlist='progress.m3u8'):
+    os.makedirs(directory, exist_ok=True)
+    segments = []
+    for number in range(count):
+        uri = f'segment{number:03d}.ts'
+        with open(os.path.join(directory, uri), 'wb') as f:
+            f.write(b'ts')
+        segments.append({'uri': uri, 'duration': 2.0})
+    write_media_playlist(os.path.join(directory, playlist), segments, ended=False)
+    return segments
+
+
+def test_segments_of_an_interrupted_run_are_kept(server, tmp_path, source):
+    staging = str(tmp_path / 'staging')
+    # The manifest is started before ffmpeg runs
+    server.load_manifest(staging, source, [''])
+    stage_segments(staging, 3)
+    # Being written when the run was interrupted
+    with open(os.path.join(staging, 'segment003.ts'), 'wb') as f:
+        f.write(b't')
+
+    manifest = server.load_manifest(staging, source, [''])
+    assert [segment['uri'] for segment in manifest['variants']['']] == [
+        'segment000.ts', 'segment001.ts', 'segment002.ts']
+    assert not os.path.exists(os.path.join(staging, 'segment003.ts'))
+
+    # A second interruption adds to them, the first new segment after a discontinuity
+    stage_segments(staging, 5)
+    manifest = server.load_manifest(staging, source, [''])
+    assert [segment.get('discontinuity', False) for segment in manifest['variants']['']] == [
+        False, False, False, True, False]
+    with open(os.path.join(staging, 'manifest.json')) as f:
+        assert json.load(f) == manifest
+
+
+def test_renditions_are_cut_back_to_the_segments_they_all_have(server, tmp_path, source):
+    staging = str(tmp_path / 'staging')
+    server.load_manifest(staging, source, ['720p', '360p'])
+    stage_segments(os.path.join(staging, '720p'), 4)
+    stage_segments(os.path.join(staging, '360p'), 2)
+    manifest = server.load_manifest(staging, source, ['720p', '360p'])
+    assert [len(manifest['variants'][variant]) for variant in ('720p', '360p')] == [2, 2]
+    assert sorted(os.listdir(os.path.join(staging, '720p'))) == [
+        'progress.m3u8', 'segment000.ts', 'segment001.ts']
+
+
+def test_a_replaced_source_starts_over(server, tmp_path, source):
+    staging = str(tmp_path / 'staging')
+    server.load_manifest(staging, source, [''])
+    stage_segments(staging, 3)
+    assert len(server.load_manifest(staging, source, [''])['variants']['']) == 3
+    with open(source, 'ab') as f:
+        f.write(b' replaced')
+    manifest = server.load_manifest(staging, source, [''])
+    assert manifest['variants'][''] == []
+    assert manifest['source']['size'] == len(b'source replaced')
+    assert not os.path.exists(os.path.join(staging, 'segment000.ts'))
@@ -0,0 +1,22 @@
+from encoding_profiles import ProfileScheduler, load_profiles
+
+
+def make_scheduler(speeds):
+    profiles = load_profiles(None)
+    profiles['turbo'] = dict(profiles['fast-ingest'], preset='superfast')
+    calibration = {'profiles': {name: {'realtime_factor': speed} for name, speed in speeds.items()}}
+    return ProfileScheduler(profiles, workers=1, calibration=calibration)
+
+
+def test_a_custom_profile_is_ranked_by_its_measured_speed():
+    scheduler = make_scheduler({'turbo': 20.0, 'fast-ingest': 8.0, 'balanced': 3.0, 'archival': 0.5})
+    # Nothing to keep up with, so the slowest profile wins
+    assert scheduler.choose(0) == 'archival'
+    # More than any profile manages, so the fastest one, defined last
+    assert scheduler.choose(1000 * 12 * 3600) == 'turbo'
+
+
+def test_the_slowest_profile_that_keeps_up_is_chosen():
+    scheduler = make_scheduler({'turbo': 20.0, 'fast-ingest': 8.0, 'balanced': 3.0, 'archival': 0.5})
+    # A backlog of 5 seconds per second of horizon
+    assert scheduler.choose(5 * 12 * 3600) == 'fast-ingest'
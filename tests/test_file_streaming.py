@@ -0,0 +1,85 @@
+from flask import Flask
+from werkzeug.http import http_date
+
+from file_streaming import MAX_RANGES, if_range_matches, parse_byte_ranges, send_media
+
+app = Flask(__name__)
+
+
+def test_single_and_open_ended_ranges():
+    assert parse_byte_ranges('bytes=0-99', 1000) == [(0, 100)]
+    assert parse_byte_ranges('bytes=900-', 1000) == [(900, 1000)]
+    # An end past the file is clamped to its size
+    assert parse_byte_ranges('bytes=500-5000', 1000) == [(500, 1000)]
+
+
+def test_overlapping_and_adjacent_ranges_are_merged_in_order():
+    assert parse_byte_ranges('bytes=500-599, 0-99, 50-149, 150-199', 1000) == [(0, 200), (500, 600)]
+
+
+def test_suffix_ranges():
+    assert parse_byte_ranges('bytes=-100', 1000) == [(900, 1000)]
+    # A suffix longer than the file is the whole file
+    assert parse_byte_ranges('bytes=-5000', 1000) == [(0, 1000)]
+    assert parse_byte_ranges('bytes=0-9,-10', 1000) == [(0, 10), (990, 1000)]
+
+
+def test_unsatisfiable_ranges_give_an_empty_list():
+    assert parse_byte_ranges('bytes=1000-1099', 1000) == []
+    assert parse_byte_ranges('bytes=-0', 1000) == []
+    # Only the satisfiable ones are kept
+    assert parse_byte_ranges('bytes=2000-, 0-9', 1000) == [(0, 10)]
+
+
+def test_malformed_headers_are_ignored():
+    for header in ['', 'items=0-9', 'bytes=9-0', 'bytes=a-b', 'bytes=10']:
+        assert parse_byte_ranges(header, 1000) is None
+    too_many = ','.join(f'{n * 10}-{n * 10 + 1}' for n in range(MAX_RANGES + 1))
+    assert parse_byte_ranges('bytes=' + too_many, 1000) is None
+
+
+def test_if_range():
+    etag, mtime = '"3e8-1"', 1700000000
+    with app.test_request_context():
+        assert if_range_matches(etag, mtime)
+    with app.test_request_context(headers={'If-Range': etag}):
+        assert if_range_matches(etag, mtime)
+    with app.test_request_context(headers={'If-Range': '"3e8-2"'}):
+        assert not if_range_matches(etag, mtime)
+    # If-Range needs a strong match
+    with app.test_request_context(headers={'If-Range': 'W/' + etag}):
+        assert not if_range_matches(etag, mtime)
+    with app.test_request_context(headers={'If-Range': http_date(mtime)}):
+        assert if_range_matches(etag, mtime)
+    with app.test_request_context(headers={'If-Range': http_date(mtime - 60)}):
+        assert not if_range_matches(etag, mtime)
+
+
+def test_send_media_ranges(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(bytes(range(256)) * 4)
+    with app.test_request_context(headers={'Range': 'bytes=2000-'}):
+        response = send_media(str(path))
+        assert response.status_code == 416
+        assert response.headers['Content-Range'] == 'bytes */1024'
+    with app.test_request_context(headers={'Range': 'bytes=-4'}):
+        response = send_media(str(path))
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 1020-1023/1024'
+        assert b''.join(response.response) == bytes([252, 253, 254, 255])
+    with app.test_request_context(headers={'Range': 'bytes=0-1, 10-11'}):
+        response = send_media(str(path))
+        assert response.status_code == 206
+        body = b''.join(response.response)
+        assert response.content_length == len(body)
+        assert b'Content-Range: bytes 0-1/1024\r\n\r\n\x00\x01' in body
+        assert b'Content-Range: bytes 10-11/1024\r\n\r\n\x0a\x0b' in body
+
+
+def test_a_stale_if_range_sends_the_whole_file(tmp_path):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'x' * 100)
+    with app.test_request_context(headers={'Range': 'bytes=0-9', 'If-Range': '"stale"'}):
+        response = send_media(str(path))
+        assert response.status_code == 200
+        assert response.content_length == 100
@@ -0,0 +1,52 @@
+import os
+import queue
+import time
+
+from fs_watcher import UploadWatcher
+
+
+def test_a_file_rewritten_in_place_is_reported_again(tmp_path):
+    path = tmp_path / 'movie.mp4'
+    path.write_bytes(b'first version')
+    (tmp_path / 'notes.txt').write_bytes(b'ignored')
+    events = queue.Queue()
+    watcher = UploadWatcher(str(tmp_path), lambda name: events.put(('ready', name)),
+                            lambda name: events.put(('removed', name)),
+                            settle=0.1, interval=0.05, extensions=('.mp4',), sweep=0.2)
+    watcher.start()
+    try:
+        # Already there when the watcher starts, so only a change reports it
+        folder_mtime = os.stat(tmp_path).st_mtime_ns
+        time.sleep(0.1)
+        with open(path, 'r+b') as f:
+            f.write(b'second')
+        # Nothing was created, renamed or deleted
+        assert os.stat(tmp_path).st_mtime_ns == folder_mtime
+        assert events.get(timeout=5) == ('ready', 'movie.mp4')
+
+        path.unlink()
+        assert events.get(timeout=5) == ('removed', 'movie.mp4')
+        assert events.empty()
+    finally:
+        watcher.stop()
+
+
+def test_a_new_upload_is_reported_once_it_settles(tmp_path):
+    events = queue.Queue()
+    watcher = UploadWatcher(str(tmp_path), lambda name: events.put(('ready', name)),
+                            lambda name: events.put(('removed', name)),
+                            settle=0.3, interval=0.05, extensions=('.mp4',))
+    watcher.start()
+    try:
+        with open(tmp_path / 'movie.mp4', 'wb') as f:
+            for _ in range(3):
+                f.write(b'chunk')
+                f.flush()
+                time.sleep(0.1)
+        started = time.monotonic()
+        assert events.get(timeout=5) == ('ready', 'movie.mp4')
+        assert time.monotonic() - started >= 0.1
+        time.sleep(0.5)
+        assert events.empty()
+    finally:
+        watcher.stop()
@@ -0,0 +1,53 @@
+import pytest
+
+import rate_limit
+from rate_limit import DOWNLOAD, PLAYBACK, BandwidthShaper, TokenBucket
+
+
+class Clock:
+    """Stands in for the time module, advancing only when told to"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_a_slow_bucket_meters_its_rate_with_chunks_larger_than_the_burst(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    bucket = TokenBucket(1000)
+    started = clock.now
+    sent = 0
+    for _ in range(20):
+        clock.sleep(bucket.reserve(8192))
+        sent += 8192
+    # Only the initial burst goes out ahead of the rate
+    assert abs((sent - bucket.burst) / (clock.now - started) - 1000) < 1
+
+
+def test_downloads_wait_for_all_of_the_link_playback_used(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    shaper = BandwidthShaper(link_rate=1000)
+    for _ in range(5):
+        assert shaper.delay_for('viewer', PLAYBACK, 8192) == 0
+    delay = shaper.delay_for('downloader', DOWNLOAD, 1000)
+    assert delay == pytest.approx((5 * 8192 + 1000 - 2000) / 1000)
+    clock.sleep(delay)
+    # Once that is paid off, the link is the download's at its rate
+    assert shaper.delay_for('downloader', DOWNLOAD, 1000) == pytest.approx(1)
+
+
+def test_unlimited_buckets_never_wait(monkeypatch):
+    monkeypatch.setattr(rate_limit, 'time', Clock())
+    shaper = BandwidthShaper()
+    assert shaper.delay_for('viewer', DOWNLOAD, 10 ** 9) == 0
+    assert shaper.stats()['download_bytes'] == 10 ** 9
@@ -0,0 +1,50 @@
+import time
+
+import pytest
+
+from shared_state import open_state
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def state(request, tmp_path):
+    if request.param == 'memory':
+        return open_state('memory')
+    return open_state(f"sqlite:///{tmp_path / 'state.sqlite3'}")
+
+
+def test_waiting_sessions_are_admitted_in_arrival_order(state):
+    places = [state.acquire_channel(session, 2, 60) for session in 'abcde']
+    assert places == [0, 0, 1, 2, 3]
+    # Asking again keeps a session's place
+    assert state.acquire_channel('d', 2, 60) == 2
+
+    state.release_channel('a')
+    # A channel is free, but c arrived first
+    assert state.acquire_channel('e', 2, 60) == 2
+    assert state.acquire_channel('d', 2, 60) == 1
+    assert state.acquire_channel('c', 2, 60) == 0
+    assert state.acquire_channel('d', 2, 60) == 1
+
+    state.release_channel('b')
+    assert state.acquire_channel('e', 2, 60) == 1
+    assert state.acquire_channel('d', 2, 60) == 0
+    assert state.acquire_channel('e', 2, 60) == 1
+    assert (state.channel_count(), state.waiting_count()) == (2, 1)
+
+
+def test_a_lease_lapses_unless_renewed(state):
+    assert state.acquire_channel('a', 1, 0.2) == 0
+    assert state.acquire_channel('b', 1, 0.2) == 1
+    assert state.renew_channel('a', 0.2)
+    time.sleep(0.3)
+    assert not state.renew_channel('a', 0.2)
+    # b stopped asking as well, so the freed channel goes to whoever asks now
+    assert state.acquire_channel('c', 1, 0.2) == 0
+    assert state.reap_channels(0.2) == 0
+    assert (state.channel_count(), state.waiting_count()) == (1, 0)
+
+
+def test_counters(state):
+    assert state.counter('catalog') == 0
+    assert [state.bump('catalog') for _ in range(3)] == [1, 2, 3]
+    assert state.counter('catalog') == 3
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import time
+
+from transcode_queue import PRIORITY_VIEWER, TranscodeQueue
+
+
+async def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+
+def test_viewer_requests_run_before_background_work(tmp_path):
+    ran = []
+
+    async def handler(job):
+        ran.append(job.name)
+        return True
+
+    async def main():
+        queue = TranscodeQueue(handler, str(tmp_path / 'queue.json'))
+        queue.submit('a', 'a.mp4', 'hls/a')
+        queue.submit('b', 'b.mp4', 'hls/b')
+        queue.submit('c', 'c.mp4', 'hls/c', PRIORITY_VIEWER)
+        queue.promote('b')
+        queue.start()
+        await wait_until(lambda: queue.completed == 3)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert ran == ['c', 'b', 'a']
+    with open(tmp_path / 'queue.json') as f:
+        assert json.load(f) == {'completed': 3, 'jobs': []}
+
+
+def test_failed_jobs_are_retried_with_backoff_then_given_up(tmp_path):
+    calls = {'flaky': [], 'broken': []}
+
+    async def handler(job):
+        calls[job.name].append(time.monotonic())
+        return job.name == 'flaky' and len(calls['flaky']) > 1
+
+    async def main():
+        queue = TranscodeQueue(handler, str(tmp_path / 'queue.json'), max_attempts=3, retry_backoff=0.05)
+        queue.submit('flaky', 'flaky.mp4', 'hls/flaky')
+        queue.submit('broken', 'broken.mp4', 'hls/broken')
+        queue.start()
+        await wait_until(lambda: queue.completed == 1 and queue.status()['failed'])
+        await queue.stop()
+        return queue.status()
+
+    status = asyncio.run(main())
+    assert len(calls['flaky']) == 2
+    broken = calls['broken']
+    assert len(broken) == 3
+    # The wait doubles after every failure
+    assert broken[1] - broken[0] >= 0.05
+    assert broken[2] - broken[1] >= 0.1
+    assert [(job['name'], job['attempts'], job['error']) for job in status['failed']] == [
+        ('broken', 3, 'ffmpeg exited with an error')]
+
+
+def test_a_job_resubmitted_while_running_runs_again_on_the_new_source(tmp_path):
+    ran = []
+    release = None
+
+    async def handler(job):
+        ran.append(job.input_path)
+        if len(ran) == 1:
+            await release.wait()
+        return True
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        queue = TranscodeQueue(handler, str(tmp_path / 'queue.json'))
+        queue.submit('movie', 'movie.mp4', 'hls/movie')
+        queue.start()
+        await wait_until(lambda: ran)
+        queue.submit('movie', 'movie.mkv', 'hls/movie')
+        assert queue.status()['running'][0]['resubmit']
+        release.set()
+        await wait_until(lambda: queue.completed == 1)
+        await queue.stop()
+
+    asyncio.run(main())
+    assert ran == ['movie.mp4', 'movie.mkv']
+
+
+def test_a_queued_job_follows_its_replaced_source(tmp_path):
+    queue = TranscodeQueue(None, str(tmp_path / 'queue.json'))
+    queue.submit('movie', 'movie.mp4', 'hls/movie')
+    queue.submit('movie', 'movie.mkv', 'hls/movie')
+    assert [job['input_path'] for job in queue.status()['queued']] == ['movie.mkv']
+    # And so does the state file it restarts from
+    restarted = TranscodeQueue(None, str(tmp_path / 'queue.json'))
+    assert [job['input_path'] for job in restarted.status()['queued']] == ['movie.mkv']
+
+
+def test_a_batch_writes_the_state_file_once(tmp_path):
+    state_file = tmp_path / 'queue.json'
+    queue = TranscodeQueue(None, str(state_file))
+    with queue.batch():
+        for number in range(50):
+            queue.submit(f'movie{number}', f'movie{number}.mp4', f'hls/movie{number}')
+        assert not state_file.exists()
+    with open(state_file) as f:
+        assert len(json.load(f)['jobs']) == 50
@@ -0,0 +1,288 @@
+import asyncio
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+# Lower numbers run first
+PRIORITY_VIEWER = 0
+PRIORITY_BACKGROUND = 10
+
+
+class TranscodeJob:
+    """A single queued conversion of one source video"""
+
+    def __init__(self, name, input_path, output_dir, priority=PRIORITY_BACKGROUND,
+                 state='queued', attempts=0, error=None, not_before=0.0, submitted=None, resubmit=False):
+        self.name = name
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.priority = priority
+        self.state = state
+        self.attempts = attempts
+        self.error = error
+        self.not_before = not_before
+        self.submitted = submitted or time.time()
+        # Submitted again while running, e.g. because the source was replaced
+        self.resubmit = resubmit
+        self.started = None
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'input_path': self.input_path,
+            'output_dir': self.output_dir,
+            'priority': self.priority,
+            'state': self.state,
+            'attempts': self.attempts,
+            'error': self.error,
+            'not_before': self.not_before,
+            'submitted': self.submitted,
+            'resubmit': self.resubmit,
+        }
+
+
+class TranscodeQueue:
+    """Priority job queue that runs at most `workers` transcodes at a time.
+
+    Jobs are persisted to `state_file` so queued and failed work survives a
+    restart. Failed jobs are retried with exponential backoff up to
+    `max_attempts` times. `submit` and `promote` are safe to call from any
+    thread; the workers themselves run on the event loop passed to `start`.
+    Inside `batch()` the state file is written once at the end rather than
+    after every change.
+    """
+
+    def __init__(self, handler, state_file, workers=1, max_attempts=3, retry_backoff=10):
+        self.handler = handler
+        self.state_file = state_file
+        self.workers = max(1, workers)
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.completed = 0
+        self._jobs = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wakeup = None
+        self._tasks = []
+        self._batching = 0
+        self._unsaved = False
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.state_file, 'r') as f:
+                saved = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return
+        for data in saved.get('jobs', []):
+            job = TranscodeJob(**data)
+            if job.state == 'running':
+                # Interrupted by a restart, run it again
+                job.state = 'queued'
+                job.resubmit = False
+            self._jobs[job.name] = job
+            if job.state == 'queued':
+                heapq.heappush(self._heap, (job.priority, next(self._seq), job.name))
+        self.completed = saved.get('completed', 0)
+
+    def _save(self):
+        if self._batching:
+            self._unsaved = True
+            return
+        data = {
+            'completed': self.completed,
+            'jobs': [job.to_dict() for job in self._jobs.values() if job.state != 'done'],
+        }
+        tmp_path = self.state_file + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            self._batching += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batching -= 1
+                if not self._batching and self._unsaved:
+                    self._unsaved = False
+                    self._save()
+
+    def _notify(self):
+        if self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def submit(self, name, input_path, output_dir, priority=PRIORITY_BACKGROUND):
+        """Queue a conversion, or raise the priority of an existing one.
+
+        A job that is already running is queued again once it finishes.
+        """
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None and job.state == 'running':
+                job.resubmit = True
+                job.input_path = input_path
+                self._save()
+                return job
+            if job is not None and job.state == 'queued':
+                # The source may have been replaced before the job ran, e.g. movie.mp4 by movie.mkv
+                replaced = job.input_path != input_path
+                job.input_path = input_path
+                if priority >= job.priority:
+                    if replaced:
+                        self._save()
+                    return job
+                job.priority = priority
+            else:
+                job = TranscodeJob(name, input_path, output_dir, priority)
+                self._jobs[name] = job
+            heapq.heappush(self._heap, (job.priority, next(self._seq), name))
+            self._save()
+        self._notify()
+        return job
+
+    def promote(self, name):
+        """Move a known job to the front because a viewer asked for it"""
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None or job.state not in ('queued', 'failed'):
+                return False
+        self.submit(name, job.input_path, job.output_dir, PRIORITY_VIEWER)
+        return True
+
+    def cancel(self, name):
+        """Drop a queued or failed job, e.g. because its source was deleted.
+
+        A running job is left to finish. Returns whether a job was dropped.
+        """
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None or job.state not in ('queued', 'failed'):
+                return False
+            # Its heap entry is skipped by _pop once the job is gone
+            del self._jobs[name]
+            self._save()
+        return True
+
+    def _pop(self):
+        with self._lock:
+            now = time.time()
+            while self._heap:
+                priority, _, name = heapq.heappop(self._heap)
+                job = self._jobs.get(name)
+                # Skip entries superseded by a later priority change
+                if job is None or job.state != 'queued' or job.priority != priority:
+                    continue
+                if job.not_before > now:
+                    self._loop.call_later(job.not_before - now, self._requeue, name)
+                    continue
+                job.state = 'running'
+                job.started = now
+                self._save()
+                return job
+        return None
+
+    def _requeue(self, name):
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is None or job.state != 'queued':
+                return
+            heapq.heappush(self._heap, (job.priority, next(self._seq), name))
+        self._wakeup.set()
+
+    async def _next_job(self):
+        while True:
+            job = self._pop()
+            if job is not None:
+                return job
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _worker(self):
+        while True:
+            job = await self._next_job()
+            try:
+                ok = await self.handler(job)
+                error = None if ok else 'ffmpeg exited with an error'
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.exception(f"Transcode of {job.name} crashed")
+                ok, error = False, str(e)
+            self._finish(job, ok, error)
+
+    def _finish(self, job, ok, error):
+        with self._lock:
+            job.attempts += 1
+            if job.resubmit:
+                # What it converted is already out of date, start over on the new source
+                job.state = 'queued'
+                job.attempts = 0
+                job.error = None
+                job.not_before = 0.0
+                job.resubmit = False
+                heapq.heappush(self._heap, (job.priority, next(self._seq), job.name))
+                self._save()
+                self._wakeup.set()
+                return
+            if ok:
+                job.state = 'done'
+                job.error = None
+                self.completed += 1
+                del self._jobs[job.name]
+            elif job.attempts < self.max_attempts:
+                delay = self.retry_backoff * 2 ** (job.attempts - 1)
+                job.state = 'queued'
+                job.error = error
+                job.not_before = time.time() + delay
+                self._loop.call_later(delay, self._requeue, job.name)
+            else:
+                job.state = 'failed'
+                job.error = error
+            self._save()
+
+    def start(self):
+        """Start the worker tasks on the running event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._tasks = [self._loop.create_task(self._worker()) for _ in range(self.workers)]
+        self._wakeup.set()
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def status(self):
+        """Snapshot of queued, running and failed jobs"""
+        with self._lock:
+            jobs = sorted(self._jobs.values(), key=lambda job: (job.priority, job.submitted))
+            now = time.time()
+            return {
+                'workers': self.workers,
+                'completed': self.completed,
+                'queued': [dict(job.to_dict(), retry_in=max(0, round(job.not_before - now)))
+                           for job in jobs if job.state == 'queued'],
+                'running': [dict(job.to_dict(), elapsed=round(now - (job.started or now)))
+                            for job in jobs if job.state == 'running'],
+                'failed': [job.to_dict() for job in jobs if job.state == 'failed'],
+            }